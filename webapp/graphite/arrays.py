@@ -0,0 +1,202 @@
+"""Vectorized helpers for series values backed by NumPy arrays.
+
+NumPy is optional. All helpers here expect ``enabled()`` to have been checked
+by the caller, which is False unless NumPy is installed and ``USE_NUMPY`` is
+set. Gaps are represented as NaN in float64 buffers and converted back to
+``None`` when values are handed to code that expects plain lists.
+"""
+from __future__ import division
+
+import warnings
+
+from django.conf import settings
+
+try:
+    import numpy as np
+except ImportError:
+    np = False
+
+
+NAN = float('nan')
+
+
+def enabled():
+    return bool(np) and getattr(settings, 'USE_NUMPY', False)
+
+
+def isArray(values):
+    return bool(np) and isinstance(values, np.ndarray)
+
+
+def toArray(values):
+    """Return ``values`` as a float64 array with NaN in place of None."""
+    if isArray(values) and values.dtype == np.float64:
+        return values
+    return np.array(values, dtype=np.float64)
+
+
+def toGapArray(values):
+    """Return a list of values as a float64 array with NaN in place of None.
+
+    Returns None if the values aren't all numbers, or if some of them are NaN:
+    the helpers here take NaN for gaps, while the functions working on lists
+    only skip None and keep NaN values.
+    """
+    try:
+        array = np.array(values, dtype=np.float64)
+    except (TypeError, ValueError):
+        return None
+    if np.isnan(array).sum() != list.count(values, None):
+        return None
+    return array
+
+
+def countGaps(values):
+    """Return the number of NaN values of an array."""
+    return int(np.isnan(values).sum())
+
+
+def fromArray(values, valid=None):
+    """Return a list of floats with None wherever ``valid`` is False.
+
+    If ``valid`` isn't given NaN values are treated as gaps.
+    """
+    if valid is None:
+        valid = ~np.isnan(values)
+    if valid.all():
+        return values.tolist()
+    out = values.astype(object)
+    out[~valid] = None
+    return out.tolist()
+
+
+def _first(matrix, valid):
+    idx = valid.argmax(axis=1)
+    return matrix[np.arange(len(matrix)), idx]
+
+
+def _last(matrix, valid):
+    idx = valid.shape[1] - 1 - valid[:, ::-1].argmax(axis=1)
+    return matrix[np.arange(len(matrix)), idx]
+
+
+def _sum(matrix, valid):
+    return np.where(valid, matrix, 0.0).sum(axis=1)
+
+
+def _median(matrix, valid):
+    with warnings.catch_warnings():
+        # all-NaN rows are masked by the caller
+        warnings.simplefilter('ignore', RuntimeWarning)
+        return np.nanmedian(np.where(valid, matrix, np.nan), axis=1)
+
+
+def _stddev(matrix, valid):
+    count = valid.sum(axis=1)
+    avg = _sum(matrix, valid) / count
+    deviation = np.where(valid, matrix - avg[:, None], 0.0)
+    return np.sqrt((deviation * deviation).sum(axis=1) / count)
+
+
+def reduceRows(matrix, valid, func, rowLengths=None):
+    """Reduce each row of a 2D array, ignoring cells where ``valid`` is False.
+
+    ``func`` is one of the names in ``graphite.functions.aggfuncs.aggFuncs``.
+    ``rowLengths`` is the number of real cells in each row (excluding any
+    padding) and is only used by ``avg_zero``. Rows without any valid cell
+    produce meaningless results and must be masked by the caller.
+    """
+    with np.errstate(invalid='ignore', divide='ignore', over='ignore'):
+        if func == 'sum':
+            return _sum(matrix, valid)
+        if func == 'average':
+            return _sum(matrix, valid) / valid.sum(axis=1)
+        if func == 'avg_zero':
+            if rowLengths is None:
+                rowLengths = matrix.shape[1]
+            return _sum(matrix, valid) / rowLengths
+        if func == 'median':
+            return _median(matrix, valid)
+        if func == 'max':
+            return np.where(valid, matrix, -np.inf).max(axis=1)
+        if func == 'min':
+            return np.where(valid, matrix, np.inf).min(axis=1)
+        if func == 'diff':
+            return 2 * _first(matrix, valid) - _sum(matrix, valid)
+        if func == 'stddev':
+            return _stddev(matrix, valid)
+        if func == 'range':
+            return (np.where(valid, matrix, -np.inf).max(axis=1) -
+                    np.where(valid, matrix, np.inf).min(axis=1))
+        if func == 'multiply':
+            return np.where(valid, matrix, 1.0).prod(axis=1)
+        if func == 'first':
+            return _first(matrix, valid)
+        if func == 'last':
+            return _last(matrix, valid)
+    raise ValueError("Unsupported reduction: '%s'" % func)
+
+
+def consolidate(values, valuesPerPoint, func, xFilesFactor):
+    """Consolidate ``values`` into buckets of ``valuesPerPoint`` points.
+
+    Mirrors ``TimeSeries.__consolidatingGenerator``: a bucket is None unless
+    at least ``xFilesFactor`` of its ``valuesPerPoint`` slots are non-null.
+    """
+    arr = toArray(values)
+    count = len(arr)
+    if not count:
+        return []
+
+    buckets = -(-count // valuesPerPoint)
+    padding = buckets * valuesPerPoint - count
+    if padding:
+        arr = np.concatenate((arr, np.full(padding, np.nan)))
+
+    matrix = arr.reshape(buckets, valuesPerPoint)
+    valid = ~np.isnan(matrix)
+    nonNull = valid.sum(axis=1)
+
+    rowLengths = np.full(buckets, valuesPerPoint)
+    rowLengths[-1] -= padding
+
+    result = reduceRows(matrix, valid, func, rowLengths)
+    keep = (nonNull > 0) & (nonNull / valuesPerPoint >= xFilesFactor)
+    return fromArray(result, keep)
+
+
+def stack(seriesList):
+    """Stack the (consolidated) values of ``seriesList`` into a 2D array.
+
+    Shorter series are padded with NaN, like ``izip_longest`` pads with None.
+    Raises ValueError if a series can't be converted by ``toGapArray``.
+    """
+    rows = [series.asarray() if series.valuesPerPoint == 1 else toGapArray(list(series))
+            for series in seriesList]
+    if any(row is None for row in rows):
+        raise ValueError("Series with non-numeric or NaN values")
+    matrix = np.full((len(rows), max(len(row) for row in rows)), np.nan)
+    for i, row in enumerate(rows):
+        matrix[i, :len(row)] = row
+    return matrix
+
+
+def aggregate(seriesList, func, xFilesFactor):
+    """Aggregate ``seriesList`` point by point using ``func``.
+
+    Equivalent to applying the matching function from
+    ``graphite.functions.aggfuncs`` to every row of
+    ``izip_longest(*seriesList)`` that passes ``xFilesFactor``.
+    """
+    columns = stack(seriesList).T
+    valid = ~np.isnan(columns)
+    nonNull = valid.sum(axis=1)
+    keep = (nonNull > 0) & (nonNull / len(seriesList) >= xFilesFactor)
+
+    if func == 'count':
+        return fromArray(nonNull, keep)
+
+    if func == 'multiply':
+        keep &= valid.all(axis=1)
+
+    return fromArray(reduceRows(columns, valid, func, len(seriesList)), keep)
@@ -30,6 +30,10 @@ class CarbonLinkRequestError(Exception):
     pass
 
 
+# Error returned by carbon for the request types it doesn't know
+UNKNOWN_REQUEST_TYPE_ERROR = 'Invalid request type'
+
+
 class CarbonLinkPool(object):
     def __init__(self, hosts, timeout):
         self.hosts = [ (server, instance) for (server, port, instance) in hosts ]
@@ -45,6 +49,9 @@ class CarbonLinkPool(object):
         self.keyfunc = load_keyfunc()
         self.connections = {}
         self.last_failure = {}
+        # Hosts running a carbon version without cache-query-bulk support,
+        # and when they were found to be
+        self.bulk_unsupported = {}
         # Create a connection pool for each host
         for host in self.hosts:
             self.connections[host] = set()
@@ -98,6 +105,70 @@ class CarbonLinkPool(object):
             metric, len(results['datapoints'])))
         return results['datapoints']
 
+    def query_bulk(self, metrics):
+        """Query the cache for several metrics at once.
+
+        Metrics are grouped by the carbon instance holding them, and each
+        instance gets a single cache-query-bulk request.  Instances running a
+        carbon version that doesn't support bulk queries are queried metric by
+        metric, for CARBONLINK_QUERY_BULK_RETRY_DELAY seconds before they are
+        sent bulk queries again.
+
+        Returns a dict of metric -> datapoints.
+        """
+        results = {}
+        single_metrics = []
+        metrics_by_host = {}
+        for metric in sorted(set(metrics)):
+            if metric.startswith(settings.CARBON_METRIC_PREFIX) or not self.hosts:
+                single_metrics.append(metric)
+            else:
+                metrics_by_host.setdefault(self.select_host(metric), []).append(metric)
+
+        for host, host_metrics in metrics_by_host.items():
+            if self.bulk_supported(host):
+                request = dict(type='cache-query-bulk', metrics=host_metrics)
+                try:
+                    result = self.send_request_to_host(host, request, '%d metrics' % len(host_metrics))
+                except socket.error as e:
+                    log.cache("Exception connecting to cache %s: %s" % (str(host), e))
+                    result = None
+
+                # if the host is down the metrics are treated like a cache miss,
+                # like cache-query does, rather than retrying them one by one
+                if result is None or 'error' not in result:
+                    result = result or {}
+                    datapoints = result.get('datapointsByMetric', {})
+                    for metric in host_metrics:
+                        results[metric] = datapoints.get(metric, [])
+                    log.cache("CarbonLink cache-query-bulk request for %d metrics returned %d datapoints" % (
+                        len(host_metrics), sum(len(points) for points in datapoints.values())))
+                    continue
+
+                if str(result['error']).startswith(UNKNOWN_REQUEST_TYPE_ERROR):
+                    log.cache("CarbonLink cache-query-bulk not supported by %s, falling back to cache-query: %s" % (
+                        str(host), result['error']))
+                    self.bulk_unsupported[host] = time.time()
+                else:
+                    log.cache("CarbonLink cache-query-bulk failed on %s, falling back to cache-query: %s" % (
+                        str(host), result['error']))
+
+            single_metrics.extend(host_metrics)
+
+        for metric in single_metrics:
+            try:
+                results[metric] = self.query(metric)
+            except Exception:
+                log.exception("Failed CarbonLink query '%s'" % metric)
+                results[metric] = []
+
+        return results
+
+    def bulk_supported(self, host):
+        unsupported_since = self.bulk_unsupported.get(host)
+        return unsupported_since is None or \
+            time.time() - unsupported_since >= settings.CARBONLINK_QUERY_BULK_RETRY_DELAY
+
     def get_metadata(self, metric, key):
         request = dict(type='get-metadata', metric=metric, key=key)
         results = self.send_request(request)
@@ -112,9 +183,6 @@ class CarbonLinkPool(object):
 
     def send_request(self, request):
         metric = request['metric']
-        serialized_request = pickle.dumps(request, protocol=settings.CARBONLINK_PICKLE_PROTOCOL)
-        len_prefix = struct.pack("!L", len(serialized_request))
-        request_packet = len_prefix + serialized_request
         result = {}
         result.setdefault('datapoints', [])
 
@@ -126,20 +194,34 @@ class CarbonLinkPool(object):
             return result
 
         host = self.select_host(metric)
+        response = self.send_request_to_host(host, request, metric)
+        if response is None:
+            return result
+        if 'error' in response:
+            log.cache("Error getting data from cache: %s" % response['error'])
+            raise CarbonLinkRequestError(response['error'])
+        log.cache("CarbonLink finished receiving %s from %s" % (str(metric), str(host)))
+        return response
+
+    def send_request_to_host(self, host, request, description):
+        """Send a request to a carbon instance and return its response.
+
+        Returns None if the request failed after connecting to the host.
+        """
+        serialized_request = pickle.dumps(request, protocol=settings.CARBONLINK_PICKLE_PROTOCOL)
+        len_prefix = struct.pack("!L", len(serialized_request))
+        request_packet = len_prefix + serialized_request
+
         conn = self.get_connection(host)
-        log.cache("CarbonLink sending request for %s to %s" % (metric, str(host)))
+        log.cache("CarbonLink sending request for %s to %s" % (description, str(host)))
         try:
             conn.sendall(request_packet)
             result = self.recv_response(conn)
         except Exception as e:
             self.last_failure[host] = time.time()
             log.cache("Exception getting data from cache %s: %s" % (str(host), e))
-        else:
-            self.connections[host].add(conn)
-            if 'error' in result:
-                log.cache("Error getting data from cache: %s" % result['error'])
-                raise CarbonLinkRequestError(result['error'])
-            log.cache("CarbonLink finished receiving %s from %s" % (str(metric), str(host)))
+            return None
+        self.connections[host].add(conn)
         return result
 
     def send_request_to_all(self, request):
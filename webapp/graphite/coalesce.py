@@ -0,0 +1,156 @@
+"""Coalescing of identical concurrent requests.
+
+When many clients ask for the same thing at the same moment (e.g. everyone
+opening the same dashboard during an incident) only the first caller does the
+work; the others wait for it and share its result.
+"""
+import time
+
+from functools import wraps
+from threading import Event, Lock
+
+from django.conf import settings
+from django.core.cache import cache
+
+from graphite.logger import log
+from graphite.util import pickle
+
+
+class _Call(object):
+    __slots__ = ('event', 'result', 'exception')
+
+    def __init__(self):
+        self.event = Event()
+        self.result = None
+        self.exception = None
+
+
+class SingleFlight(object):
+    """Execute a function only once at a time for a given key within this process.
+
+    Callers arriving while a call with the same key is in flight block until it
+    completes and get its result (or its exception) instead of running the
+    function themselves.
+    """
+
+    def __init__(self, name):
+        self.name = name
+        self.lock = Lock()
+        self.calls = {}
+
+    def do(self, key, func, *args, **kwargs):
+        """Return a tuple of (result, shared).
+
+        ``shared`` is True if the result was computed by another caller, in
+        which case the caller must not modify it.
+        """
+        with self.lock:
+            call = self.calls.get(key)
+            leader = call is None
+            if leader:
+                call = self.calls[key] = _Call()
+
+        if not leader:
+            log.debug('%s: waiting for in-flight call %s' % (self.name, key))
+            call.event.wait()
+            if call.exception is not None:
+                raise call.exception
+            return (call.result, True)
+
+        try:
+            call.result = func(*args, **kwargs)
+            return (call.result, False)
+        except Exception as e:
+            call.exception = e
+            raise
+        finally:
+            with self.lock:
+                del self.calls[key]
+            call.event.set()
+
+
+def wait_for_cache(key, timeout, interval=0.05):
+    """Wait for another process to compute ``key``, return its cached value.
+
+    The process computing a value holds ``lock:<key>`` in the Django cache (see
+    ``cache_lock``).  Returns None if there's no such process, or it didn't
+    store a value within ``timeout`` seconds.
+    """
+    lock_key = 'lock:%s' % key
+    deadline = time.time() + timeout
+    while True:
+        value = cache.get(key)
+        if value is not None:
+            return value
+        if time.time() > deadline or cache.get(lock_key) is None:
+            return None
+        time.sleep(interval)
+
+
+class cache_lock(object):
+    """Context manager holding ``lock:<key>`` in the Django cache.
+
+    ``acquired`` is False if another process already holds the lock.
+    """
+
+    def __init__(self, key, timeout):
+        self.lock_key = 'lock:%s' % key
+        self.timeout = timeout
+        self.acquired = False
+
+    def __enter__(self):
+        self.acquired = cache.add(self.lock_key, True, self.timeout)
+        return self
+
+    def __exit__(self, *exc_info):
+        if self.acquired:
+            cache.delete(self.lock_key)
+
+
+_render_requests = SingleFlight('render')
+
+
+def coalesce_render(key_func):
+    """Coalesce concurrent view calls for which ``key_func(request)`` is equal.
+
+    Requests are coalesced within the process if COALESCE_REQUESTS is set.
+    If COALESCE_REQUESTS_ACROSS_PROCESSES is also set, a request that another
+    process is already computing waits for that process to store the response
+    in the Django cache (which the view must do under the same key) instead of
+    computing it again.
+
+    Waiting callers receive a copy of the response, or render their own if it
+    is a streaming response.
+    """
+    def decorator(view):
+        def run(request, key):
+            if not settings.COALESCE_REQUESTS_ACROSS_PROCESSES or 'noCache' in request.GET or 'noCache' in request.POST:
+                return view(request)
+
+            with cache_lock(key, settings.FETCH_TIMEOUT) as lock:
+                if lock.acquired:
+                    return view(request)
+
+            response = wait_for_cache(key, settings.FETCH_TIMEOUT)
+            if response is not None:
+                log.cache('Request-Cache hit [%s] after waiting for another process' % key)
+                return response
+            return view(request)
+
+        @wraps(view)
+        def wrapped(request):
+            if not settings.COALESCE_REQUESTS:
+                return view(request)
+
+            key = key_func(request)
+            (response, shared) = _render_requests.do(key, run, request, key)
+            if shared:
+                # streaming responses are generated as they are sent, so they
+                # can't be shared and each request renders its own
+                if response.streaming:
+                    return view(request)
+                response = pickle.loads(pickle.dumps(response, protocol=-1))
+            return response
+
+        return wrapped
+    return decorator
@@ -0,0 +1,215 @@
+"""Binary columnar encoding of rendered series for intra-cluster requests.
+
+A response starts with the ``MAGIC`` bytes, a version byte and a flags byte.
+If ``FLAG_ZLIB`` is set the rest of the response is zlib compressed.  Next is
+the number of series, then for each series:
+
+  - the length of its header and the header itself, the JSON encoded series
+    info (as returned by ``TimeSeries.getInfo()``) without the values,
+  - the number of values,
+  - the values, packed as little-endian float64 (0.0 for gaps),
+  - a bitmap of the values that aren't gaps, least significant bit first.
+
+All lengths are little-endian uint32.  If ``graphite.arrays.enabled()``
+values are decoded as float64 arrays over the buffer, with NaN in the gaps,
+otherwise as lists with None in the gaps.  Series with NaN values of their own
+are always decoded as lists, so that they aren't mistaken for gaps.
+"""
+import struct
+import sys
+import zlib
+
+from array import array
+
+from graphite import arrays
+from graphite.arrays import np
+from graphite.util import json
+
+CONTENT_TYPE = 'application/x-graphite-columnar'
+
+MAGIC = b'GCOL'
+VERSION = 1
+FLAG_ZLIB = 0x01
+
+_PREAMBLE = struct.Struct('<4sBB')
+_UINT32 = struct.Struct('<I')
+
+# bytes read from the stream at a time when decompressing
+_CHUNK_SIZE = 64 * 1024
+
+
+def dumps(data, compress=False):
+    """Encode a list of series"""
+    return b''.join(iterdump(data, compress))
+
+
+def iterdump(data, compress=False):
+    """Encode a list of series, yielding the encoding of one series at a time"""
+    yield _PREAMBLE.pack(MAGIC, VERSION, FLAG_ZLIB if compress else 0)
+
+    compressor = zlib.compressobj(1) if compress else None
+    for piece in _iterdump(data):
+        if compressor:
+            piece = compressor.compress(piece)
+        if piece:
+            yield piece
+    if compressor:
+        yield compressor.flush()
+
+
+def _iterdump(data):
+    yield _UINT32.pack(len(data))
+    for series in data:
+        info = series.getInfo()
+        values = info.pop('values')
+        header = json.dumps(info).encode('utf-8')
+        yield _UINT32.pack(len(header)) + header
+        yield _UINT32.pack(len(values))
+        packed, bitmap = _pack(values)
+        yield packed
+        yield bitmap
+
+
+def _pack(values):
+    count = len(values)
+    if arrays.enabled():
+        valid = np.array(values, dtype=object) != None  # noqa: E711
+        # None is converted to NaN
+        packed = np.array(values, dtype=np.float64)
+        packed[~valid] = 0.0
+        return packed.astype('<f8').tobytes(), np.packbits(valid, bitorder='little').tobytes()
+
+    packed = array('d', [0.0 if value is None else value for value in values])
+    if sys.byteorder == 'big':
+        packed.byteswap()
+    bits = ''.join(['0' if value is None else '1' for value in values])
+    bitmap = int(bits[::-1] or '0', 2).to_bytes((count + 7) // 8, 'little')
+    return packed.tobytes(), bitmap
+
+
+def _checkPreamble(magic, version):
+    if magic != MAGIC:
+        raise ValueError('Invalid columnar data')
+    if version != VERSION:
+        raise ValueError('Unsupported columnar data version %d' % version)
+
+
+def loads(buffer):
+    """Decode a list of series info"""
+    magic, version, flags = _PREAMBLE.unpack_from(buffer)
+    _checkPreamble(magic, version)
+
+    body = memoryview(buffer)[_PREAMBLE.size:]
+    if flags & FLAG_ZLIB:
+        body = memoryview(zlib.decompress(body))
+
+    (count,) = _UINT32.unpack_from(body)
+    offset = _UINT32.size
+    data = []
+    for _ in range(count):
+        (length,) = _UINT32.unpack_from(body, offset)
+        offset += _UINT32.size
+        info = json.loads(bytes(body[offset:offset + length]).decode('utf-8'))
+        offset += length
+
+        (length,) = _UINT32.unpack_from(body, offset)
+        offset += _UINT32.size
+        packed = body[offset:offset + 8 * length]
+        offset += 8 * length
+        bitmap = body[offset:offset + (length + 7) // 8]
+        offset += (length + 7) // 8
+        if len(packed) != 8 * length or len(bitmap) != (length + 7) // 8:
+            raise ValueError('Truncated columnar data')
+
+        info['values'] = _unpack(packed, bitmap, length)
+        data.append(info)
+
+    return data
+
+
+def load(stream):
+    """Decode a list of series info read from a file-like object
+
+    The stream is read (and decompressed) as the series are decoded, so that
+    only the series being decoded is buffered besides the results.
+    """
+    magic, version, flags = _PREAMBLE.unpack(_read(stream, _PREAMBLE.size))
+    _checkPreamble(magic, version)
+
+    if flags & FLAG_ZLIB:
+        stream = _ZlibReader(stream)
+
+    (count,) = _UINT32.unpack(_read(stream, _UINT32.size))
+    data = []
+    for _ in range(count):
+        (length,) = _UINT32.unpack(_read(stream, _UINT32.size))
+        info = json.loads(_read(stream, length).decode('utf-8'))
+
+        (length,) = _UINT32.unpack(_read(stream, _UINT32.size))
+        packed = _read(stream, 8 * length)
+        bitmap = _read(stream, (length + 7) // 8)
+
+        info['values'] = _unpack(packed, bitmap, length)
+        data.append(info)
+
+    return data
+
+
+def _read(stream, size):
+    """Read exactly size bytes from a stream"""
+    chunks = []
+    while size > 0:
+        chunk = stream.read(size)
+        if not chunk:
+            raise ValueError('Truncated columnar data')
+        chunks.append(chunk)
+        size -= len(chunk)
+    return chunks[0] if len(chunks) == 1 else b''.join(chunks)
+
+
+class _ZlibReader(object):
+    """File-like object decompressing a zlib stream as it is read"""
+
+    def __init__(self, stream):
+        self.stream = stream
+        self.decompressor = zlib.decompressobj()
+        self.buffer = bytearray()
+
+    def read(self, size):
+        while len(self.buffer) < size and self.decompressor is not None:
+            chunk = self.stream.read(_CHUNK_SIZE)
+            if chunk:
+                self.buffer += self.decompressor.decompress(chunk)
+            else:
+                self.buffer += self.decompressor.flush()
+                self.decompressor = None
+        data = bytes(self.buffer[:size])
+        del self.buffer[:size]
+        return data
+
+
+def _unpack(packed, bitmap, count):
+    if arrays.enabled():
+        values = np.frombuffer(packed, dtype='<f8')
+        valid = np.unpackbits(np.frombuffer(bitmap, dtype=np.uint8), count=count, bitorder='little').astype(bool)
+        if np.isnan(values[valid]).any():
+            return arrays.fromArray(values, valid)
+        if valid.all():
+            return values
+        values = values.copy()
+        values[~valid] = arrays.NAN
+        return values
+
+    values = array('d')
+    values.frombytes(packed)
+    if sys.byteorder == 'big':
+        values.byteswap()
+    values = values.tolist()
+
+    # only look at the bytes of the bitmap with gaps
+    for i, byte in enumerate(bitmap):
+        if byte != 0xff:
+            for j in range(i * 8, min(i * 8 + 8, count)):
+                if not byte & (1 << (j - i * 8)):
+                    values[j] = None
+    return values
@@ -0,0 +1,310 @@
+"""Cache of find results shared by the finders and the webapp processes.
+
+Entries are served stale while a single thread (and, as far as the cache
+backend allows, a single process) finds them again in the background, and
+expire after a jittered delay so that entries cached at the same moment
+aren't all found again at the same moment.
+
+The cache stores the path, type and intervals of the nodes, not their
+readers: the leaf nodes of a cached result get a ``CachedReader`` which
+finds the node again (without the cache) if it is fetched.
+"""
+import fcntl
+import math
+import mmap
+import os
+import random
+import struct
+import time
+
+from hashlib import md5
+from threading import Lock
+
+from django.conf import settings
+from django.core.cache import cache
+
+from graphite.finders.utils import FindQuery
+from graphite.intervals import Interval, IntervalSet
+from graphite.logger import log
+from graphite.node import BranchNode, LeafNode
+from graphite.readers.utils import BaseReader
+from graphite.render.hashing import compactHash
+from graphite.util import pickle
+from graphite.worker_pool.pool import get_pool
+
+
+# size of the slots of the FileCache of the refresh locks, which hold True
+LOCK_SLOT_SIZE = 64
+
+
+class FileCache(object):
+    """Cache shared by the processes of a host through a memory mapped file.
+
+    Implements the part of the Django cache API used by FindCache.  The file
+    is made of ``slots`` slots of ``slot_size`` bytes, each key is stored in
+    the slot of its hash, replacing whatever was stored there.  A slot holds
+    a header (sequence number, expiry time, key hash and length of the value)
+    followed by the pickled value.  Writers lock the file, readers don't but
+    read a slot again if its sequence number changed while reading it.
+    Values that don't fit in a slot aren't stored.
+
+    ``add()`` doesn't replace the live value of another key either, so that a
+    FileCache can hold locks: a lock is never taken over by another one.
+    """
+    _HEADER = struct.Struct('<QdQI')
+
+    def __init__(self, path, slots, slot_size):
+        self.slots = slots
+        self.slot_size = slot_size
+        self.lock = Lock()
+        size = slots * slot_size
+        self.fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+        if os.fstat(self.fd).st_size < size:
+            os.ftruncate(self.fd, size)
+        self.map = mmap.mmap(self.fd, size)
+
+    def _slot(self, key):
+        digest = md5(key.encode('utf-8')).digest()
+        key_hash = struct.unpack('<Q', digest[:8])[0]
+        return key_hash, (key_hash % self.slots) * self.slot_size
+
+    def get(self, key, default=None):
+        key_hash, offset = self._slot(key)
+        for _ in range(3):
+            seq, expires, slot_hash, length = self._HEADER.unpack_from(self.map, offset)
+            if seq % 2:
+                # a write is in progress
+                time.sleep(0.001)
+                continue
+            if slot_hash != key_hash or expires < time.time() \
+                    or length > self.slot_size - self._HEADER.size:
+                return default
+            start = offset + self._HEADER.size
+            data = self.map[start:start + length]
+            if self._HEADER.unpack_from(self.map, offset)[0] != seq:
+                continue
+            try:
+                return pickle.loads(data)
+            except Exception:
+                return default
+        return default
+
+    def set(self, key, value, timeout):
+        data = self._dumps(key, value)
+        if data is None:
+            return
+        with self._locked():
+            self._write(key, data, time.time() + timeout)
+
+    def add(self, key, value, timeout):
+        data = self._dumps(key, value)
+        if data is None:
+            return False
+        with self._locked():
+            offset = self._slot(key)[1]
+            if self._HEADER.unpack_from(self.map, offset)[1] >= time.time():
+                return False
+            self._write(key, data, time.time() + timeout)
+            return True
+
+    def _dumps(self, key, value):
+        """Pickle a value, return None if it doesn't fit in a slot"""
+        data = pickle.dumps(value, protocol=-1)
+        if len(data) > self.slot_size - self._HEADER.size:
+            log.debug('FileCache: %d bytes value of %s is too large' % (len(data), key))
+            return None
+        return data
+
+    def delete(self, key):
+        with self._locked():
+            key_hash, offset = self._slot(key)
+            if self._HEADER.unpack_from(self.map, offset)[2] == key_hash:
+                self._write(key, b'', 0)
+
+    def _write(self, key, data, expires):
+        key_hash, offset = self._slot(key)
+        # the sequence number is odd while the slot is written
+        seq = self._HEADER.unpack_from(self.map, offset)[0]
+        if seq % 2 == 0:
+            seq += 1
+        self._HEADER.pack_into(self.map, offset, seq, 0, key_hash, 0)
+        start = offset + self._HEADER.size
+        self.map[start:start + len(data)] = data
+        self._HEADER.pack_into(self.map, offset, seq + 1, expires, key_hash, len(data))
+
+    def _locked(self):
+        return _FileLock(self.lock, self.fd)
+
+
+class _FileLock(object):
+    """Lock a file for the threads of this process and for other processes"""
+
+    def __init__(self, lock, fd):
+        self.lock = lock
+        self.fd = fd
+
+    def __enter__(self):
+        self.lock.acquire()
+        fcntl.lockf(self.fd, fcntl.LOCK_EX)
+
+    def __exit__(self, *exc_info):
+        fcntl.lockf(self.fd, fcntl.LOCK_UN)
+        self.lock.release()
+
+
+class FindCache(object):
+    """Stale-while-revalidate cache of find and index results.
+
+    The locks of the entries being refreshed are stored in ``locks``, the
+    backend by default.
+    """
+
+    def __init__(self, backend, locks=None):
+        self.backend = backend
+        self.locks = locks if locks is not None else backend
+        self.lock = Lock()
+        self.refreshing = set()
+
+    def get(self, key, compute, fallback_keys=()):
+        """Return the cached value of key, or compute() it.
+
+        A value cached under one of fallback_keys (e.g. the key of the same
+        query for the previous time period) is served stale if key isn't
+        cached.
+        """
+        entry = self.backend.get(key)
+        if entry is None:
+            for fallback_key in fallback_keys:
+                entry = self.backend.get(fallback_key)
+                if entry is not None:
+                    entry = (0, entry[1])
+                    break
+
+        if entry is None:
+            return self._compute(key, compute)
+
+        (fresh_until, value) = entry
+        if fresh_until <= time.time():
+            self._refresh(key, compute)
+        return value
+
+    def _compute(self, key, compute):
+        value = compute()
+        duration = settings.FIND_RESULT_CACHE_DURATION
+        fresh_until = time.time() + duration * (1 - settings.FIND_RESULT_CACHE_JITTER * random.random())
+        timeout = int(math.ceil(duration + settings.FIND_RESULT_CACHE_STALE))
+        self.backend.set(key, (fresh_until, value), timeout)
+        return value
+
+    def _refresh(self, key, compute):
+        """Compute key again in the background, once at a time"""
+        with self.lock:
+            if key in self.refreshing:
+                return
+            self.refreshing.add(key)
+
+        lock_key = 'lock:%s' % key
+        if not self.locks.add(lock_key, True, int(math.ceil(settings.FIND_TIMEOUT))):
+            # another process is refreshing it
+            with self.lock:
+                self.refreshing.discard(key)
+            return
+
+        log.debug('FindCache: refreshing %s' % key)
+        get_pool('find_cache', settings.POOL_MAX_WORKERS).apply_async(
+            self._run_refresh, (key, compute, lock_key))
+
+    def _run_refresh(self, key, compute, lock_key):
+        try:
+            self._compute(key, compute)
+        except Exception:
+            log.exception('FindCache: failed to refresh %s' % key)
+        finally:
+            self.locks.delete(lock_key)
+            with self.lock:
+                self.refreshing.discard(key)
+
+
+class CachedReader(BaseReader):
+    """Reader of a leaf node from the find cache"""
+    __slots__ = ('store', 'path', 'intervals', 'local', 'headers')
+
+    def __init__(self, store, path, intervals, local=False, headers=None):
+        self.store = store
+        self.path = path
+        self.intervals = intervals
+        self.local = local
+        self.headers = headers
+
+    def get_intervals(self):
+        return self.intervals
+
+    def fetch(self, startTime, endTime, now=None, requestContext=None):
+        query = FindQuery(self.path, startTime, endTime, local=self.local, headers=self.headers)
+        for node in self.store._find_nodes(query):
+            if node.is_leaf:
+                return node.fetch(startTime, endTime, now, requestContext)
+        return None
+
+    def __repr__(self):
+        return '<CachedReader[%x]: %s>' % (id(self), self.path)
+
+
+def find_keys(query):
+    """Return the cache key of a find query and its fallback keys.
+
+    The time range of the query is rounded to FIND_RESULT_CACHE_DURATION, the
+    fallback is the key of the previous period.
+    """
+    duration = settings.FIND_RESULT_CACHE_DURATION or 1
+
+    def key(shift):
+        start = end = None
+        if query.startTime is not None:
+            start = query.startTime - (query.startTime % duration) - shift
+        if query.endTime is not None:
+            end = query.endTime - (query.endTime % duration) - shift
+        headers = sorted((query.headers or {}).items())
+        return 'find-result:%s' % compactHash(repr((query.pattern, bool(query.local), headers, start, end)))
+
+    if query.startTime is None and query.endTime is None:
+        return key(0), []
+    return key(0), [key(duration)]
+
+
+def dump_nodes(nodes):
+    """Return the (path, is_leaf, intervals) tuples of a list of nodes"""
+    return [
+        (node.path, True, [(i.start, i.end) for i in node.intervals])
+        if node.is_leaf else (node.path, False, None)
+        for node in nodes
+    ]
+
+
+def load_nodes(store, query, infos):
+    """Return the nodes of a list of (path, is_leaf, intervals) tuples"""
+    for (path, is_leaf, intervals) in infos:
+        if not is_leaf:
+            yield BranchNode(path)
+            continue
+
+        intervals = IntervalSet([Interval(start, end) for (start, end) in intervals])
+        reader = CachedReader(store, path, intervals, local=query.local, headers=query.headers)
+        yield LeafNode(path, reader)
+
+
+def get_find_cache():
+    if not settings.FIND_RESULT_CACHE_FILE:
+        return FindCache(cache)
+
+    backend = FileCache(
+        settings.FIND_RESULT_CACHE_FILE,
+        settings.FIND_RESULT_CACHE_FILE_SLOTS,
+        settings.FIND_RESULT_CACHE_FILE_SLOT_SIZE)
+    # the locks don't share the slots of the entries, so that they can't
+    # replace an entry or be replaced by one
+    locks = FileCache(
+        settings.FIND_RESULT_CACHE_FILE + '.locks',
+        settings.FIND_RESULT_CACHE_FILE_SLOTS,
+        LOCK_SLOT_SIZE)
+    return FindCache(backend, locks)
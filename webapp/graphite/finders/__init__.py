@@ -2,6 +2,8 @@ import fnmatch
 import os.path
 import re
 
+from functools import lru_cache
+
 EXPAND_BRACES_RE = re.compile(r'(\{([^\{\}]*)\})')
 
 
@@ -37,14 +39,45 @@ def extract_variants(pattern):
         return [pattern]
 
 
+def split_pattern(pattern):
+    """Split a pattern into the patterns of its path components.
+
+    Returns a list of lists of component patterns, one per variant of the
+    pattern: {foo,bar} variants are kept in their component unless they span
+    several components, ie. a.{b,c}.d = [a, {b,c}, d] but
+    a.{b.c,d}.e = [a, b, c, e] and [a, d, e].
+    """
+    depth = 0
+    for char in pattern:
+        if char == '{':
+            depth += 1
+        elif char == '}':
+            depth = max(0, depth - 1)
+        elif char == '.' and depth:
+            return [variant.split('.') for variant in sorted(expand_braces(pattern))]
+    return [pattern.split('.')]
+
+
 def match_entries(entries, pattern):
-    # First we check for pattern variants (ie. {foo,bar}baz = foobaz or barbaz)
-    matching = []
+    """Return the entries matching a path component pattern.
+
+    Supports the fnmatch wildcards and {foo,bar} variants, matching every
+    entry only once against a single compiled regular expression.
+    """
+    match = compile_pattern(pattern).match
+    return [entry for entry in entries if match(entry)]
+
 
-    for variant in expand_braces(pattern):
-        matching.extend(fnmatch.filter(entries, variant))
+@lru_cache(maxsize=1024)
+def compile_pattern(pattern):
+    """Compile a path component pattern into a single regular expression.
 
-    return list(set(matching))
+    The pattern can contain the fnmatch wildcards and {foo,bar} variants.
+    Variants are only expanded once, when the pattern is compiled, into an
+    alternation of their fnmatch translations.
+    """
+    variants = sorted(expand_braces(pattern))
+    return re.compile('|'.join('(?:%s)' % fnmatch.translate(variant) for variant in variants))
 
 
 """
@@ -15,7 +15,8 @@ from django.conf import settings
 from graphite.node import BranchNode, LeafNode
 from graphite.readers import CeresReader
 from graphite.finders.utils import BaseFinder
-from graphite.finders import get_real_metric_path, extract_variants
+from graphite.finders import get_real_metric_path, match_entries, split_pattern
+from graphite.util import is_pattern
 from graphite.tags.utils import TaggedSeries
 
 
@@ -35,26 +36,76 @@ class CeresFinder(BaseFinder):
                 TaggedSeries.encode(query.pattern, hash_only=True),
                 TaggedSeries.encode(query.pattern, hash_only=False),
             ]
+            fs_paths = [
+                fs_path
+                for variant in variants
+                for fs_path in glob(self.tree.getFilesystemPath(variant))
+            ]
         else:
-            variants = extract_variants(query.pattern)
+            fs_paths = self._find_variants(split_pattern(query.pattern))
+
+        for fs_path in fs_paths:
+            metric_path = self.tree.getNodePath(fs_path)
+
+            if CeresNode.isNodeDir(fs_path):
+                ceres_node = self.tree.getNode(metric_path)
+
+                if ceres_node.hasDataForInterval(query.startTime, query.endTime):
+                    real_metric_path = get_real_metric_path(fs_path, metric_path)
+                    reader = CeresReader(ceres_node, real_metric_path)
+                    # if we're finding by tag, return the proper metric path
+                    if tagged:
+                        metric_path = query.pattern
+                    yield LeafNode(metric_path, reader)
 
-        for variant in variants:
-            for fs_path in glob(self.tree.getFilesystemPath(variant)):
-                metric_path = self.tree.getNodePath(fs_path)
+            elif os.path.isdir(fs_path):
+                yield BranchNode(metric_path)
 
-                if CeresNode.isNodeDir(fs_path):
-                    ceres_node = self.tree.getNode(metric_path)
+    def _find_variants(self, variants):
+        """Generates the paths matching any of the variants of a split pattern"""
+        if len(variants) == 1:
+            for path in self._find_paths(self.tree.root, variants[0]):
+                yield path
+            return
 
-                    if ceres_node.hasDataForInterval(query.startTime, query.endTime):
-                        real_metric_path = get_real_metric_path(fs_path, metric_path)
-                        reader = CeresReader(ceres_node, real_metric_path)
-                        # if we're finding by tag, return the proper metric path
-                        if tagged:
-                            metric_path = query.pattern
-                        yield LeafNode(metric_path, reader)
+        seen = set()
+        for patterns in variants:
+            for path in self._find_paths(self.tree.root, patterns):
+                if path not in seen:
+                    seen.add(path)
+                    yield path
+
+    def _find_paths(self, current_dir, patterns):
+        """Recursively generates the paths underneath current_dir whose components
+        match the corresponding pattern in patterns.
+
+        Works like glob() on every {foo,bar} variant of the pattern, but lists
+        each directory only once and matches all the variants in one pass.
+        """
+        pattern = patterns[0]
+        patterns = patterns[1:]
+
+        if is_pattern(pattern):
+            try:
+                entries = os.listdir(current_dir)
+            except OSError:
+                return
+            # like glob, only match hidden entries explicitly
+            if not pattern.startswith('.'):
+                entries = [entry for entry in entries if not entry.startswith('.')]
+            matching = sorted(match_entries(entries, pattern))
+        elif os.path.lexists(os.path.join(current_dir, pattern)):
+            matching = [pattern]
+        else:
+            matching = []
 
-                elif os.path.isdir(fs_path):
-                    yield BranchNode(metric_path)
+        for entry in matching:
+            path = os.path.join(current_dir, entry)
+            if not patterns:
+                yield path
+            elif os.path.isdir(path):
+                for match in self._find_paths(path, patterns):
+                    yield match
 
     def get_index(self, requestContext):
         matches = []
@@ -0,0 +1,181 @@
+"""In-memory index of the directories searched by StandardFinder."""
+import os
+import time
+
+from bisect import bisect_left
+from threading import Lock
+
+# Use the built-in version of scandir if possible, otherwise
+# use the scandir module version
+try:
+    from os import scandir
+except ImportError:
+    from scandir import scandir
+
+from graphite.logger import log
+from graphite.worker_pool.pool import get_pool
+
+
+class Directory(object):
+    """A node of the index: the names of the entries of a directory.
+
+    ``files`` is a sorted tuple of file names, ``subdirs`` maps the names of
+    subdirectories to their Directory.  Both are replaced, never modified, when
+    the directory is rescanned so that they can be read without locking.
+    """
+    __slots__ = ('mtime', 'files', 'subdirs', 'symlinks')
+
+    def __init__(self):
+        self.mtime = None
+        self.files = ()
+        self.subdirs = {}
+        # names of the subdirectories that are symbolic links
+        self.symlinks = frozenset()
+
+    def has_file(self, name):
+        i = bisect_left(self.files, name)
+        return i < len(self.files) and self.files[i] == name
+
+
+class DirectoryIndex(object):
+    """Index of the tree of directories and files under ``root_dir``.
+
+    The index mirrors the layout of the filesystem, a trie keyed by path
+    component, so that finders can match their patterns against it without
+    listing directories on every query.  It is refreshed at most every
+    ``refresh_interval`` seconds, only rescanning the directories whose mtime
+    changed since they were last scanned.  Indexing runs in the background,
+    queries keep using the current index meanwhile, and the index isn't
+    ``ready`` to be used until it has been built once.
+
+    The methods below are drop-in replacements for the os and os.path
+    functions of the same name for paths under ``root_dir``.
+    """
+
+    def __init__(self, root_dir, refresh_interval):
+        self.root_dir = os.path.normpath(root_dir)
+        self.refresh_interval = refresh_interval
+        self.root = Directory()
+        self.last_refresh = None
+        self.lock = Lock()
+        # result of the refresh running in the background
+        self.pending = None
+
+    @property
+    def ready(self):
+        """True once the whole tree has been indexed"""
+        return self.last_refresh is not None
+
+    def refresh(self, force=False, wait=False):
+        """Rescan the directories that changed if the index is out of date.
+
+        The rescan runs in the background, at most one at a time, unless wait
+        is set to block until it is done.
+        """
+        if not force and self.last_refresh is not None \
+                and time.time() - self.last_refresh < self.refresh_interval:
+            return
+
+        with self.lock:
+            if self.pending is None:
+                self.pending = get_pool('directory_index', 1).apply_async(self._refresh)
+            pending = self.pending
+        if wait:
+            pending.wait()
+
+    def _refresh(self):
+        try:
+            start = time.time()
+            self._refresh_dir(self.root, self.root_dir, set())
+            self.last_refresh = time.time()
+            log.debug("Refreshed index of %s in %fs" % (self.root_dir, self.last_refresh - start))
+        except Exception:
+            log.exception("Failed to refresh index of %s" % self.root_dir)
+        finally:
+            with self.lock:
+                self.pending = None
+
+    def _refresh_dir(self, directory, path, ancestors):
+        try:
+            st = os.stat(path)
+        except OSError:
+            directory.files, directory.subdirs = (), {}
+            return
+
+        # don't follow symbolic links back into a parent directory
+        inode = (st.st_dev, st.st_ino)
+        if inode in ancestors:
+            return
+
+        if st.st_mtime != directory.mtime:
+            files = []
+            subdirs = {}
+            symlinks = set()
+            try:
+                for entry in scandir(path):
+                    if entry.is_file():
+                        files.append(entry.name)
+                    if entry.is_dir():
+                        subdirs[entry.name] = directory.subdirs.get(entry.name) or Directory()
+                        if entry.is_symlink():
+                            symlinks.add(entry.name)
+            except OSError as e:
+                log.exception(e)
+            directory.files = tuple(sorted(files))
+            directory.subdirs = subdirs
+            directory.symlinks = frozenset(symlinks)
+
+            # entries can still be added within the mtime's resolution, make
+            # sure a recently modified directory is scanned again next time
+            if time.time() - st.st_mtime > 1:
+                directory.mtime = st.st_mtime
+            else:
+                directory.mtime = None
+
+        ancestors.add(inode)
+        for name, subdir in directory.subdirs.items():
+            self._refresh_dir(subdir, os.path.join(path, name), ancestors)
+        ancestors.discard(inode)
+
+    def _lookup(self, path):
+        path = os.path.normpath(path)
+        if path == self.root_dir:
+            return self.root
+        if not path.startswith(self.root_dir + os.sep):
+            return None
+
+        directory = self.root
+        for name in path[len(self.root_dir) + 1:].split(os.sep):
+            directory = directory.subdirs.get(name)
+            if directory is None:
+                return None
+        return directory
+
+    def listdir(self, path):
+        """Return the (files, subdirectories) names of a directory"""
+        directory = self._lookup(path)
+        if directory is None:
+            return [], []
+        return list(directory.files), sorted(directory.subdirs)
+
+    def walk(self, top, followlinks=False):
+        """Generate (dirpath, dirnames, filenames) tuples like os.walk()"""
+        directory = self._lookup(top)
+        if directory is None:
+            return
+
+        stack = [(top, directory)]
+        while stack:
+            path, directory = stack.pop()
+            subdirs = sorted(directory.subdirs)
+            yield path, subdirs, list(directory.files)
+            for name in reversed(subdirs):
+                if followlinks or name not in directory.symlinks:
+                    stack.append((os.path.join(path, name), directory.subdirs[name]))
+
+    def isdir(self, path):
+        return self._lookup(path) is not None
+
+    def isfile(self, path):
+        directory = self._lookup(os.path.dirname(path))
+        return directory is not None and directory.has_file(os.path.basename(path))
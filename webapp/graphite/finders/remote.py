@@ -1,17 +1,23 @@
 import codecs
 import time
 
+from collections import deque
+from threading import Lock
+
+from six.moves import queue
 from six.moves.urllib.parse import urlencode, urlsplit, parse_qs
 
 from django.conf import settings
 from django.core.cache import cache
 
+from graphite import columnar
 from graphite.http_pool import http
 from graphite.intervals import Interval, IntervalSet
 from graphite.logger import log
 from graphite.node import LeafNode, BranchNode
 from graphite.render.hashing import compactHash
 from graphite.util import unpickle, logtime, is_local_interface, json, msgpack, BufferedHTTPReader
+from graphite.worker_pool.pool import get_pool
 
 from graphite.finders.utils import BaseFinder
 from graphite.readers.remote import RemoteReader
@@ -20,6 +26,11 @@ from graphite.readers.remote import RemoteReader
 class RemoteFinder(BaseFinder):
     local = False
 
+    # number of requests of all the hosts sent (or queued) by the 'remote'
+    # pool, which runs the hedged requests
+    pool_jobs = 0
+    pool_lock = Lock()
+
     @classmethod
     def factory(cls):
         finders = []
@@ -49,14 +60,158 @@ class RemoteFinder(BaseFinder):
         self.url = parsed['url']
         self.params = parsed['params']
         self.last_failure = 0
+        # start time of the request probing the host when its circuit
+        # breaker is half-open
+        self.probe_start = None
+        self.lock = Lock()
         self.tags = not self.params.get('noTags')
+        # hedged requests go to the replica of the host, if it has one
+        self.replica_url = None
+        if self.params.get('replica'):
+            self.replica_url = self.parse_host(self.params['replica'])['url']
+        # number of hedged requests the host may still be sent, see claim_hedge()
+        self.hedge_budget = 0.0
+        self.health = PeerHealth()
+
+    @property
+    def failures(self):
+        """Return the number of consecutive failures of the host"""
+        return self.health.failures
+
+    @failures.setter
+    def failures(self, failures):
+        self.health.failures = failures
+
+    @property
+    def retry_delay(self):
+        """Return how long the host stays disabled after its last failure"""
+        if not settings.REMOTE_CIRCUIT_BREAKER:
+            return settings.REMOTE_RETRY_DELAY
+        # back off exponentially while the host keeps failing
+        return min(
+            settings.REMOTE_RETRY_DELAY,
+            settings.REMOTE_CIRCUIT_BREAKER_MIN_DELAY * 2 ** (max(self.failures, 1) - 1))
+
+    @property
+    def state(self):
+        """Return the state of the circuit breaker of the host"""
+        if not self.last_failure:
+            return 'closed'
+        if time.time() - self.last_failure < self.retry_delay:
+            return 'open'
+        return 'half-open'
 
     @property
     def disabled(self):
-        return time.time() - self.last_failure < settings.REMOTE_RETRY_DELAY
+        if not settings.REMOTE_CIRCUIT_BREAKER:
+            return time.time() - self.last_failure < settings.REMOTE_RETRY_DELAY
+
+        state = self.state
+        if state != 'half-open':
+            return state == 'open'
+
+        # a single request probes the host, see claim_probe()
+        with self.lock:
+            return self._probing()
+
+    def _probing(self):
+        # a probe that didn't complete in time lets another one through
+        return self.probe_start is not None and time.time() - self.probe_start < settings.FETCH_TIMEOUT
+
+    def claim_probe(self):
+        """Claim the request probing the host if its circuit breaker is half-open.
+
+        Returns False if another request is already probing it.  This is
+        called right before a request is sent, so that finders that are
+        enabled but not queried don't use the probe up.
+        """
+        if not settings.REMOTE_CIRCUIT_BREAKER or self.state != 'half-open':
+            return True
+        with self.lock:
+            if self._probing():
+                return False
+            self.probe_start = time.time()
+            return True
 
     def fail(self):
-        self.last_failure = time.time()
+        with self.lock:
+            self.last_failure = time.time()
+            self.probe_start = None
+        self.health.record(False)
+
+    def succeed(self):
+        with self.lock:
+            self.last_failure = 0
+            self.probe_start = None
+        self.health.record(True)
+
+    def adaptive_timeout(self, timeout, operation='find'):
+        """Return the timeout of a request to the host.
+
+        With REMOTE_ADAPTIVE_TIMEOUT, requests time out after
+        REMOTE_ADAPTIVE_TIMEOUT_FACTOR times the 99th percentile of the
+        latencies of the recent requests of the same operation ('find' or
+        'fetch') to the host, if that is shorter.
+        """
+        if not settings.REMOTE_ADAPTIVE_TIMEOUT or timeout is None:
+            return timeout
+        latency = self.health.percentile(operation, 99)
+        if latency is None:
+            return timeout
+        return min(timeout, max(
+            latency * settings.REMOTE_ADAPTIVE_TIMEOUT_FACTOR, settings.REMOTE_ADAPTIVE_TIMEOUT_MIN))
+
+    def hedge_delay(self, operation='find'):
+        """Return how long to wait for a response before sending a hedged request.
+
+        This is the REMOTE_HEDGE_PERCENTILE of the latencies of the recent
+        requests of the operation to the host, or None if there are too few
+        of them to tell.
+        """
+        latency = self.health.percentile(operation, settings.REMOTE_HEDGE_PERCENTILE)
+        if latency is None:
+            return None
+        return max(latency, settings.REMOTE_HEDGE_MIN_DELAY)
+
+    def earn_hedge(self):
+        """Add a request to the host to its hedging budget.
+
+        Every request earns REMOTE_HEDGE_BUDGET hedged requests, and at most
+        the hedged requests earned by 100 requests are saved up, so that
+        hedging never adds more than that fraction of requests to an
+        overloaded host.
+        """
+        with self.lock:
+            self.hedge_budget = min(
+                self.hedge_budget + settings.REMOTE_HEDGE_BUDGET,
+                max(1.0, settings.REMOTE_HEDGE_BUDGET * 100))
+
+    def claim_hedge(self):
+        """Claim a hedged request to the replica of the host.
+
+        Returns False if the hedging budget of the host is spent, or if all
+        the threads of the 'remote' pool are busy: the hedged request would
+        only queue up behind the others.
+        """
+        with self.lock:
+            if self.hedge_budget < 1 or not self.claim_pool():
+                return False
+            self.hedge_budget -= 1
+            return True
+
+    @classmethod
+    def claim_pool(cls):
+        """Claim a thread of the 'remote' pool, return False if none is idle"""
+        with cls.pool_lock:
+            if cls.pool_jobs >= 2 * settings.POOL_MAX_WORKERS:
+                return False
+            cls.pool_jobs += 1
+            return True
+
+    @classmethod
+    def release_pool(cls):
+        with cls.pool_lock:
+            cls.pool_jobs -= 1
 
     @logtime
     def find_nodes(self, query, timer=None):
@@ -89,9 +244,14 @@ class RemoteFinder(BaseFinder):
         else:
             url = '/metrics/find/'
 
+            # the columnar format is only used for render requests
+            find_format = self.params.get('format', 'pickle')
+            if find_format == 'columnar':
+                find_format = 'pickle'
+
             query_params = [
                 ('local', self.params.get('local', '1')),
-                ('format', self.params.get('format', 'pickle')),
+                ('format', find_format),
                 ('query', query.pattern),
             ]
             if query.startTime:
@@ -241,18 +401,28 @@ class RemoteFinder(BaseFinder):
 
         return results
 
-    def request(self, path, fields=None, headers=None, timeout=None):
+    def request(self, path, fields=None, headers=None, timeout=None, operation='find'):
         url = "%s%s" % (self.url, path)
         url_full = "%s?%s" % (url, urlencode(fields))
+        timeout = self.adaptive_timeout(timeout, operation)
+
+        if not self.claim_probe():
+            raise Exception("RemoteFinder[%s] Host is already being probed, not requesting %s" % (self.host, url_full))
+
+        delay = None
+        if (settings.REMOTE_HEDGE_REQUESTS and settings.USE_WORKER_POOL and
+                self.replica_url and timeout is not None):
+            self.earn_hedge()
+            delay = self.hedge_delay(operation)
+            # don't queue the request up behind others on a saturated pool
+            if delay is not None and not self.claim_pool():
+                delay = None
 
         try:
-            result = http.request(
-                'POST' if settings.REMOTE_STORE_USE_POST else 'GET',
-                url,
-                fields=fields,
-                headers=headers,
-                timeout=timeout,
-                preload_content=False)
+            if delay is None:
+                result = self._send(url, fields, headers, timeout, operation)
+            else:
+                result = self._hedged_send(path, fields, headers, timeout, operation, delay)
         except BaseException as err:
             self.fail()
             log.exception("RemoteFinder[%s] Error requesting %s: %s" % (self.host, url_full, err))
@@ -268,11 +438,93 @@ class RemoteFinder(BaseFinder):
         result.url_full = url_full
 
         # reset last failure time so that retried fetches can re-enable a remote
-        self.last_failure = 0
+        self.succeed()
 
         log.debug("RemoteFinder[%s] Fetched %s" % (self.host, url_full))
         return result
 
+    def _send(self, url, fields, headers, timeout, operation):
+        start = time.time()
+        result = http.request(
+            'POST' if settings.REMOTE_STORE_USE_POST else 'GET',
+            url,
+            fields=fields,
+            headers=headers,
+            timeout=timeout,
+            preload_content=False)
+        self.health.record_latency(operation, time.time() - start)
+        return result
+
+    def _hedged_send(self, path, fields, headers, timeout, operation, delay):
+        """Send a request, and send it again to the replica if there is no
+        response after delay seconds and the host has a hedging budget left
+        (see claim_hedge()).
+
+        The request runs on a thread of the 'remote' pool claimed by the
+        caller.  Returns the first successful response, the connections of the other
+        responses are closed.  Raises the last error if all requests failed,
+        or if there is no successful response within timeout seconds.
+        """
+        pool = get_pool('remote', 2 * settings.POOL_MAX_WORKERS)
+        responses = queue.Queue()
+        lock = Lock()
+        done = []
+        start = time.time()
+        deadline = start + timeout
+
+        def send(url, timeout):
+            try:
+                response = (self._send(url, fields, headers, timeout, operation), None)
+            except BaseException as err:
+                response = (None, err)
+            finally:
+                self.release_pool()
+            with lock:
+                if not done:
+                    responses.put(response)
+                    return
+            _discard(response[0])
+
+        pool.apply_async(send, ["%s%s" % (self.url, path), timeout])
+        pending = 1
+        hedged = False
+        try:
+            while True:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    raise Exception("Timed out after %fs" % (time.time() - start))
+                try:
+                    result, error = responses.get(
+                        True, remaining if hedged else max(0, min(remaining, start + delay - time.time())))
+                except queue.Empty:
+                    if hedged or time.time() >= deadline:
+                        continue
+                    hedged = True
+                    if not self.claim_hedge():
+                        log.debug("RemoteFinder[%s] Not hedging request %s, no budget or idle thread left" % (self.host, path))
+                        continue
+                    log.debug("RemoteFinder[%s] Hedging request %s after %fs" % (self.host, path, delay))
+                    pool.apply_async(send, ["%s%s" % (self.replica_url, path), deadline - time.time()])
+                    pending += 1
+                    continue
+
+                pending -= 1
+                if (result is not None and result.status == 200) or not pending:
+                    break
+                _discard(result)
+        finally:
+            with lock:
+                done.append(True)
+            while True:
+                try:
+                    _discard(responses.get_nowait()[0])
+                except queue.Empty:
+                    break
+
+        if result is None:
+            raise error
+        return result
+
     def deserialize(self, result):
         """
         Based on configuration, either stream-deserialize a response in settings.REMOTE_BUFFER_SIZE chunks,
@@ -306,6 +558,8 @@ class RemoteFinder(BaseFinder):
     def _deserialize_buffer(byte_buffer, content_type):
         if content_type == 'application/x-msgpack':
             data = msgpack.unpackb(byte_buffer, encoding='utf-8')
+        elif content_type == columnar.CONTENT_TYPE:
+            data = columnar.loads(byte_buffer)
         else:
             data = unpickle.loads(byte_buffer)
 
@@ -315,12 +569,64 @@ class RemoteFinder(BaseFinder):
     def _deserialize_stream(stream, content_type):
         if content_type == 'application/x-msgpack':
             data = msgpack.load(stream, encoding='utf-8')
+        elif content_type == columnar.CONTENT_TYPE:
+            data = columnar.load(stream)
         else:
             data = unpickle.load(stream)
 
         return data
 
 
+class PeerHealth(object):
+    """Latencies and outcomes of the last requests to a cluster server"""
+
+    # fetches usually take longer than the other requests (finding nodes, the
+    # index and tag autocompletion), their latencies are tracked apart
+    operations = ('find', 'fetch')
+
+    def __init__(self, size=100):
+        self.lock = Lock()
+        # response times in seconds, by operation
+        self.latencies = dict((operation, deque(maxlen=size)) for operation in self.operations)
+        # True for successful requests, False for failed ones
+        self.results = deque(maxlen=size)
+        # number of consecutive failures
+        self.failures = 0
+
+    def record(self, success):
+        with self.lock:
+            self.results.append(success)
+            self.failures = 0 if success else self.failures + 1
+
+    def record_latency(self, operation, latency):
+        with self.lock:
+            self.latencies[operation].append(latency)
+
+    def percentile(self, operation, n):
+        """Return the nth percentile of the latencies of an operation, or None
+        if there are too few of them to tell"""
+        with self.lock:
+            latencies = sorted(self.latencies[operation])
+        if len(latencies) < 20:
+            return None
+        return latencies[min(len(latencies) - 1, int(len(latencies) * n / 100.0))]
+
+    @property
+    def error_rate(self):
+        with self.lock:
+            results = list(self.results)
+        if not results:
+            return 0.0
+        return float(results.count(False)) / len(results)
+
+
+def _discard(response):
+    """Close the connection of a response that won't be read"""
+    if response is not None:
+        response.close()
+        response.release_conn()
+
+
 class MeasuredReader(object):
     def __init__(self, reader):
         self.reader = reader
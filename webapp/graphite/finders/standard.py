@@ -13,20 +13,70 @@ except ImportError:
 
 from graphite.logger import log
 from graphite.node import BranchNode, LeafNode
-from graphite.readers import WhisperReader, GzippedWhisperReader, RRDReader
+from graphite.readers import WhisperReader, GzippedWhisperReader, MmapWhisperReader, RRDReader
 from graphite.util import find_escaped_pattern_fields
+from graphite.finders.index import DirectoryIndex
 from graphite.finders.utils import BaseFinder
 from graphite.tags.utils import TaggedSeries
 
 from . import fs_to_metric, get_real_metric_path, match_entries, expand_braces
 
 
+class FileSystem(object):
+    """Access to the directories searched by StandardFinder on disk.
+
+    DirectoryIndex implements the same methods from memory.
+    """
+
+    def listdir(self, path):
+        """Return the (files, subdirectories) names of a directory"""
+        files = []
+        subdirs = []
+        try:
+            for x in scandir(path):
+                if x.is_file():
+                    files.append(x.name)
+                if x.is_dir():
+                    subdirs.append(x.name)
+        except OSError as e:
+            log.exception(e)
+        return files, subdirs
+
+    def walk(self, top, followlinks=False):
+        return walk(top, followlinks=followlinks)
+
+    def isdir(self, path):
+        return isdir(path)
+
+    def isfile(self, path):
+        return isfile(path)
+
+
 class StandardFinder(BaseFinder):
     DATASOURCE_DELIMITER = '::RRD_DATASOURCE::'
 
     def __init__(self, directories=None):
         directories = directories or settings.STANDARD_DIRS
         self.directories = directories
+        self.indexes = {}
+
+    def filesystem(self, root_dir):
+        """Return the FileSystem or the DirectoryIndex for root_dir
+
+        The index is refreshed in the background, and the FileSystem is used
+        until it has been built.
+        """
+        if not settings.STANDARD_FINDER_INDEX:
+            return FileSystem()
+
+        index = self.indexes.get(root_dir)
+        if index is None:
+            index = self.indexes.setdefault(
+                root_dir, DirectoryIndex(root_dir, settings.STANDARD_FINDER_INDEX_REFRESH_INTERVAL))
+        index.refresh()
+        if not index.ready:
+            return FileSystem()
+        return index
 
     def find_nodes(self, query):
         clean_pattern = query.pattern.replace('\\', '')
@@ -44,6 +94,8 @@ class StandardFinder(BaseFinder):
         pattern_parts = clean_pattern.split('.')
 
         for root_dir in self.directories:
+            fs = self.filesystem(root_dir)
+
             if tagged:
                 relative_paths = []
                 for pattern in encoded_paths:
@@ -53,10 +105,10 @@ class StandardFinder(BaseFinder):
                         pattern + '.rrd',
                     ]
                     for entry in entries:
-                        if isfile(join(root_dir, entry)):
+                        if fs.isfile(join(root_dir, entry)):
                             relative_paths.append(entry)
             else:
-                relative_paths = self._find_paths(root_dir, pattern_parts)
+                relative_paths = self._find_paths(root_dir, pattern_parts, fs)
 
             for relative_path in relative_paths:
                 if basename(relative_path).startswith('.'):
@@ -83,11 +135,14 @@ class StandardFinder(BaseFinder):
                     metric_path = '.'.join(metric_path_parts)
 
                 # Now we construct and yield an appropriate Node object
-                if isdir(absolute_path):
+                if fs.isdir(absolute_path):
                     yield BranchNode(metric_path)
 
                 elif absolute_path.endswith('.wsp') and WhisperReader.supported:
-                    reader = WhisperReader(absolute_path, real_metric_path)
+                    if settings.WHISPER_MMAP and MmapWhisperReader.supported:
+                        reader = MmapWhisperReader(absolute_path, real_metric_path)
+                    else:
+                        reader = WhisperReader(absolute_path, real_metric_path)
                     yield LeafNode(metric_path, reader)
 
                 elif absolute_path.endswith('.wsp.gz') and GzippedWhisperReader.supported:
@@ -104,32 +159,35 @@ class StandardFinder(BaseFinder):
                                 reader = RRDReader(absolute_path, datasource_name)
                                 yield LeafNode(metric_path + "." + datasource_name, reader)
 
-    def _find_paths(self, current_dir, patterns):
+    @staticmethod
+    def _has_wildcard(pattern):
+        return pattern.find('[') > -1 or pattern.find('*') > -1 or pattern.find('?') > -1
+
+    def _find_paths(self, current_dir, patterns, fs):
         """Recursively generates absolute paths whose components underneath current_dir
         match the corresponding pattern in patterns"""
         raw_pattern = patterns[0]
         patterns = patterns[1:]
 
-        for pattern in expand_braces(raw_pattern):
-            has_wildcard = pattern.find('[') > -1 or pattern.find('*') > -1 or pattern.find('?') > -1
+        variants = expand_braces(raw_pattern)
+        # match all the variants at once with a single pass over the directory
+        # listing if any of them has a wildcard, rather than once per variant
+        if len(variants) > 1 and "**" not in variants \
+                and any(self._has_wildcard(variant) for variant in variants):
+            variants = [raw_pattern]
+
+        for pattern in variants:
+            has_wildcard = self._has_wildcard(pattern)
 
             matching_subdirs = []
             files = []
             if has_wildcard:  # this avoids os.listdir() for performance
-                subdirs = []
-                try:
-                    for x in scandir(current_dir):
-                        if x.is_file():
-                            files.append(x.name)
-                        if x.is_dir():
-                            subdirs.append(x.name)
-                except OSError as e:
-                    log.exception(e)
+                files, subdirs = fs.listdir(current_dir)
 
                 if pattern == "**":
                     matching_subdirs = map(
                       lambda item: item[0][len(current_dir) + 1:],
-                      walk(current_dir)
+                      fs.walk(current_dir)
                     )
 
                     # if this is a terminal globstar, add a pattern for all files in subdirs
@@ -137,7 +195,7 @@ class StandardFinder(BaseFinder):
                         patterns = ["*"]
                 else:
                     matching_subdirs = match_entries(subdirs, pattern)
-            elif isdir(join(current_dir, pattern)):
+            elif fs.isdir(join(current_dir, pattern)):
                 matching_subdirs.append(pattern)
 
             # the last pattern may apply to RRD data sources
@@ -146,7 +204,7 @@ class StandardFinder(BaseFinder):
                     entries = [
                       pattern + ".rrd",
                     ]
-                    rrd_files = [entry for entry in entries if isfile(join(current_dir, entry))]
+                    rrd_files = [entry for entry in entries if fs.isfile(join(current_dir, entry))]
                 else:
                     rrd_files = match_entries(files, pattern + ".rrd")
 
@@ -159,7 +217,7 @@ class StandardFinder(BaseFinder):
             if patterns:  # we've still got more directories to traverse
                 for subdir in matching_subdirs:
                     absolute_path = join(current_dir, subdir)
-                    for match in self._find_paths(absolute_path, patterns):
+                    for match in self._find_paths(absolute_path, patterns, fs):
                         yield join(subdir, match)
 
             else:  # we've got the last pattern
@@ -169,7 +227,7 @@ class StandardFinder(BaseFinder):
                         pattern + '.wsp.gz',
                         pattern + '.rrd',
                     ]
-                    matching_files = [entry for entry in entries if isfile(join(current_dir, entry))]
+                    matching_files = [entry for entry in entries if fs.isfile(join(current_dir, entry))]
                 else:
                     matching_files = match_entries(files, pattern + '.*')
 
@@ -179,7 +237,7 @@ class StandardFinder(BaseFinder):
     def get_index(self, requestContext):
         matches = []
 
-        for root, _, files in walk(settings.WHISPER_DIR):
+        for root, _, files in self.filesystem(settings.WHISPER_DIR).walk(settings.WHISPER_DIR):
             root = root.replace(settings.WHISPER_DIR, '')
             for base_name in files:
                 if fnmatch.fnmatch(base_name, '*.wsp'):
@@ -189,7 +247,8 @@ class StandardFinder(BaseFinder):
         # unlike 0.9.x, we're going to use os.walk with followlinks
         # since we require Python 2.7 and newer that supports it
         if RRDReader.supported:
-            for root, _, files in walk(settings.RRD_DIR, followlinks=True):
+            fs = self.filesystem(settings.RRD_DIR)
+            for root, _, files in fs.walk(settings.RRD_DIR, followlinks=True):
                 root = root.replace(settings.RRD_DIR, '')
                 for base_name in files:
                     if fnmatch.fnmatch(base_name, '*.rrd'):
@@ -2,7 +2,11 @@
 import time
 import abc
 
+from django.conf import settings
+
 from graphite.node import BranchNode, LeafNode  # noqa
+from graphite.readers.utils import query_carbonlink
+from graphite.worker_pool.pool import get_pool, pool_exec, Job, PoolTimeoutError
 from graphite.util import is_pattern
 from graphite.intervals import Interval
 
@@ -129,29 +133,51 @@ class BaseFinder(object):
             for pattern in patterns
         ]
 
-        results = []
-
-        for node, query in self.find_multi(queries):
-            if not isinstance(node, LeafNode):
-                continue
-
-            result = node.fetch(
-                start_time, end_time,
-                now=now, requestContext=requestContext
-            )
+        leaves = [
+            (node, query) for node, query in self.find_multi(queries)
+            if isinstance(node, LeafNode)
+        ]
 
-            if result is None:
-                continue
+        # Query carbon's cache for all the metrics at once rather than
+        # once per metric from each reader.
+        cached_datapoints = {}
+        if settings.CARBONLINK_QUERY_BULK:
+            metrics = [
+                node.reader.real_metric_path for node, _ in leaves
+                if getattr(node.reader, 'carbonlink', False)
+            ]
+            if metrics:
+                cached_datapoints = query_carbonlink(metrics)
+
+        pool = None
+        # legacy finders (see storage.get_finders) may not define local
+        if settings.USE_WORKER_POOL and getattr(self, 'local', True) and len(leaves) > 1:
+            pool = get_pool('fetch', settings.FETCH_POOL_MAX_WORKERS)
+        if pool is None:
+            return _fetch_nodes(
+                leaves, start_time, end_time, now, requestContext, cached_datapoints)
+
+        # Split the nodes in at most FETCH_POOL_MAX_WORKERS_PER_REQUEST
+        # chunks read in parallel, so that a single request can't occupy
+        # the whole pool.
+        chunk_count = min(len(leaves), max(1, settings.FETCH_POOL_MAX_WORKERS_PER_REQUEST))
+        chunk_size = -(-len(leaves) // chunk_count)
+        deadline = time.time() + settings.FETCH_TIMEOUT
+        jobs = [
+            Job(_fetch_nodes, 'fetch of %d nodes' % len(leaves[i:i + chunk_size]),
+                leaves[i:i + chunk_size], start_time, end_time, now, requestContext,
+                cached_datapoints, deadline=deadline)
+            for i in range(0, len(leaves), chunk_size)
+        ]
 
-            time_info, values = result
+        for job in pool_exec(pool, jobs, settings.FETCH_TIMEOUT):
+            if job.exception:
+                raise job.exception
 
-            results.append({
-                'pathExpression': query.pattern,
-                'path': node.path,
-                'name': node.path,
-                'time_info': time_info,
-                'values': values,
-            })
+        # keep the results in the order of the nodes
+        results = []
+        for job in jobs:
+            results.extend(job.result)
 
         return results
 
@@ -160,3 +186,45 @@ class BaseFinder(object):
 
     def auto_complete_values(self, exprs, tag, valuePrefix=None, limit=None, requestContext=None):
         return []
+
+
+def _fetch_nodes(leaves, start_time, end_time, now, requestContext,
+                 cached_datapoints, deadline=None):
+    """Fetch a list of (node, query).
+
+    Raises PoolTimeoutError once deadline is passed, rather than returning
+    the results of part of the nodes.
+    """
+    results = []
+
+    for node, query in leaves:
+        if deadline is not None and time.time() > deadline:
+            raise PoolTimeoutError('Timed out fetching %d of %d nodes' % (len(leaves) - len(results), len(leaves)))
+
+        metric = getattr(node.reader, 'real_metric_path', None)
+        if getattr(node.reader, 'carbonlink', False) and metric in cached_datapoints:
+            result = node.reader.fetch(
+                start_time, end_time,
+                now=now, requestContext=requestContext,
+                cached_datapoints=cached_datapoints[metric],
+            )
+        else:
+            result = node.fetch(
+                start_time, end_time,
+                now=now, requestContext=requestContext
+            )
+
+        if result is None:
+            continue
+
+        time_info, values = result
+
+        results.append({
+            'pathExpression': query.pattern,
+            'path': node.path,
+            'name': node.path,
+            'time_info': time_info,
+            'values': values,
+        })
+
+    return results
@@ -18,14 +18,17 @@ aggFuncs = {
 }
 
 
-aggFuncAliases = {
-  'rangeOf': aggFuncs['range'],
-  'avg': aggFuncs['average'],
-  'total': aggFuncs['sum'],
-  'current': aggFuncs['last'],
+aggFuncAliasNames = {
+  'rangeOf': 'range',
+  'avg': 'average',
+  'total': 'sum',
+  'current': 'last',
 }
 
 
+aggFuncAliases = {alias: aggFuncs[name] for alias, name in aggFuncAliasNames.items()}
+
+
 def getAggFunc(func, rawFunc=None):
     if func in aggFuncs:
         return aggFuncs[func]
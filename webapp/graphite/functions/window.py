@@ -0,0 +1,164 @@
+# make / work consistently between python 2.x and 3.x
+# https://www.python.org/dev/peps/pep-0238/
+from __future__ import division
+
+import math
+
+from bisect import bisect_left, insort
+from collections import deque
+
+from graphite.functions.aggfuncs import aggFuncAliasNames, getAggFunc
+
+
+class SlidingWindow(object):
+    """
+    Incrementally maintained aggregate over the last ``size`` points of a series.
+
+    Points are pushed one at a time, and each push evicts the point that falls
+    out of the window.  Every supported statistic is updated in amortized O(1)
+    (O(log n) search for median), so sliding over a whole series costs O(n)
+    instead of O(n * size):
+
+    - sum, average, avg_zero, diff: compensated running sum of the non-null
+      values, recomputed exactly every ``size`` evictions so that rounding
+      errors don't accumulate
+    - min, max, range: monotonic deques
+    - median: sorted list of the non-null values
+    - count, last: deque of the non-null values
+
+    Functions without an incremental form fall back to applying their
+    ``graphite.functions.aggfuncs`` implementation to the window's non-null
+    values.
+    """
+
+    def __init__(self, size, func):
+        self.size = size
+        self.func = aggFuncAliasNames.get(func, func)
+        self.aggFunc = getAggFunc(self.func)
+        self.index = 0
+        self.nonNull = deque()
+        self.total = 0
+        # rounding errors of total, and evictions since it was recomputed
+        self.compensation = 0
+        self.evictions = 0
+        self.mins = deque()
+        self.maxs = deque()
+        self.sortedValues = []
+
+        self.trackSum = self.func in ('sum', 'average', 'avg_zero', 'diff')
+        self.trackMin = self.func in ('min', 'range')
+        self.trackMax = self.func in ('max', 'range')
+        self.trackMedian = self.func == 'median'
+
+    def push(self, value):
+        """Add the next point, evicting the oldest one once the window is full"""
+        index = self.index
+        self.index += 1
+
+        if self.nonNull and self.nonNull[0][0] <= index - self.size:
+            self._evict(self.nonNull.popleft()[1])
+        if self.mins and self.mins[0][0] <= index - self.size:
+            self.mins.popleft()
+        if self.maxs and self.maxs[0][0] <= index - self.size:
+            self.maxs.popleft()
+
+        if value is None:
+            return
+
+        self.nonNull.append((index, value))
+        if self.trackSum:
+            self._add(value)
+        if self.trackMin:
+            while self.mins and self.mins[-1][1] >= value:
+                self.mins.pop()
+            self.mins.append((index, value))
+        if self.trackMax:
+            while self.maxs and self.maxs[-1][1] <= value:
+                self.maxs.pop()
+            self.maxs.append((index, value))
+        if self.trackMedian:
+            insort(self.sortedValues, value)
+
+    def _add(self, value):
+        # Neumaier summation
+        total = self.total + value
+        if abs(self.total) >= abs(value):
+            self.compensation += (self.total - total) + value
+        else:
+            self.compensation += (value - total) + self.total
+        self.total = total
+
+    def _evict(self, value):
+        if self.trackSum:
+            self.evictions += 1
+            if not self.nonNull or self.evictions >= self.size:
+                # recompute to avoid accumulating rounding errors
+                self.total = math.fsum(v for _, v in self.nonNull) if self.nonNull else 0
+                self.compensation = 0
+                self.evictions = 0
+            else:
+                self._add(-value)
+        if self.trackMedian:
+            del self.sortedValues[bisect_left(self.sortedValues, value)]
+
+    def count(self):
+        return len(self.nonNull)
+
+    def value(self):
+        """Aggregate of the non-null values currently in the window, or None"""
+        count = len(self.nonNull)
+        if not count:
+            return None
+
+        func = self.func
+        if func == 'sum':
+            return self.total + self.compensation
+        if func in ('average', 'avg_zero'):
+            return (self.total + self.compensation) / count
+        if func == 'min':
+            return self.mins[0][1]
+        if func == 'max':
+            return self.maxs[0][1]
+        if func == 'range':
+            return float(self.maxs[0][1]) - float(self.mins[0][1])
+        if func == 'count':
+            return count
+        if func == 'last':
+            return self.nonNull[-1][1]
+        if func == 'diff':
+            first = self.nonNull[0][1]
+            return first - (self.total + self.compensation - first)
+        if func == 'median':
+            mid = count // 2
+            if count % 2 == 0:
+                return float(self.sortedValues[mid-1] + self.sortedValues[mid]) / 2
+            return self.sortedValues[mid]
+
+        return self.aggFunc([v for _, v in self.nonNull])
+
+
+def slidingWindow(values, size, func, xFilesFactor):
+    """
+    Yield ``func`` applied to every window of ``size`` consecutive values.
+
+    Yields one result per full window, starting with ``values[0:size]``.  A
+    result is None unless at least ``xFilesFactor`` of the ``size`` points in
+    its window are non-null.
+    """
+    window = SlidingWindow(size, func)
+
+    if size < 1:
+        for _ in range(len(values) + 1):
+            yield None
+        return
+
+    for i, value in enumerate(values):
+        window.push(value)
+        if i + 1 < size:
+            continue
+
+        count = window.count()
+        if count and count / size >= xFilesFactor:
+            yield window.value()
+        else:
+            yield None
@@ -1,4 +1,10 @@
 """Shared urllib3 pool."""
 import urllib3
 
-http = urllib3.PoolManager(num_pools=10, maxsize=5)
+from django.conf import settings
+
+# Keep a pool of connections to each cluster server (and its replica) rather
+# than evicting them from the PoolManager when querying many servers.
+http = urllib3.PoolManager(
+    num_pools=max(10, 2 * len(settings.CLUSTER_SERVERS)),
+    maxsize=settings.REMOTE_POOL_MAXSIZE)
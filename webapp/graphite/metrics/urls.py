@@ -23,5 +23,6 @@ urlpatterns = [
             name='metrics_get_metadata'),
     re_path(r'^/set-metadata/?$', views.set_metadata_view,
             name='metrics_set_metadata'),
+    re_path(r'^/peers/?$', views.peers_view, name='metrics_peers'),
     re_path(r'^/?$', views.find_view, name='metrics'),
 ]
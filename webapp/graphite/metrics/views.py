@@ -309,6 +309,41 @@ def set_metadata_view(request):
   return json_response_for(request, results)
 
 
+def peers_view(request):
+  "View for the health of the cluster servers"
+  queryParams = request.GET.copy()
+  queryParams.update(request.POST)
+
+  jsonp = queryParams.get('jsonp', False)
+
+  peers = []
+  for finder in STORE.finders:
+    health = getattr(finder, 'health', None)
+    if health is None:
+      continue
+
+    peers.append({
+      'host': finder.host,
+      'state': finder.state,
+      'failures': finder.failures,
+      'requests': len(health.results),
+      'errorRate': health.error_rate,
+      'latency': dict(
+        (operation, dict(('p%d' % n, health.percentile(operation, n)) for n in (50, 90, 99)))
+        for operation in health.operations
+      ),
+      'timeout': {
+        'find': finder.adaptive_timeout(settings.FIND_TIMEOUT, 'find'),
+        'fetch': finder.adaptive_timeout(settings.FETCH_TIMEOUT, 'fetch'),
+      },
+    })
+
+  response = json_response_for(request, peers, jsonp=jsonp)
+  response['Pragma'] = 'no-cache'
+  response['Cache-Control'] = 'no-cache'
+  return response
+
+
 def tree_json(nodes, base_path, wildcards=False):
   results = []
 
@@ -1,7 +1,7 @@
 from __future__ import absolute_import
 
 from graphite.intervals import Interval, IntervalSet
-from graphite.readers.utils import merge_with_carbonlink, BaseReader
+from graphite.readers.utils import consolidate, merge_with_carbonlink, BaseReader
 
 try:
     import ceres
@@ -12,6 +12,7 @@ except ImportError:
 class CeresReader(BaseReader):
     __slots__ = ('ceres_node', 'real_metric_path')
     supported = bool(ceres)
+    carbonlink = True
 
     def __init__(self, ceres_node, real_metric_path):
         self.ceres_node = ceres_node
@@ -25,12 +26,22 @@ class CeresReader(BaseReader):
 
         return IntervalSet(intervals)
 
-    def fetch(self, startTime, endTime):
+    def fetch(self, startTime, endTime, now=None, requestContext=None, cached_datapoints=None):
         data = self.ceres_node.read(startTime, endTime)
         time_info = (data.startTime, data.endTime, data.timeStep)
         values = list(data.values)
 
         values = merge_with_carbonlink(
-            self.real_metric_path, data.startTime, data.timeStep, values)
+            self.real_metric_path, data.startTime, data.timeStep, values,
+            cached_datapoints=cached_datapoints)
+
+        # ceres has no lower resolution archives to read from, consolidate
+        # the points here rather than sending them all to the client
+        max_step = requestContext.get('fetchMaxStep') if requestContext else None
+        if max_step and max_step >= 2 * data.timeStep:
+            aggregation_method = self.ceres_node.readMetadata().get('aggregationMethod', 'average')
+            time_info, values = consolidate(
+                data.startTime, data.timeStep, values,
+                max_step - max_step % data.timeStep, aggregation_method)
 
         return time_info, values
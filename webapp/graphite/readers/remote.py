@@ -51,6 +51,10 @@ class RemoteReader(BaseReader):
         if now is not None:
             query_params.append(('now', int(now)))
 
+        # let the peer read coarser data too, see RENDER_PUSHDOWN_MAX_DATA_POINTS
+        if requestContext and requestContext.get('fetchMaxStep'):
+            query_params.append(('maxStep', int(requestContext['fetchMaxStep'])))
+
         headers = requestContext.get('forwardHeaders') if requestContext else None
 
         retries = 1  # start counting at one to make log output and settings more readable
@@ -61,6 +65,7 @@ class RemoteReader(BaseReader):
                     fields=query_params,
                     headers=headers,
                     timeout=settings.FETCH_TIMEOUT,
+                    operation='fetch',
                 )
                 break
             except Exception:
@@ -9,6 +9,9 @@ class BaseReader(object):
     __metaclass__ = abc.ABCMeta
 
     supported = True
+    # Set to True if fetch() merges points from carbon's cache for
+    # real_metric_path and accepts them pre-fetched as cached_datapoints.
+    carbonlink = False
 
     @abc.abstractmethod
     def get_intervals(self):
@@ -33,29 +36,50 @@ class BaseReader(object):
         """
 
 
+# Similar to the function in render/datalib:TimeSeries
+def _consolidate(func, values):
+    usable = [v for v in values if v is not None]
+    if not usable:
+        return None
+    if func == 'avg_zero':
+        return sum([0 if v is None else v for v in values]) / len(values)
+    if func == 'sum':
+        return sum(usable)
+    if func == 'average':
+        return sum(usable) / len(usable)
+    if func == 'max':
+        return max(usable)
+    if func == 'min':
+        return min(usable)
+    if func == 'last':
+        return usable[-1]
+    raise Exception("Invalid consolidation function: '%s'" % func)
+
+
+def consolidate(start, step, values, new_step, func):
+    """Consolidate values into buckets of new_step seconds, a multiple of step.
+
+    The buckets are aligned on new_step like the points of a whisper archive.
+
+    Returns:
+      (time_info, values)
+    """
+    new_start = start - (start % new_step)
+    buckets = []
+    for i, value in enumerate(values):
+        bucket = (start + i * step - new_start) // new_step
+        if bucket == len(buckets):
+            buckets.append([])
+        buckets[-1].append(value)
+
+    consolidated = [_consolidate(func, bucket) for bucket in buckets]
+    return (new_start, new_start + len(consolidated) * new_step, new_step), consolidated
+
+
 def merge_with_cache(cached_datapoints, start, step, values, func=None, raw_step=None):
     """Merge values with datapoints from a buffer/cache."""
     consolidated = []
 
-    # Similar to the function in render/datalib:TimeSeries
-    def consolidate(func, values):
-        usable = [v for v in values if v is not None]
-        if not usable:
-            return None
-        if func == 'avg_zero':
-            return sum([0 if v is None else v for v in values]) / len(values)
-        if func == 'sum':
-            return sum(usable)
-        if func == 'average':
-            return sum(usable) / len(usable)
-        if func == 'max':
-            return max(usable)
-        if func == 'min':
-            return min(usable)
-        if func == 'last':
-            return usable[-1]
-        raise Exception("Invalid consolidation function: '%s'" % func)
-
     # if we have a raw_step, start by taking only the last data point for each interval to match what whisper will do
     if raw_step is not None and raw_step > 1:
         consolidated_dict = {}
@@ -73,7 +97,7 @@ def merge_with_cache(cached_datapoints, start, step, values, func=None, raw_step
                 consolidated_dict[interval].append(value)
             else:
                 consolidated_dict[interval] = [value]
-        consolidated = [(i, consolidate(func, consolidated_dict[i])) for i in consolidated_dict]
+        consolidated = [(i, _consolidate(func, consolidated_dict[i])) for i in consolidated_dict]
     # otherwise just use the points
     else:
         consolidated = cached_datapoints
@@ -103,14 +127,32 @@ def CarbonLink():
     return CarbonLink()
 
 
-def merge_with_carbonlink(metric, start, step, values, aggregation_method=None, raw_step=None):
-    """Get points from carbonlink and merge them with existing values."""
-    cached_datapoints = []
+def query_carbonlink(metrics):
+    """Get points from carbonlink for several metrics at once.
+
+    Returns:
+      dict of metric -> datapoints, empty if the query failed.
+    """
     try:
-        cached_datapoints = CarbonLink().query(metric)
+        return CarbonLink().query_bulk(metrics)
     except BaseException:
-        log.exception("Failed CarbonLink query '%s'" % metric)
-        cached_datapoints = []
+        log.exception("Failed bulk CarbonLink query for %d metrics" % len(metrics))
+        return {}
+
+
+def merge_with_carbonlink(metric, start, step, values, aggregation_method=None, raw_step=None,
+                          cached_datapoints=None):
+    """Get points from carbonlink and merge them with existing values.
+
+    cached_datapoints can be given if they were already fetched with
+    query_carbonlink().
+    """
+    if cached_datapoints is None:
+        try:
+            cached_datapoints = CarbonLink().query(metric)
+        except BaseException:
+            log.exception("Failed CarbonLink query '%s'" % metric)
+            cached_datapoints = []
 
     if isinstance(cached_datapoints, dict):
         cached_datapoints = list(cached_datapoints.items())
@@ -1,6 +1,12 @@
 from __future__ import absolute_import
+import os
+import struct
 import time
 
+from collections import OrderedDict
+from itertools import chain
+from threading import Lock
+
 # Use the built-in version of scandir/stat if possible, otherwise
 # use the scandir module version
 try:
@@ -18,7 +24,15 @@ try:
 except ImportError:
     gzip = False
 
+try:
+    import mmap
+except ImportError:
+    mmap = False
+
+from django.conf import settings
 
+from graphite import arrays
+from graphite.arrays import np
 from graphite.intervals import Interval, IntervalSet
 from graphite.logger import log
 from graphite.readers.utils import merge_with_carbonlink, BaseReader
@@ -32,6 +46,7 @@ if bool(whisper):
 class WhisperReader(BaseReader):
     __slots__ = ('fs_path', 'real_metric_path')
     supported = bool(whisper)
+    carbonlink = True
     meta_info = None
 
     def __init__(self, fs_path, real_metric_path):
@@ -51,12 +66,36 @@ class WhisperReader(BaseReader):
         end = max(stat(self.fs_path).st_mtime, start)
         return IntervalSet([Interval(start, end)])
 
-    def fetch_data(self, startTime, endTime, now=None):
-        return whisper.fetch(self.fs_path, startTime, endTime, now=now)
+    def select_archive(self, startTime, now, max_step):
+        """Select the coarsest archive covering startTime with a step of at most max_step.
 
-    def fetch(self, startTime, endTime, now=None, requestContext=None):
+        Returns the secondsPerPoint of the archive, or None if whisper would
+        pick the same archive by itself.
+        """
+        if now is None:
+            now = int(time.time())
+
+        meta_info = self.info()
+        # whisper only reads the range within maxRetention
+        diff = now - max(startTime, now - meta_info['maxRetention'])
+
+        covering = [archive for archive in meta_info['archives'] if archive['retention'] >= diff]
+        selected = [archive for archive in covering if archive['secondsPerPoint'] <= max_step]
+        if not selected or selected[-1] is covering[0]:
+            return None
+        return selected[-1]['secondsPerPoint']
+
+    def fetch_data(self, startTime, endTime, now=None, archiveToSelect=None):
+        return whisper.fetch(self.fs_path, startTime, endTime, now=now, archiveToSelect=archiveToSelect)
+
+    def fetch(self, startTime, endTime, now=None, requestContext=None, cached_datapoints=None):
+        max_step = requestContext.get('fetchMaxStep') if requestContext else None
         try:
-            data = self.fetch_data(startTime, endTime, now=now)
+            archiveToSelect = self.select_archive(startTime, now, max_step) if max_step else None
+            if archiveToSelect:
+                data = self.fetch_data(startTime, endTime, now=now, archiveToSelect=archiveToSelect)
+            else:
+                data = self.fetch_data(startTime, endTime, now=now)
         except IOError:
             log.exception("Failed fetch of whisper file '%s'" % self.fs_path)
             return None
@@ -71,7 +110,8 @@ class WhisperReader(BaseReader):
 
         # Merge in data from carbon's cache
         values = merge_with_carbonlink(
-            self.real_metric_path, start, step, values, aggregation_method, self.get_raw_step())
+            self.real_metric_path, start, step, values, aggregation_method, self.get_raw_step(),
+            cached_datapoints=cached_datapoints)
 
         return time_info, values
 
@@ -88,9 +128,230 @@ class GzippedWhisperReader(WhisperReader):
                 fh.close()
         return self.meta_info
 
-    def fetch_data(self, startTime, endTime, now=None):
+    def fetch_data(self, startTime, endTime, now=None, archiveToSelect=None):
         fh = gzip.GzipFile(self.fs_path, 'rb')
         try:
-            return whisper.file_fetch(fh, startTime, endTime, now=now)
+            return whisper.file_fetch(fh, startTime, endTime, now=now, archiveToSelect=archiveToSelect)
         finally:
             fh.close()
+
+
+class HeaderCache(object):
+    """LRU cache of parsed whisper headers, shared by the readers of a process.
+
+    Headers are keyed by (path, inode, mtime) so that a file replaced (e.g. by
+    whisper-resize) or modified in place (e.g. by whisper-set-aggregation-method)
+    is parsed again.
+    """
+
+    def __init__(self):
+        self.lock = Lock()
+        self.headers = OrderedDict()
+
+    def get(self, key):
+        with self.lock:
+            header = self.headers.get(key)
+            if header is not None:
+                self.headers.move_to_end(key)
+            return header
+
+    def set(self, key, header):
+        with self.lock:
+            self.headers[key] = header
+            self.headers.move_to_end(key)
+            while len(self.headers) > settings.WHISPER_HEADER_CACHE_SIZE:
+                self.headers.popitem(last=False)
+
+
+HEADER_CACHE = HeaderCache()
+
+
+class MmapWhisperReader(WhisperReader):
+    """WhisperReader reading whisper files through mmap.
+
+    A fetch opens and maps the file once, looks its header up in HEADER_CACHE
+    (parsing it only on a miss) and decodes the points of the archive straight
+    from the mapping, instead of opening the file for whisper.info() and again
+    for whisper.fetch().
+    """
+    __slots__ = ()
+    supported = bool(whisper and mmap)
+
+    def info(self):
+        if not self.meta_info:
+            st = stat(self.fs_path)
+            self.meta_info = HEADER_CACHE.get((self.fs_path, st.st_ino, st.st_mtime_ns))
+        if not self.meta_info:
+            self._map()
+        return self.meta_info
+
+    def _map(self):
+        """Map the file, return the mapping and set its header as meta_info"""
+        with open(self.fs_path, 'rb') as fh:
+            st = os.fstat(fh.fileno())
+            try:
+                mapping = mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ)
+            except ValueError:
+                raise whisper.CorruptWhisperFile("Unable to read header", self.fs_path)
+
+        key = (self.fs_path, st.st_ino, st.st_mtime_ns)
+        header = HEADER_CACHE.get(key)
+        if header is None:
+            try:
+                header = _read_header(mapping, self.fs_path)
+            except Exception:
+                mapping.close()
+                raise
+            HEADER_CACHE.set(key, header)
+        self.meta_info = header
+        return mapping
+
+    def fetch_data(self, startTime, endTime, now=None, archiveToSelect=None):
+        mapping = self._map()
+        try:
+            return _fetch(mapping, self.meta_info, self.fs_path, startTime, endTime, now, archiveToSelect)
+        finally:
+            mapping.close()
+
+
+def _read_header(buf, fs_path):
+    """Parse the header of a whisper file like whisper.__readHeader"""
+    try:
+        (aggregationType, maxRetention, xff, archiveCount) = struct.unpack_from(whisper.metadataFormat, buf)
+    except struct.error:
+        raise whisper.CorruptWhisperFile("Unable to read header", fs_path)
+
+    if aggregationType not in whisper.aggregationTypeToMethod or not 0 <= xff <= 1:
+        raise whisper.CorruptWhisperFile("Unable to read header", fs_path)
+
+    archives = []
+    for i in range(archiveCount):
+        try:
+            (offset, secondsPerPoint, points) = struct.unpack_from(
+                whisper.archiveInfoFormat, buf, whisper.metadataSize + i * whisper.archiveInfoSize)
+        except struct.error:
+            raise whisper.CorruptWhisperFile("Unable to read archive%d metadata" % i, fs_path)
+
+        archives.append({
+            'offset': offset,
+            'secondsPerPoint': secondsPerPoint,
+            'points': points,
+            'retention': secondsPerPoint * points,
+            'size': points * whisper.pointSize,
+        })
+
+    return {
+        'aggregationMethod': whisper.aggregationTypeToMethod[aggregationType],
+        'maxRetention': maxRetention,
+        'xFilesFactor': xff,
+        'archives': archives,
+    }
+
+
+def _fetch(buf, header, fs_path, fromTime, untilTime, now=None, archiveToSelect=None):
+    """Fetch points from a mapped whisper file like whisper.file_fetch"""
+    if now is None:
+        now = int(time.time())
+    if untilTime is None:
+        untilTime = now
+    fromTime = int(fromTime)
+    untilTime = int(untilTime)
+
+    if fromTime > untilTime:
+        raise whisper.InvalidTimeInterval(
+            "Invalid time interval: from time '%s' is after until time '%s'" % (fromTime, untilTime))
+
+    oldestTime = now - header['maxRetention']
+    # the range is in the future or beyond the retention
+    if fromTime > now or untilTime < oldestTime:
+        return None
+    fromTime = max(fromTime, oldestTime)
+    untilTime = min(untilTime, now)
+
+    diff = now - fromTime
+    for archive in header['archives']:
+        if archiveToSelect:
+            if archive['secondsPerPoint'] == archiveToSelect:
+                break
+        elif archive['retention'] >= diff:
+            break
+    else:
+        if archiveToSelect:
+            raise ValueError("Invalid granularity: %s" % archiveToSelect)
+
+    return _archive_fetch(buf, archive, fs_path, fromTime, untilTime)
+
+
+if np:
+    # the layout of whisper.pointFormat
+    POINT_DTYPE = np.dtype([('time', '>u4'), ('value', '>f8')])
+
+
+def _archive_fetch(buf, archive, fs_path, fromTime, untilTime):
+    """Read the points of an archive from a memoryview of the mapping"""
+    step = archive['secondsPerPoint']
+    fromInterval = int(fromTime - (fromTime % step)) + step
+    untilInterval = int(untilTime - (untilTime % step)) + step
+    if fromInterval == untilInterval:
+        # Zero-length time range: always include the next point
+        untilInterval += step
+
+    offset = archive['offset']
+    try:
+        (baseInterval, _) = struct.unpack_from(whisper.pointFormat, buf, offset)
+    except struct.error:
+        raise whisper.CorruptWhisperFile("Unable to read base datapoint", fs_path)
+
+    timeInfo = (fromInterval, untilInterval, step)
+    if baseInterval == 0:
+        return timeInfo, [None] * ((untilInterval - fromInterval) // step)
+
+    size = archive['size']
+    if offset + size > len(buf):
+        raise whisper.CorruptWhisperFile("Unable to read datapoints", fs_path)
+    fromOffset = offset + ((fromInterval - baseInterval) // step * whisper.pointSize) % size
+    untilOffset = offset + ((untilInterval - baseInterval) // step * whisper.pointSize) % size
+
+    # nothing may raise while the slices of the mapping exist, they would
+    # outlive this function in the traceback and keep the mapping open
+    with memoryview(buf) as view:
+        if fromOffset < untilOffset:
+            chunks = [view[fromOffset:untilOffset]]
+        else:
+            # wrap around the end of the archive
+            chunks = [view[fromOffset:offset + size], view[offset:untilOffset]]
+
+        if arrays.enabled():
+            values = _decode_points(chunks, fromInterval, step)
+        else:
+            values = [None] * (sum(len(chunk) for chunk in chunks) // whisper.pointSize)
+            currentInterval = fromInterval
+            points = chain.from_iterable(struct.iter_unpack(whisper.pointFormat, chunk) for chunk in chunks)
+            for i, (pointTime, pointValue) in enumerate(points):
+                if pointTime == currentInterval:
+                    values[i] = pointValue
+                currentInterval += step
+        for chunk in chunks:
+            chunk.release()
+
+    return timeInfo, values
+
+
+def _decode_points(chunks, fromInterval, step):
+    """Decode the points of an archive with NumPy.
+
+    A point is valid if its timestamp is the one expected at its position
+    (older points are left over from a previous pass of the ring buffer).
+    """
+    points = [np.frombuffer(chunk, dtype=POINT_DTYPE) for chunk in chunks]
+    # copies the points, no reference to the mapping is left
+    if len(points) == 1:
+        times = points[0]['time'].astype(np.int64)
+        values = points[0]['value'].astype(np.float64)
+    else:
+        times = np.concatenate([p['time'] for p in points]).astype(np.int64)
+        values = np.concatenate([p['value'] for p in points]).astype(np.float64)
+    del points
+
+    valid = times == fromInterval + step * np.arange(len(times), dtype=np.int64)
+    return arrays.fromArray(values, valid)
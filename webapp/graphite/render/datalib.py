@@ -20,10 +20,15 @@ import types
 from six import text_type
 
 from django.conf import settings
+from django.core.cache import cache
 
+from graphite import arrays
+from graphite.arrays import np
 from graphite.logger import log
+from graphite.render.hashing import compactHash
 from graphite.storage import STORE
 from graphite.util import timebounds, logtime
+from graphite.worker_pool.pool import get_pool
 
 if not hasattr(settings, 'DEFAULT_CONSOLIDATION'):
   settings.DEFAULT_CONSOLIDATION = 'average'
@@ -40,7 +45,20 @@ class Tags(UserDict):
 
 
 class TimeSeries(list):
+  # Set by consolidate() to draw the series with a visual downsampling of
+  # its consolidated buckets instead of the consolidation function
+  downsample = None
+
   def __init__(self, name, start, end, step, values, consolidate=settings.DEFAULT_CONSOLIDATION, tags=None, xFilesFactor=None, pathExpression=None):
+    if arrays.isArray(values):
+      # NaN values of arrays are gaps
+      if arrays.enabled() and type(self) is TimeSeries:
+        # copied, like the values of a list, so that series fetched from
+        # the same array don't share it
+        self._setArray(np.array(values, dtype=np.float64))
+        values = ()
+      else:
+        values = arrays.fromArray(values)
     list.__init__(self, values)
     self.name = name
     self.start = start
@@ -79,12 +97,50 @@ class TimeSeries(list):
 
   def __iter__(self):
     if self.valuesPerPoint > 1:
+      if self.downsample == 'm4':
+        return self.__m4Generator( list.__iter__(self) )
       return self.__consolidatingGenerator( list.__iter__(self) )
     else:
       return list.__iter__(self)
 
-  def consolidate(self, valuesPerPoint):
+  def asarray(self):
+    """Return the raw (unconsolidated) values as a float64 array with NaN for None.
+
+    Returns None if the values aren't all numbers or some are NaN, see
+    arrays.toGapArray().
+    """
+    # slice to a plain list, iterating the series would consolidate it
+    return arrays.toGapArray(self[:])
+
+  def _setArray(self, values):
+    # keep the values as a float64 array until they're used as a list
+    self.__class__ = ArrayTimeSeries
+    self._array = values
+    list.clear(self)
+
+  def consolidate(self, valuesPerPoint, downsample=None):
+    """Consolidate every valuesPerPoint values when iterating the series.
+
+    With downsample='m4' each bucket yields pointsPerValue values instead
+    of one: its first, minimum, maximum and last values in time order, so
+    that a line drawn through them keeps the exact extremes of the series.
+
+    With NumPy, the values are converted to an array here if they can be
+    consolidated with vectorized operations, see ArrayTimeSeries.
+    """
     self.valuesPerPoint = int(valuesPerPoint)
+    self.downsample = downsample
+    if arrays.enabled() and type(self) is TimeSeries and self._arrayConsolidation():
+      values = self.asarray()
+      if values is not None:
+        self._setArray(values)
+
+  @property
+  def pointsPerValue(self):
+    """Number of values yielded when iterating over each consolidated bucket"""
+    if self.downsample == 'm4' and self.valuesPerPoint > 1:
+      return 4
+    return 1
 
   __consolidation_functions = {
     'sum': sum,
@@ -136,6 +192,49 @@ class TimeSeries(list):
 
     return
 
+  def __m4Generator(self, gen):
+    buf = []
+    valcnt = 0
+
+    for x in gen:
+      valcnt += 1
+      if x is not None and x == x:
+        buf.append(x)
+
+      if valcnt == self.valuesPerPoint:
+        for value in self.__m4Bucket(buf):
+          yield value
+        buf = []
+        valcnt = 0
+
+    if valcnt > 0:
+      for value in self.__m4Bucket(buf):
+        yield value
+
+  def __m4Bucket(self, buf):
+    if not buf or (len(buf) / self.valuesPerPoint) < self.xFilesFactor:
+      return (None, None, None, None)
+
+    iMin = min(range(len(buf)), key=buf.__getitem__)
+    iMax = max(range(len(buf)), key=buf.__getitem__)
+    if iMax < iMin:
+      iMin, iMax = iMax, iMin
+    return (buf[0], buf[iMin], buf[iMax], buf[-1])
+
+  def _arrayConsolidation(self):
+    """Return the name of the function consolidating the series with NumPy.
+
+    Returns None if the series isn't consolidated, or if it's consolidated
+    with the m4 downsampling or an unknown function (the generators raise
+    the error when the series is iterated).
+    """
+    if self.valuesPerPoint <= 1 or self.downsample == 'm4':
+      return None
+    func = self.__consolidation_function_aliases.get(self.consolidationFunc, self.consolidationFunc)
+    if func not in self.__consolidation_functions:
+      return None
+    return func
+
   def __repr__(self):
     return 'TimeSeries(name=%s, start=%s, end=%s, step=%s, valuesPerPoint=%s, consolidationFunc=%s, xFilesFactor=%s)' % (
       self.name, self.start, self.end, self.step, self.valuesPerPoint, self.consolidationFunc, self.xFilesFactor)
@@ -185,6 +284,56 @@ class TimeSeries(list):
       raise Exception('Invalid tags specified')
 
 
+class ArrayTimeSeries(TimeSeries):
+  """TimeSeries holding its values in a float64 array, with NaN for gaps.
+
+  With NumPy, TimeSeries built from an array, or consolidated by consolidate(),
+  keep their values this way: the length and the consolidated values are
+  computed from the array. Any other use of the series as a list fills the
+  list with the values and turns it back into a plain TimeSeries.
+  """
+
+  def __len__(self):
+    return len(self._array)
+
+  def __iter__(self):
+    func = self._arrayConsolidation()
+    if func is not None:
+      return iter(arrays.consolidate(self._array, self.valuesPerPoint, func, self.xFilesFactor))
+    self._fill()
+    return TimeSeries.__iter__(self)
+
+  def __reduce_ex__(self, protocol):
+    self._fill()
+    return self.__reduce_ex__(protocol)
+
+  def asarray(self):
+    return self._array
+
+  def _fill(self):
+    values = arrays.fromArray(self.__dict__.pop('_array'))
+    self.__class__ = TimeSeries
+    list.extend(self, values)
+
+
+def _fills(method):
+  def fill(*args, **kwargs):
+    for arg in args:
+      if isinstance(arg, ArrayTimeSeries):
+        arg._fill()
+    return method(*args, **kwargs)
+  fill.__name__ = method.__name__
+  fill.__doc__ = method.__doc__
+  return fill
+
+
+for _method in ('__getitem__', '__setitem__', '__delitem__', '__contains__', '__reversed__',
+                '__eq__', '__ne__', '__lt__', '__le__', '__gt__', '__ge__', '__add__', '__iadd__',
+                '__mul__', '__rmul__', '__imul__', 'append', 'extend', 'insert', 'pop', 'remove',
+                'index', 'count', 'reverse', 'sort', 'clear'):
+  setattr(ArrayTimeSeries, _method, _fills(getattr(TimeSeries, _method)))
+
+
 # Data retrieval API
 @logtime
 def fetchData(requestContext, pathExpr, timer=None):
@@ -232,8 +381,7 @@ def _merge_results(pathExpr, startTime, endTime, prefetched, seriesList, request
       # as a very weak CRDT resolver.
       candidate_nones = 0
       if not settings.REMOTE_STORE_MERGE_RESULTS:
-        candidate_nones = len(
-          [val for val in values if val is None])
+        candidate_nones = _countNones(series)
 
       known = seriesList[series.name]
       # To avoid repeatedly recounting the 'Nones' in series we've already seen,
@@ -241,7 +389,7 @@ def _merge_results(pathExpr, startTime, endTime, prefetched, seriesList, request
       if known.name in series_best_nones:
         known_nones = series_best_nones[known.name]
       else:
-        known_nones = len([val for val in known if val is None])
+        known_nones = _countNones(known)
         series_best_nones[known.name] = known_nones
 
       if known_nones > candidate_nones and len(series):
@@ -274,24 +422,98 @@ def _merge_results(pathExpr, startTime, endTime, prefetched, seriesList, request
   return [seriesList[k] for k in sorted(seriesList)]
 
 
-def prefetchData(requestContext, pathExpressions):
+def _countNones(series):
+  if isinstance(series, ArrayTimeSeries):
+    # don't fill the list just to count its gaps
+    return arrays.countGaps(series.asarray())
+  return len([val for val in series if val is None])
+
+
+def prefetchData(requestContext, pathExpressions, windows=None):
   """Prefetch a bunch of path expressions and stores them in the context.
 
   The idea is that this will allow more batching than doing a query
   each time evaluateTarget() needs to fetch a path. All the prefetched
   data is stored in the requestContext, to be accessed later by fetchData.
+
+  windows maps the timebounds of the other time windows the targets need
+  (see extractPathExpressions) to their request context and path
+  expressions, they are fetched at the same time as the request window,
+  in the prefetch worker pool if USE_WORKER_POOL is enabled.
   """
-  if not pathExpressions:
+  if not pathExpressions and not windows:
     return
 
+  timeBounds = timebounds(requestContext)
+  done = requestContext.get('prefetched', {})
+
+  # skip the path expressions that were already prefetched by the evaluation
+  # of another target
+  pathExpressions = [pathExpr for pathExpr in pathExpressions or [] if pathExpr not in done.get(timeBounds, {})]
+  otherWindows = []
+  for bounds in sorted(windows or {}):
+    (context, paths) = windows[bounds]
+    paths = sorted(pathExpr for pathExpr in paths if pathExpr not in done.get(bounds, {}))
+    if paths:
+      otherWindows.append((context, bounds, paths))
+
+  pool = None
+  if settings.USE_WORKER_POOL and otherWindows:
+    # the pool is sized once, for all the requests
+    pool = get_pool('prefetch', settings.POOL_MAX_WORKERS)
+  results = [(window, pool.apply_async(_prefetchWindow, window) if pool else None) for window in otherWindows]
+
+  # the request window is fetched in this thread, failing to fetch it fails the request
+  if pathExpressions:
+    _storePrefetched(requestContext, timeBounds, _prefetchWindow(requestContext, timeBounds, pathExpressions))
+
+  # the functions fetch the windows that couldn't be prefetched themselves
+  deadline = time.time() + settings.FIND_TIMEOUT + settings.FETCH_TIMEOUT
+  for ((context, bounds, paths), result) in results:
+    try:
+      if result is None:
+        prefetched = _prefetchWindow(context, bounds, paths)
+      else:
+        prefetched = result.get(max(0, deadline - time.time()))
+    except Exception as e:
+      log.info("Failed to prefetch data for [%s]: %s" % (', '.join(paths), e))
+      continue
+    _storePrefetched(requestContext, bounds, prefetched)
+
+
+def _prefetchWindow(requestContext, timeBounds, pathExpressions):
+  (startTime, endTime, now) = timeBounds
+
   start = time.time()
   log.debug("Fetching data for [%s]" % (', '.join(pathExpressions)))
 
-  (startTime, endTime, now) = timebounds(requestContext)
+  # only windows that end now will move forward on the next refresh
+  if settings.INCREMENTAL_DATA_CACHE and endTime >= now:
+    prefetched = _fetchIncremental(pathExpressions, startTime, endTime, now, requestContext)
+  else:
+    prefetched = _fetch(pathExpressions, startTime, endTime, now, requestContext)
+
+  log.rendering("Fetched data for [%s] in %fs" % (', '.join(pathExpressions), time.time() - start))
+  return prefetched
+
 
+def _storePrefetched(requestContext, timeBounds, prefetched):
+  if requestContext.get('prefetched') is None:
+    requestContext['prefetched'] = {}
+
+  # the targets of a request evaluated in parallel may store the same window at once
+  requestContext['prefetched'].setdefault(timeBounds, {}).update(prefetched)
+
+
+def _fetch(pathExpressions, startTime, endTime, now, requestContext):
+  return _prefetched(STORE.fetch(pathExpressions, startTime, endTime, now, requestContext))
+
+
+def _prefetched(results):
+  """Group the results of a fetch by path expression"""
   prefetched = collections.defaultdict(list)
 
-  for result in STORE.fetch(pathExpressions, startTime, endTime, now, requestContext):
+  for result in results:
     if result is None:
       continue
 
@@ -310,12 +532,135 @@ def prefetchData(requestContext, pathExpressions):
       if isinstance(values, types.GeneratorType):
         prefetched[pathExpression][i] = (name, (time_info, list(values)))
 
-  if not requestContext.get('prefetched'):
-    requestContext['prefetched'] = {}
+  return prefetched
 
-  if (startTime, endTime, now) in requestContext['prefetched']:
-      requestContext['prefetched'][(startTime, endTime, now)].update(prefetched)
-  else:
-      requestContext['prefetched'][(startTime, endTime, now)] = prefetched
 
-  log.rendering("Fetched data for [%s] in %fs" % (', '.join(pathExpressions), time.time() - start))
+def _incrementalCacheKey(pathExpr, requestContext):
+  return 'incremental:' + compactHash('%s:%s:%s' % (
+    pathExpr, bool(requestContext.get('localOnly')), requestContext.get('fetchMaxStep')))
+
+
+def _incrementalWindow(windows, startTime, endTime):
+  """Return the step and the cached window to continue for a window ending now.
+
+  windows maps the step of the windows cached for a path expression to the
+  window. Only windows that started less than INCREMENTAL_DATA_CACHE_DURATION
+  before startTime are continued, longer ones may have been read from a
+  coarser archive than a fetch from startTime would be.
+  """
+  usable = [
+    (window['startTime'], step, window) for (step, window) in (windows or {}).items()
+    if window['startTime'] <= startTime < window['endTime'] <= endTime and
+    startTime - window['startTime'] <= settings.INCREMENTAL_DATA_CACHE_DURATION
+  ]
+  if not usable:
+    return (None, None)
+  (_, step, window) = max(usable, key=lambda u: (u[0], -u[1]))
+  return (step, window)
+
+
+def _fetchIncremental(pathExpressions, startTime, endTime, now, requestContext):
+  """Fetch path expressions, reusing previously fetched windows from the cache.
+
+  For rolling windows (e.g. from=-24h refreshed every minute) most of the data
+  was already fetched by the previous request. Only the tail from the end of
+  the cached window (minus INCREMENTAL_DATA_CACHE_OVERLAP, to pick up late
+  points) is fetched and spliced onto the cached series. The tail is fetched
+  with the step of the cached window as fetchMaxStep, so that storage reads it
+  from the same archive rather than from a finer one covering the short tail.
+  If the tail can't be spliced cleanly (the set of series or their step
+  changed) the whole window is fetched again.
+
+  Windows are cached by path expression, for each step, so that windows of
+  the same path expression read from different archives don't evict each
+  other.
+  """
+  keys = dict((pathExpr, _incrementalCacheKey(pathExpr, requestContext)) for pathExpr in pathExpressions)
+  cached = cache.get_many(list(keys.values()))
+
+  # group the path expressions we have a usable window for by the start and step of their tail
+  tails = collections.defaultdict(list)
+  windows = {}
+  full = []
+  for pathExpr in pathExpressions:
+    (step, window) = _incrementalWindow(cached.get(keys[pathExpr]), startTime, endTime)
+    if window is None:
+      full.append(pathExpr)
+      continue
+    windows[pathExpr] = window
+    tailStart = max(startTime, window['endTime'] - settings.INCREMENTAL_DATA_CACHE_OVERLAP)
+    tails[(tailStart, step)].append(pathExpr)
+
+  prefetched = collections.defaultdict(list)
+  for (tailStart, step), tailExpressions in tails.items():
+    tailContext = requestContext.copy()
+    tailContext['fetchMaxStep'] = step
+    fetched = _fetch(tailExpressions, tailStart, endTime, now, tailContext)
+    for pathExpr in tailExpressions:
+      spliced = _splice(windows[pathExpr]['series'], fetched.get(pathExpr, []), startTime)
+      if spliced is None:
+        full.append(pathExpr)
+      else:
+        log.cache('Incremental-Cache hit [%s], fetched from %d' % (pathExpr, tailStart))
+        prefetched[pathExpr] = spliced
+
+  if full:
+    log.cache('Incremental-Cache miss [%s]' % ', '.join(full))
+    prefetched.update(_fetch(full, startTime, endTime, now, requestContext))
+
+  updates = {}
+  for pathExpr in pathExpressions:
+    series = prefetched.get(pathExpr, [])
+    steps = set(step for (name, ((start, end, step), values)) in series)
+    # windows of series read with several steps can't be continued with a single tail fetch
+    if len(steps) > 1:
+      continue
+    step = steps.pop() if steps else None
+    # drop the windows of other steps that ended before this one started
+    entry = dict(
+      (windowStep, window) for (windowStep, window) in (cached.get(keys[pathExpr]) or {}).items()
+      if window['endTime'] > startTime)
+    entry[step] = {
+      'startTime': startTime,
+      'endTime': endTime,
+      'series': series,
+    }
+    updates[keys[pathExpr]] = entry
+  if updates:
+    cache.set_many(updates, settings.INCREMENTAL_DATA_CACHE_DURATION)
+
+  return prefetched
+
+
+def _values(values):
+  """Return the values read for a series as a list, with None for gaps"""
+  if arrays.isArray(values):
+    return arrays.fromArray(values)
+  return list(values)
+
+
+def _splice(cachedSeries, tailSeries, startTime):
+  """Append freshly fetched tails to cached series, dropping points before startTime.
+
+  Returns None if the tails don't line up with the cached series.
+  """
+  tails = dict(tailSeries)
+  if len(tails) != len(tailSeries) or len(tails) != len(cachedSeries) or set(tails) != set(name for name, _ in cachedSeries):
+    # the set of series changed, or some came back from several backends
+    return None
+
+  spliced = []
+  for name, ((start, end, step), values) in cachedSeries:
+    ((tailStart, tailEnd, tailStep), tailValues) = tails[name]
+    if tailStep != step or (tailStart - start) % step or not start <= tailStart <= end:
+      return None
+
+    # drop the points a fetch from startTime wouldn't return
+    skip = max(0, (startTime - start) // step + 1)
+    keep = (tailStart - start) // step
+    if skip >= keep:
+      spliced.append((name, ((tailStart, tailEnd, step), tailValues)))
+    else:
+      spliced.append((name, ((start + skip * step, tailEnd, step), _values(values[skip:keep]) + _values(tailValues))))
+
+  return spliced
@@ -1,5 +1,9 @@
+import copy
 import re
 import six
+import time
+
+from threading import Lock
 
 from graphite.errors import NormalizeEmptyResultError, InputParameterError
 from graphite.functions import SeriesFunction
@@ -7,6 +11,8 @@ from graphite.logger import log
 from graphite.render.grammar import grammar
 from graphite.render.datalib import fetchData, TimeSeries, prefetchData
 from graphite.functions.params import validateParams
+from graphite.util import timebounds
+from graphite.worker_pool.pool import get_pool
 
 from django.conf import settings
 
@@ -15,28 +21,43 @@ def evaluateTarget(requestContext, targets):
   if not isinstance(targets, list):
     targets = [targets]
 
-  pathExpressions = extractPathExpressions(requestContext, targets)
-  prefetchData(requestContext, pathExpressions)
-
-  seriesList = []
+  windows = {} if settings.RENDER_PREFETCH_WINDOWS else None
+  pathExpressions = extractPathExpressions(requestContext, targets, windows)
+  prefetchData(requestContext, pathExpressions, windows)
 
-  for target in targets:
-    if not target:
-      continue
+  # plan the evaluation of all the targets, unless they are evaluated by a
+  # function of a planned target
+  plan = None
+  if settings.RENDER_SHARE_SUBEXPRESSIONS and 'plan' not in requestContext:
+    plan = requestContext['plan'] = Plan(requestContext, targets)
 
-    if isinstance(target, six.string_types):
-      if not target.strip():
+  try:
+    parsedTargets = []
+    for target in targets:
+      if not target:
         continue
 
-      target = grammar.parseString(target)
+      if isinstance(target, six.string_types):
+        if not target.strip():
+          continue
 
-    try:
-      result = evaluateTokens(requestContext, target)
-    except InputParameterError as e:
-      e.setTargets(requestContext.get('targets', []))
-      e.setSourceIdHeaders(requestContext.get('sourceIdHeaders', {}))
-      raise
+        target = grammar.parseString(target)
+      parsedTargets.append(target)
 
+    pool = None
+    if len(parsedTargets) > 1 and settings.USE_WORKER_POOL and not dependsOnOrder(parsedTargets):
+      pool = get_pool('render', settings.RENDER_POOL_MAX_WORKERS)
+
+    if pool is None:
+      results = [evaluateTargetTokens(requestContext, target) for target in parsedTargets]
+    else:
+      results = evaluateTargetsParallel(requestContext, parsedTargets, pool)
+  finally:
+    if plan is not None:
+      del requestContext['plan']
+
+  seriesList = []
+  for result in results:
     # we have to return a list of TimeSeries objects
     if isinstance(result, TimeSeries):
       seriesList.append(result)
@@ -46,41 +67,96 @@ def evaluateTarget(requestContext, targets):
   return seriesList
 
 
+def evaluateTargetTokens(requestContext, target):
+  try:
+    return evaluateTokens(requestContext, target)
+  except InputParameterError as e:
+    e.setTargets(requestContext.get('targets', []))
+    e.setSourceIdHeaders(requestContext.get('sourceIdHeaders', {}))
+    raise
+
+
+def evaluateTargetsParallel(requestContext, targets, pool):
+  # Evaluates the targets in at most RENDER_POOL_MAX_WORKERS_PER_REQUEST
+  # threads, this one included, and returns their results in order
+  #
+  # Each target is evaluated in a copy of the request context, since
+  # functions store their arguments in it, with maps of the prefetched
+  # windows and of their paths of its own, since functions store the windows
+  # they fetch in them.
+  # Once the pool threads used RENDER_POOL_CPU_TIME_PER_REQUEST seconds of
+  # CPU time for the request, the remaining targets are left to this thread.
+  contexts = []
+  for target in targets:
+    context = requestContext.copy()
+    context['prefetched'] = dict(
+      (bounds, dict(paths)) for (bounds, paths) in (requestContext.get('prefetched') or {}).items())
+    contexts.append(context)
+  plan = requestContext.get('plan')
+  if plan is not None and plan.requestContext is requestContext:
+    plan.contexts.extend(contexts)
+
+  results = [None] * len(targets)
+  errors = [None] * len(targets)
+  pending = iter(range(len(targets)))
+  lock = Lock()
+  finished = six.moves.queue.Queue()
+  budget = settings.RENDER_POOL_CPU_TIME_PER_REQUEST
+  cpuTime = [0.0]
+
+  def run(pooled=True):
+    while True:
+      with lock:
+        if pooled and budget and cpuTime[0] >= budget:
+          return
+        i = next(pending, None)
+      if i is None:
+        return
+      start = time.thread_time()
+      try:
+        results[i] = evaluateTargetTokens(contexts[i], targets[i])
+      except Exception as e:
+        errors[i] = e
+      finally:
+        if pooled:
+          with lock:
+            cpuTime[0] += time.thread_time() - start
+        finished.put(i)
+
+  # the threads of the pool that start once all the targets are taken have nothing to do,
+  # so a busy pool only delays the request as far as this thread can evaluate the targets
+  for _ in range(min(len(targets), settings.RENDER_POOL_MAX_WORKERS_PER_REQUEST) - 1):
+    pool.apply_async(run)
+  run(pooled=False)
+  for _ in targets:
+    finished.get()
+
+  # raise the error of the first target that failed, as a sequential evaluation would
+  for error in errors:
+    if error is not None:
+      raise error
+
+  return results
+
+
 def evaluateTokens(requestContext, tokens, replacements=None, pipedArg=None):
   if tokens.template:
-    arglist = dict()
-    if tokens.template.kwargs:
-      arglist.update(dict([(kwarg.argname, evaluateScalarTokens(kwarg.args[0])) for kwarg in tokens.template.kwargs]))
-    if tokens.template.args:
-      arglist.update(dict([(str(i+1), evaluateScalarTokens(arg)) for i, arg in enumerate(tokens.template.args)]))
-    if 'template' in requestContext:
-      arglist.update(requestContext['template'])
-    return evaluateTokens(requestContext, tokens.template, arglist)
+    return evaluateTokens(requestContext, tokens.template, templateArgs(requestContext, tokens))
 
   if tokens.expression:
     if tokens.expression.pipedCalls.asList():
       # when the expression has piped calls, we pop the right-most call and pass the remaining
       # expression into it via pipedArg, to get the same result as a nested call
-      rightMost = tokens.expression.pipedCalls.pop()
+      (rightMost, tokens) = popPipedCall(tokens)
       return evaluateTokens(requestContext, rightMost, replacements, tokens)
 
     return evaluateTokens(requestContext, tokens.expression, replacements)
 
   if tokens.pathExpression:
-    expression = tokens.pathExpression
-    if replacements:
-      for name in replacements:
-        if expression == '$'+name:
-          val = replacements[name]
-          if not isinstance(val, six.string_types):
-            return val
-          elif re.match(r'^-?[\d.]+$', val):
-            return float(val)
-          else:
-            return val
-        else:
-          expression = expression.replace('$'+name, str(replacements[name]))
-    return fetchData(requestContext, expression)
+    (isValue, value) = substituteTemplate(tokens.pathExpression, replacements)
+    if isValue:
+      return value
+    return fetchData(requestContext, value)
 
   if tokens.call:
     if tokens.call.funcname == 'template':
@@ -91,42 +167,270 @@ def evaluateTokens(requestContext, tokens, replacements=None, pipedArg=None):
     if tokens.call.funcname == 'seriesByTag':
       return fetchData(requestContext, tokens.call.raw)
 
-    try:
-      func = SeriesFunction(tokens.call.funcname)
-    except KeyError:
-      raise InputParameterError('Received request for unknown function: {func}'.format(func=tokens.call.funcname))
+    plan = requestContext.get('plan')
+    if plan is not None and plan.owns(requestContext):
+      return plan.evaluate(
+        expressionKey(requestContext, tokens, replacements, pipedArg),
+        lambda: evaluateCall(requestContext, tokens, replacements, pipedArg))
 
-    rawArgs = tokens.call.args or []
-    if pipedArg is not None:
-      rawArgs.insert(0, pipedArg)
-    args = [evaluateTokens(requestContext, arg, replacements) for arg in rawArgs]
-    requestContext['args'] = rawArgs
-    kwargs = dict([(kwarg.argname, evaluateTokens(requestContext, kwarg.args[0], replacements))
-                   for kwarg in tokens.call.kwargs])
+    return evaluateCall(requestContext, tokens, replacements, pipedArg)
 
-    if hasattr(func, 'params'):
-      try:
-        (args, kwargs) = validateParams(tokens.call.funcname, func.params, args, kwargs)
-      except InputParameterError as e:
-        e.setSourceIdHeaders(requestContext.get('sourceIdHeaders', {}))
-        e.setTargets(requestContext.get('targets', []))
-        e.setFunction(tokens.call.funcname, args, kwargs)
-        if settings.ENFORCE_INPUT_VALIDATION:
-          raise
-        else:
-          log.warning('Validation Error: %s', str(e))
+  return evaluateScalarTokens(tokens)
+
+
+def evaluateCall(requestContext, tokens, replacements=None, pipedArg=None):
+  try:
+    func = SeriesFunction(tokens.call.funcname)
+  except KeyError:
+    raise InputParameterError('Received request for unknown function: {func}'.format(func=tokens.call.funcname))
 
+  rawArgs = list(tokens.call.args or [])
+  if pipedArg is not None:
+    rawArgs.insert(0, pipedArg)
+  args = [evaluateTokens(requestContext, arg, replacements) for arg in rawArgs]
+  requestContext['args'] = rawArgs
+  kwargs = dict([(kwarg.argname, evaluateTokens(requestContext, kwarg.args[0], replacements))
+                 for kwarg in tokens.call.kwargs])
+
+  if hasattr(func, 'params'):
     try:
-      return func(requestContext, *args, **kwargs)
-    except NormalizeEmptyResultError:
-      return []
+      (args, kwargs) = validateParams(tokens.call.funcname, func.params, args, kwargs)
     except InputParameterError as e:
-        e.setSourceIdHeaders(requestContext.get('sourceIdHeaders', {}))
-        e.setTargets(requestContext.get('targets', []))
-        e.setFunction(tokens.call.funcname, args, kwargs)
+      e.setSourceIdHeaders(requestContext.get('sourceIdHeaders', {}))
+      e.setTargets(requestContext.get('targets', []))
+      e.setFunction(tokens.call.funcname, args, kwargs)
+      if settings.ENFORCE_INPUT_VALIDATION:
         raise
+      else:
+        log.warning('Validation Error: %s', str(e))
 
-  return evaluateScalarTokens(tokens)
+  try:
+    return func(requestContext, *args, **kwargs)
+  except NormalizeEmptyResultError:
+    return []
+  except InputParameterError as e:
+      e.setSourceIdHeaders(requestContext.get('sourceIdHeaders', {}))
+      e.setTargets(requestContext.get('targets', []))
+      e.setFunction(tokens.call.funcname, args, kwargs)
+      raise
+
+
+def templateArgs(requestContext, tokens):
+  # Returns the variables of a template call
+  arglist = dict()
+  if tokens.template.kwargs:
+    arglist.update(dict([(kwarg.argname, evaluateScalarTokens(kwarg.args[0])) for kwarg in tokens.template.kwargs]))
+  if tokens.template.args:
+    arglist.update(dict([(str(i+1), evaluateScalarTokens(arg)) for i, arg in enumerate(tokens.template.args)]))
+  if 'template' in requestContext:
+    arglist.update(requestContext['template'])
+  return arglist
+
+
+def substituteTemplate(expression, replacements):
+  # Returns (True, value) if the path expression is a template variable,
+  # (False, expression) with the template variables replaced otherwise
+  if replacements:
+    for name in replacements:
+      if expression == '$'+name:
+        val = replacements[name]
+        if not isinstance(val, six.string_types):
+          return (True, val)
+        elif re.match(r'^-?[\d.]+$', val):
+          return (True, float(val))
+        else:
+          return (True, val)
+      else:
+        expression = expression.replace('$'+name, str(replacements[name]))
+  return (False, expression)
+
+
+def popPipedCall(tokens):
+  # Returns the right-most piped call of an expression and a copy of the
+  # expression without it, parsed targets are cached so we can't modify them
+  expression = tokens.expression.copy()
+  pipedCalls = expression.pipedCalls.copy()
+  rightMost = pipedCalls.pop()
+  expression['pipedCalls'] = pipedCalls
+  tokens = tokens.copy()
+  tokens['expression'] = expression
+  return (rightMost, tokens)
+
+
+# Functions that can't share their results: they are random, or have side
+# effects on the request context
+UNSHARED_FUNCTIONS = frozenset([
+  'randomWalk', 'randomWalkFunction', 'setXFilesFactor', 'stacked', 'xFilesFactor',
+])
+
+
+class Plan(object):
+  """Evaluation plan of the targets of a request.
+
+  The function calls of the targets are identified by their canonical form
+  (see expressionKey), so that identical calls within a target or across
+  targets are a single node of a DAG. The calls used more than once are
+  evaluated once, and each use but the last one gets a copy of the result,
+  since functions are free to modify the series they are given.
+
+  Targets evaluated concurrently (see evaluateTargetsParallel) wait for the
+  first evaluation of the calls they share.
+  """
+
+  def __init__(self, requestContext, targets):
+    self.requestContext = requestContext
+    # the copies of the request context the targets are evaluated in
+    self.contexts = []
+    self.lock = Lock()
+    self.locks = {}
+    self.targets = []
+    # canonical form of each call -> canonical forms of the calls among its arguments
+    self.nodes = {}
+    self.unshared = set()
+    self.uses = {}
+    self.remaining = {}
+    self.results = {}
+
+    for target in targets:
+      if not target:
+        continue
+
+      tokens = target
+      if isinstance(target, six.string_types):
+        if not target.strip():
+          continue
+        tokens = grammar.parseString(target)
+
+      key = expressionKey(requestContext, tokens, plan=self)
+      self.targets.append((target, key))
+      self.use(key)
+
+    self.remaining = dict(self.uses)
+
+  def addNode(self, key, funcname, args):
+    children = [arg for arg in args if arg in self.nodes]
+    self.nodes.setdefault(key, children)
+    if funcname in UNSHARED_FUNCTIONS or any(child in self.unshared for child in children):
+      self.unshared.add(key)
+
+  def use(self, key):
+    if key not in self.nodes:
+      return
+    self.uses[key] = self.uses.get(key, 0) + 1
+    # the arguments of a shared call are only evaluated the first time
+    if self.uses[key] == 1 or key in self.unshared:
+      for child in self.nodes[key]:
+        self.use(child)
+
+  def isShared(self, key):
+    return self.uses.get(key, 0) > 1 and key not in self.unshared
+
+  def owns(self, requestContext):
+    # the contexts functions evaluate their input in don't use the plan
+    return requestContext is self.requestContext or any(context is requestContext for context in self.contexts)
+
+  def evaluate(self, key, evaluate):
+    """Return the result of a call, evaluating it with evaluate() the first time"""
+    if not self.isShared(key):
+      return evaluate()
+
+    with self.lock:
+      keyLock = self.locks.setdefault(key, Lock())
+
+    # a call can't be among its own arguments, so the calls evaluated while
+    # holding the lock of another call can't wait for it
+    with keyLock:
+      remaining = self.remaining.get(key)
+      if remaining:
+        if key not in self.results:
+          self.results[key] = evaluate()
+
+        self.remaining[key] = remaining - 1
+        # the result is only given away once all the copies of it are made
+        if remaining == 1:
+          return self.results.pop(key)
+        return copyResult(self.results[key])
+
+    return evaluate()
+
+  def explain(self):
+    return {
+      'targets': [
+        {'target': target if isinstance(target, six.string_types) else None, 'expression': key}
+        for (target, key) in self.targets
+      ],
+      'calls': [
+        {
+          'expression': key,
+          'args': self.nodes[key],
+          'uses': self.uses[key],
+          'shared': self.isShared(key),
+        }
+        for key in self.nodes if key in self.uses
+      ],
+    }
+
+
+def expressionKey(requestContext, tokens, replacements=None, pipedArg=None, plan=None):
+  # Returns the canonical form of an expression, which is the same for the
+  # expressions evaluating to the same result (e.g. "a|f(1)" and "f(a, 1)"),
+  # or None if it can't be evaluated. The function calls found are added to
+  # the nodes of plan
+  if tokens.template:
+    try:
+      replacements = templateArgs(requestContext, tokens)
+    except InputParameterError:
+      return None
+    return expressionKey(requestContext, tokens.template, replacements, plan=plan)
+
+  if tokens.expression:
+    if tokens.expression.pipedCalls.asList():
+      (rightMost, tokens) = popPipedCall(tokens)
+      return expressionKey(requestContext, rightMost, replacements, tokens, plan)
+    return expressionKey(requestContext, tokens.expression, replacements, plan=plan)
+
+  if tokens.pathExpression:
+    (isValue, value) = substituteTemplate(tokens.pathExpression, replacements)
+    return repr(value) if isValue else value
+
+  if tokens.call:
+    if tokens.call.funcname == 'seriesByTag':
+      return tokens.call.raw
+
+    rawArgs = list(tokens.call.args or [])
+    if pipedArg is not None:
+      rawArgs.insert(0, pipedArg)
+    args = [expressionKey(requestContext, arg, replacements, plan=plan) for arg in rawArgs]
+    kwargs = sorted([
+      (kwarg.argname, expressionKey(requestContext, kwarg.args[0], replacements, plan=plan))
+      for kwarg in tokens.call.kwargs
+    ])
+    if None in args or None in [value for (name, value) in kwargs]:
+      return None
+
+    key = '%s(%s)' % (tokens.call.funcname, ','.join(args + ['%s=%s' % kwarg for kwarg in kwargs]))
+    if plan is not None:
+      plan.addNode(key, tokens.call.funcname, args + [value for (name, value) in kwargs])
+    return key
+
+  try:
+    return repr(evaluateScalarTokens(tokens))
+  except InputParameterError:
+    return None
+
+
+def copyResult(result):
+  # Returns a copy of the result of a function that can be modified
+  # without modifying the result: the values, whether in a list or an
+  # array, and the attributes of the series (options, tags...) are copied
+  if isinstance(result, TimeSeries):
+    series = result.__class__.__new__(result.__class__)
+    list.extend(series, list.__iter__(result))
+    series.__dict__.update(copy.deepcopy(result.__dict__))
+    return series
+  if isinstance(result, list):
+    return [copyResult(item) for item in result]
+  return result
 
 
 def evaluateScalarTokens(tokens):
@@ -155,40 +459,74 @@ def evaluateScalarTokens(tokens):
   raise InputParameterError("unknown token in target evaluator")
 
 
-def extractPathExpressions(requestContext, targets):
+def extractPathExpressions(requestContext, targets, windows=None):
   # Returns a list of unique pathExpressions found in the targets list
+  #
+  # If windows is a dict, the other time windows the functions of the targets
+  # evaluate their input in (see prefetchContexts in graphite.functions) are
+  # added to it, it maps the timebounds of each window to its request context
+  # and the set of the pathExpressions fetched in it
 
   pathExpressions = set()
+  rootContext = requestContext
 
-  def extractPathExpression(requestContext, tokens, replacements=None):
+  def extractPathExpression(requestContext, tokens, replacements=None, pipedArg=None, paths=pathExpressions):
     if tokens.template:
-      arglist = dict()
-      if tokens.template.kwargs:
-        arglist.update(dict([(kwarg.argname, evaluateScalarTokens(kwarg.args[0])) for kwarg in tokens.template.kwargs]))
-      if tokens.template.args:
-        arglist.update(dict([(str(i+1), evaluateScalarTokens(arg)) for i, arg in enumerate(tokens.template.args)]))
-      if 'template' in requestContext:
-        arglist.update(requestContext['template'])
-      extractPathExpression(requestContext, tokens.template, arglist)
+      extractPathExpression(requestContext, tokens.template, templateArgs(requestContext, tokens), paths=paths)
     elif tokens.expression:
-      extractPathExpression(requestContext, tokens.expression, replacements)
+      if windows is not None and tokens.expression.pipedCalls.asList():
+        # the input of a piped call is the expression before it
+        (rightMost, tokens) = popPipedCall(tokens)
+        extractPathExpression(requestContext, tokens, replacements, paths=paths)
+        extractPathExpression(requestContext, rightMost, replacements, tokens, paths=paths)
+        return
+      extractPathExpression(requestContext, tokens.expression, replacements, paths=paths)
       if tokens.expression.pipedCalls:
         for token in tokens.expression.pipedCalls:
-          extractPathExpression(requestContext, token, replacements)
+          extractPathExpression(requestContext, token, replacements, paths=paths)
     elif tokens.pathExpression:
       expression = tokens.pathExpression
       if replacements:
         for name in replacements:
           if expression != '$'+name:
             expression = expression.replace('$'+name, str(replacements[name]))
-      pathExpressions.add(expression)
+      paths.add(expression)
     elif tokens.call:
       # if we're prefetching seriesByTag, pass the entire call back as a path expression
       if tokens.call.funcname == 'seriesByTag':
-        pathExpressions.add(tokens.call.raw)
+        paths.add(tokens.call.raw)
       else:
         for a in tokens.call.args:
-          extractPathExpression(requestContext, a, replacements)
+          extractPathExpression(requestContext, a, replacements, paths=paths)
+        if windows is not None:
+          extractWindows(requestContext, tokens, replacements, pipedArg)
+
+  def extractWindows(requestContext, tokens, replacements, pipedArg):
+    rawArgs = list(tokens.call.args or [])
+    if pipedArg is not None:
+      rawArgs.insert(0, pipedArg)
+    if not rawArgs:
+      return
+
+    try:
+      func = SeriesFunction(tokens.call.funcname)
+      contexts = getattr(func, 'prefetchContexts', None)
+      if contexts is None:
+        return
+      args = [scalarArg(arg, replacements) for arg in rawArgs[1:]]
+      kwargs = dict([(kwarg.argname, scalarArg(kwarg.args[0], replacements)) for kwarg in tokens.call.kwargs])
+      contexts = [(timebounds(context), context) for context in contexts(requestContext, None, *args, **kwargs)]
+      rootBounds = timebounds(rootContext)
+    except Exception:
+      # the function will fetch its input itself
+      return
+
+    for (bounds, context) in contexts:
+      if bounds == rootBounds:
+        paths = pathExpressions
+      else:
+        (context, paths) = windows.setdefault(bounds, (context, set()))
+      extractPathExpression(context, rawArgs[0], replacements, paths=paths)
 
   for target in targets:
     if not target:
@@ -201,3 +539,81 @@ def extractPathExpressions(requestContext, targets):
     extractPathExpression(requestContext, target)
 
   return list(pathExpressions)
+
+
+def scalarArg(tokens, replacements=None):
+  # Returns the value of a scalar argument, raises an error for series
+  if tokens.pathExpression:
+    (isValue, value) = substituteTemplate(tokens.pathExpression, replacements)
+    if not isValue:
+      raise InputParameterError('%s is not a scalar' % value)
+    return value
+  return evaluateScalarTokens(tokens)
+
+
+# Functions whose results don't depend on the resolution of the series they
+# are given, targets only calling these can be fetched at a coarser resolution.
+RESOLUTION_INDEPENDENT_FUNCTIONS = frozenset([
+  'alias', 'aliasByMetric', 'aliasByNode', 'aliasByTags', 'aliasSub',
+  'alpha', 'areaBetween', 'color', 'dashed', 'lineWidth', 'secondYAxis',
+  'seriesByTag', 'sortByName', 'stacked', 'toLowerCase', 'toUpperCase',
+])
+
+
+# Functions with side effects on the request context, the targets calling
+# them are evaluated in order
+ORDER_DEPENDENT_FUNCTIONS = frozenset([
+  'setXFilesFactor', 'stacked', 'xFilesFactor',
+])
+
+
+def dependsOnOrder(targets):
+  # Returns True if any of the targets calls a function whose result depends
+  # on the targets evaluated before it
+
+  def tokensDependOnOrder(tokens):
+    if tokens.template:
+      return tokensDependOnOrder(tokens.template)
+    if tokens.expression:
+      if any(tokensDependOnOrder(token) for token in tokens.expression.pipedCalls):
+        return True
+      return tokensDependOnOrder(tokens.expression)
+    if tokens.call:
+      if tokens.call.funcname in ORDER_DEPENDENT_FUNCTIONS:
+        return True
+      if any(tokensDependOnOrder(kwarg.args[0]) for kwarg in tokens.call.kwargs):
+        return True
+      return any(tokensDependOnOrder(arg) for arg in tokens.call.args)
+    return False
+
+  return any(tokensDependOnOrder(target) for target in targets)
+
+
+def needsRawPoints(targets):
+  # Returns True if any of the targets calls a function that could give a
+  # different result given consolidated series
+
+  def tokensNeedRawPoints(tokens):
+    if tokens.template:
+      return True
+    if tokens.expression:
+      if any(tokensNeedRawPoints(token) for token in tokens.expression.pipedCalls):
+        return True
+      return tokensNeedRawPoints(tokens.expression)
+    if tokens.call:
+      if tokens.call.funcname not in RESOLUTION_INDEPENDENT_FUNCTIONS:
+        return True
+      if any(tokensNeedRawPoints(kwarg.args[0]) for kwarg in tokens.call.kwargs):
+        return True
+      return any(tokensNeedRawPoints(arg) for arg in tokens.call.args)
+    return False
+
+  for target in targets:
+    if isinstance(target, six.string_types):
+      if not target.strip():
+        continue
+      target = grammar.parseString(target)
+    if tokensNeedRawPoints(target):
+      return True
+
+  return False
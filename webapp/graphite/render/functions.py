@@ -21,6 +21,7 @@ import random
 import re
 import time
 
+from collections import deque
 from datetime import datetime, timedelta
 from functools import reduce
 from six.moves import range, zip
@@ -34,15 +35,20 @@ except ImportError:
 from os import environ
 
 from django.conf import settings
+from django.core.cache import cache
+from graphite import arrays
 from graphite.errors import NormalizeEmptyResultError, InputParameterError
 from graphite.events import models
 from graphite.functions import SeriesFunction, ParamTypes, Param, ParamTypeAggFunc, getAggFunc, safe
+from graphite.functions.aggfuncs import aggFuncAliasNames
+from graphite.functions.window import slidingWindow
 from graphite.logger import log
 from graphite.render.attime import getUnitString, parseTimeOffset, parseATTime, SECONDS_STRING, MINUTES_STRING, HOURS_STRING, DAYS_STRING, WEEKS_STRING, MONTHS_STRING, YEARS_STRING
 from graphite.render.evaluator import evaluateTarget
 from graphite.render.grammar import grammar
+from graphite.render.hashing import compactHash
 from graphite.storage import STORE
-from graphite.util import epoch, epoch_to_dt, timestamp, deltaseconds
+from graphite.util import epoch, epoch_to_dt, timestamp, deltaseconds, timebounds
 
 # XXX format_units() should go somewhere else
 if environ.get('READTHEDOCS'):
@@ -241,7 +247,16 @@ def aggregate(requestContext, seriesList, func, xFilesFactor=None):
 
   xFilesFactor = xFilesFactor if xFilesFactor is not None else requestContext.get('xFilesFactor')
   name = "%sSeries(%s)" % (func, formatPathExpressions(seriesList))
-  values = ( consolidationFunc(row) if xffValues(row, xFilesFactor) else None for row in izip_longest(*seriesList) )
+  values = None
+  if arrays.enabled():
+    try:
+      values = arrays.aggregate(seriesList, aggFuncAliasNames.get(func, func),
+                                xFilesFactor if xFilesFactor is not None else settings.DEFAULT_XFILES_FACTOR)
+    except (TypeError, ValueError):
+      # non-numeric values, fall back to aggregating row by row
+      pass
+  if values is None:
+    values = ( consolidationFunc(row) if xffValues(row, xFilesFactor) else None for row in izip_longest(*seriesList) )
   tags = seriesList[0].tags
   for series in seriesList:
     tags = {tag: tags[tag] for tag in tags if tag in series.tags and tags[tag] == series.tags[tag]}
@@ -1287,6 +1302,23 @@ weightedAverage.params = [
 intOrIntervalSuggestions = [5, 7, 10, '1min', '5min', '10min', '30min', '1hour']
 
 
+def _previewContext(requestContext, previewSeconds):
+  # The context of the evaluation of the input of a function that needs
+  # previewSeconds of data before the requested range
+  newContext = requestContext.copy()
+  newContext['startTime'] = requestContext['startTime'] -  timedelta(seconds=previewSeconds)
+  return newContext
+
+
+def _windowPreviewContexts(requestContext, seriesList, windowSize, *args, **kwargs):
+  # Contexts the moving window functions evaluate their input in, the preview
+  # of a number of points depends on the step of the input series
+  if isinstance(windowSize, six.string_types):
+    delta = parseTimeOffset(windowSize)
+    return [_previewContext(requestContext, abs(delta.seconds + (delta.days * 86400)))]
+  return []
+
+
 def movingWindow(requestContext, seriesList, windowSize, func='average', xFilesFactor=None):
   """
   Graphs a moving window function of a metric (or metrics) over a fixed number of
@@ -1322,13 +1354,12 @@ def movingWindow(requestContext, seriesList, windowSize, func='average', xFilesF
   else:
     previewSeconds = max([s.step for s in seriesList]) * int(windowSize)
 
-  consolidateFunc = getAggFunc(func)
+  # validate func before fetching any data
+  getAggFunc(func)
 
   # ignore original data and pull new, including our preview
   # data from earlier is needed to calculate the early results
-  newContext = requestContext.copy()
-  newContext['prefetch'] = {}
-  newContext['startTime'] = requestContext['startTime'] -  timedelta(seconds=previewSeconds)
+  newContext = _previewContext(requestContext, previewSeconds)
   previewList = evaluateTarget(newContext, requestContext['args'][0])
   result = []
 
@@ -1347,20 +1378,15 @@ def movingWindow(requestContext, seriesList, windowSize, func='average', xFilesF
 
     effectiveXFF = xFilesFactor if xFilesFactor is not None else series.xFilesFactor
 
-    for i in range(windowPoints + 1, len(series) + 1):
-      nonNull = [v for v in series[i - windowPoints:i] if v is not None]
-
-      if nonNull and xff(len(nonNull), windowPoints, effectiveXFF):
-        val = consolidateFunc(nonNull)
-      else:
-        val = None
-      newSeries.append(val)
+    # the first window ends just after the preview period
+    newSeries.extend(slidingWindow(series[1:], windowPoints, func, effectiveXFF))
 
     result.append(newSeries)
 
   return result
 
 
+movingWindow.prefetchContexts = _windowPreviewContexts
 movingWindow.group = 'Calculate'
 movingWindow.params = [
   Param('seriesList', ParamTypes.seriesList, required=True),
@@ -1412,9 +1438,7 @@ def exponentialMovingAverage(requestContext, seriesList, windowSize):
 
   # ignore original data and pull new, including our preview
   # data from earlier is needed to calculate the early results
-  newContext = requestContext.copy()
-  newContext['prefetch'] = {}
-  newContext['startTime'] = requestContext['startTime'] -  timedelta(seconds=previewSeconds)
+  newContext = _previewContext(requestContext, previewSeconds)
   previewList = evaluateTarget(newContext, requestContext['args'][0])
   result = []
 
@@ -1444,6 +1468,7 @@ def exponentialMovingAverage(requestContext, seriesList, windowSize):
   return result
 
 
+exponentialMovingAverage.prefetchContexts = _windowPreviewContexts
 exponentialMovingAverage.group = 'Calculate'
 exponentialMovingAverage.params = [
   Param('seriesList', ParamTypes.seriesList, required=True),
@@ -1473,6 +1498,7 @@ def movingMedian(requestContext, seriesList, windowSize, xFilesFactor=None):
   return movingWindow(requestContext, seriesList, windowSize, 'median', xFilesFactor)
 
 
+movingMedian.prefetchContexts = _windowPreviewContexts
 movingMedian.group = 'Calculate'
 movingMedian.params = [
   Param('seriesList', ParamTypes.seriesList, required=True),
@@ -1950,6 +1976,7 @@ def movingAverage(requestContext, seriesList, windowSize, xFilesFactor=None):
   return movingWindow(requestContext, seriesList, windowSize, 'average', xFilesFactor)
 
 
+movingAverage.prefetchContexts = _windowPreviewContexts
 movingAverage.group = 'Calculate'
 movingAverage.params = [
   Param('seriesList', ParamTypes.seriesList, required=True),
@@ -1980,6 +2007,7 @@ def movingSum(requestContext, seriesList, windowSize, xFilesFactor=None):
   return movingWindow(requestContext, seriesList, windowSize, 'sum', xFilesFactor)
 
 
+movingSum.prefetchContexts = _windowPreviewContexts
 movingSum.group = 'Calculate'
 movingSum.params = [
   Param('seriesList', ParamTypes.seriesList, required=True),
@@ -2010,6 +2038,7 @@ def movingMin(requestContext, seriesList, windowSize, xFilesFactor=None):
   return movingWindow(requestContext, seriesList, windowSize, 'min', xFilesFactor)
 
 
+movingMin.prefetchContexts = _windowPreviewContexts
 movingMin.group = 'Calculate'
 movingMin.params = [
   Param('seriesList', ParamTypes.seriesList, required=True),
@@ -2040,6 +2069,7 @@ def movingMax(requestContext, seriesList, windowSize, xFilesFactor=None):
   return movingWindow(requestContext, seriesList, windowSize, 'max', xFilesFactor)
 
 
+movingMax.prefetchContexts = _windowPreviewContexts
 movingMax.group = 'Calculate'
 movingMax.params = [
   Param('seriesList', ParamTypes.seriesList, required=True),
@@ -2602,7 +2632,6 @@ def aliasQuery(requestContext, seriesList, search, replace, newName):
   for series in seriesList:
     newQuery = re.sub(search, replace, series.name)
     newContext = requestContext.copy()
-    newContext['prefetch'] = {}
     newSeriesList = evaluateTarget(newContext, newQuery)
     if newSeriesList is None or len(newSeriesList) == 0:
       raise InputParameterError('No series found with query: ' + newQuery)
@@ -4005,7 +4034,15 @@ def holtWintersDeviation(gamma,actual,prediction,last_seasonal_dev):
   return gamma * math.fabs(actual - prediction) + (1 - gamma) * last_seasonal_dev
 
 
-def holtWintersAnalysis(series, seasonality='1d'):
+def holtWintersAnalysis(series, seasonality='1d', state=None, checkpoint=None):
+  """
+  Performs a Holt-Winters analysis of the series.
+
+  The analysis continues from the model ``state`` of an earlier analysis if
+  given, as if the points of the series followed the points it was computed
+  from. If ``checkpoint`` is the index of a point of the series, the state of
+  the model before that point is returned as ``checkpoint`` in the results.
+  """
   alpha = gamma = 0.1
   beta = 0.0035
   seasonality_time = parseTimeOffset(seasonality)
@@ -4013,32 +4050,41 @@ def holtWintersAnalysis(series, seasonality='1d'):
   # season_length should be 2 or more
   if season_length < 2:
     season_length = 2
-  intercept = 0
-  slope = 0
+  if state is None:
+    state = {
+      'started': False,
+      'intercept': None,
+      'slope': 0,
+      'prediction': None,
+      'seasonals': [0] * season_length,
+      'deviations': [0] * season_length,
+    }
   intercepts = list()
   slopes = list()
   seasonals = list()
   predictions = list()
   deviations = list()
 
-  def getLastSeasonal(i):
-    j = i - season_length
-    if j >= 0:
-      return seasonals[j]
-    return 0
-
-  def getLastDeviation(i):
-    j = i - season_length
-    if j >= 0:
-      return deviations[j]
-    return 0
-
-  last_seasonal = 0
-  last_seasonal_dev = 0
-  next_last_seasonal = 0
-  next_pred = None
+  # the seasonals and deviations of the last season, 0 before the first point
+  last_seasonals = deque(state['seasonals'], season_length)
+  last_deviations = deque(state['deviations'], season_length)
+  started = state['started']
+  last_intercept = state['intercept']
+  last_slope = state['slope']
+  next_pred = state['prediction']
+  checkpoint_state = None
 
   for i,actual in enumerate(series):
+    if i == checkpoint:
+      checkpoint_state = {
+        'started': started,
+        'intercept': last_intercept,
+        'slope': last_slope,
+        'prediction': next_pred,
+        'seasonals': list(last_seasonals),
+        'deviations': list(last_deviations),
+      }
+
     if actual is None:
       # missing input values break all the math
       # do the best we can and move on
@@ -4047,24 +4093,28 @@ def holtWintersAnalysis(series, seasonality='1d'):
       seasonals.append(0)
       predictions.append(next_pred)
       deviations.append(0)
+      last_seasonals.append(0)
+      last_deviations.append(0)
+      started = True
+      last_intercept = None
+      last_slope = 0
       next_pred = None
       continue
 
-    if i == 0:
+    if not started:
       last_intercept = actual
       last_slope = 0
       # seed the first prediction as the first actual
       prediction = actual
+      started = True
     else:
-      last_intercept = intercepts[-1]
-      last_slope = slopes[-1]
       if last_intercept is None:
         last_intercept = actual
       prediction = next_pred
 
-    last_seasonal = getLastSeasonal(i)
-    next_last_seasonal = getLastSeasonal(i+1)
-    last_seasonal_dev = getLastDeviation(i)
+    last_seasonal = last_seasonals[0]
+    next_last_seasonal = last_seasonals[1]
+    last_seasonal_dev = last_deviations[0]
 
     intercept = holtWintersIntercept(alpha,actual,last_seasonal
             ,last_intercept,last_slope)
@@ -4078,6 +4128,10 @@ def holtWintersAnalysis(series, seasonality='1d'):
     seasonals.append(seasonal)
     predictions.append(prediction)
     deviations.append(deviation)
+    last_seasonals.append(seasonal)
+    last_deviations.append(deviation)
+    last_intercept = intercept
+    last_slope = slope
 
   # make the new forecast series
   forecastTags = series.tags
@@ -4100,6 +4154,125 @@ def holtWintersAnalysis(series, seasonality='1d'):
       'slopes'     : slopes,
       'seasonals'  : seasonals,
   }
+  if checkpoint is not None:
+    results['checkpoint'] = checkpoint_state
+  return results
+
+
+def _holtWintersContexts(requestContext, seriesList, bootstrapInterval='7d', *args, **kwargs):
+  # Context the Holt-Winters functions evaluate their input in, it depends on
+  # the cached model states with HOLT_WINTERS_STATE_CACHE
+  if settings.HOLT_WINTERS_STATE_CACHE:
+    return []
+  bootstrap = parseTimeOffset(bootstrapInterval)
+  return [_previewContext(requestContext, bootstrap.seconds + (bootstrap.days * 86400))]
+
+
+def _holtWintersBandsContexts(requestContext, seriesList, delta=3, bootstrapInterval='7d', *args, **kwargs):
+  return _holtWintersContexts(requestContext, seriesList, bootstrapInterval)
+
+
+def _holtWintersStateKey(requestContext, name, seasonality):
+  seasonality_time = parseTimeOffset(seasonality)
+  return 'holtwinters:' + compactHash('%s:%d:%s:%s' % (
+    name, seasonality_time.seconds + (seasonality_time.days * 86400), bool(requestContext.get('localOnly')),
+    requestContext.get('fetchMaxStep')))
+
+
+def _holtWintersOffset(series, state):
+  # Index of the checkpoint of state in series, None if the series can't
+  # continue the model from there
+  if state['step'] != series.step:
+    return None
+  (offset, misaligned) = divmod(state['timestamp'] - series.start, series.step)
+  if misaligned or not 0 <= offset < len(series):
+    return None
+  return offset
+
+
+def _holtWintersBootstrap(requestContext, seriesList, bootstrapInterval='7d', seasonality='1d'):
+  # Returns (series, forecast, deviation) for each series of the input of a
+  # Holt-Winters function, evaluated with bootstrapInterval of history to
+  # bootstrap the model. The forecast and deviation cover the requested range.
+  #
+  # With HOLT_WINTERS_STATE_CACHE the model of each series is checkpointed at
+  # a multiple of HOLT_WINTERS_STATE_INTERVAL, and continued from there by the
+  # next requests, which then only fetch the points since the checkpoint.
+  # These are fetched with the step of the checkpoints as fetchMaxStep, so
+  # that storage reads them from the archive the bootstrapInterval was read
+  # from rather than from a finer one covering the shorter window.
+  bootstrap = parseTimeOffset(bootstrapInterval)
+  previewSeconds = bootstrap.seconds + (bootstrap.days * 86400)
+
+  states = {}
+  previewList = None
+  if settings.HOLT_WINTERS_STATE_CACHE:
+    (startTime, endTime, now) = timebounds(requestContext)
+    keys = dict((series.name, _holtWintersStateKey(requestContext, series.name, seasonality)) for series in seriesList)
+    cached = cache.get_many(list(keys.values()))
+    for series in seriesList:
+      state = cached.get(keys[series.name])
+      if state and startTime - previewSeconds <= state['timestamp'] <= startTime:
+        states[series.name] = state
+
+    steps = set(state['step'] for state in states.values())
+    if seriesList and len(states) == len(seriesList) and len(steps) == 1:
+      # fetch from the point before the earliest checkpoint instead
+      continuedSeconds = startTime - min(state['timestamp'] - state['step'] for state in states.values())
+      newContext = _previewContext(requestContext, continuedSeconds)
+      newContext['fetchMaxStep'] = steps.pop()
+      previewList = evaluateTarget(newContext, requestContext['args'][0])
+      if all(series.name in states and _holtWintersOffset(series, states[series.name]) is not None
+             for series in previewList):
+        previewSeconds = continuedSeconds
+      else:
+        previewList = None
+    if previewList is None:
+      states = {}
+
+  if previewList is None:
+    # ignore original data and pull new, including our preview
+    newContext = _previewContext(requestContext, previewSeconds)
+    previewList = evaluateTarget(newContext, requestContext['args'][0])
+
+  results = []
+  checkpoints = {}
+  for series in previewList:
+    # continue the cached model from its checkpoint
+    state = states.get(series.name)
+    offset = _holtWintersOffset(series, state) if state else 0
+    analysed = series
+    if offset:
+      analysed = series.copy(start=series.start + offset * series.step, values=series[offset:])
+
+    checkpoint = None
+    if settings.HOLT_WINTERS_STATE_CACHE:
+      # leave the points that may still change out of the checkpoint
+      timestamp = min(startTime, now - settings.HOLT_WINTERS_STATE_INTERVAL)
+      timestamp -= timestamp % settings.HOLT_WINTERS_STATE_INTERVAL
+      (checkpoint, misaligned) = divmod(timestamp - analysed.start, analysed.step)
+      if misaligned or not 0 <= checkpoint < len(analysed) or (state and state['timestamp'] >= timestamp):
+        checkpoint = None
+
+    analysis = holtWintersAnalysis(analysed, seasonality, state, checkpoint)
+    if checkpoint is not None:
+      analysis['checkpoint'].update(timestamp=timestamp, step=analysed.step)
+      checkpoints[_holtWintersStateKey(requestContext, series.name, seasonality)] = analysis['checkpoint']
+
+    windowPoints = max(0, previewSeconds // series.step - offset)
+    data = analysis['predictions']
+    forecast = TimeSeries(data.name, series.start + previewSeconds, data.end, data.step, data[windowPoints:], xFilesFactor=series.xFilesFactor)
+    forecast.pathExpression = data.pathExpression
+
+    data = analysis['deviations']
+    deviation = TimeSeries(data.name, series.start + previewSeconds, data.end, data.step, data[windowPoints:], xFilesFactor=series.xFilesFactor)
+    deviation.pathExpression = data.pathExpression
+
+    results.append((series, forecast, deviation))
+
+  if checkpoints:
+    cache.set_many(checkpoints, settings.HOLT_WINTERS_STATE_CACHE_DURATION)
+
   return results
 
 
@@ -4108,28 +4281,18 @@ def holtWintersForecast(requestContext, seriesList, bootstrapInterval='7d', seas
   Performs a Holt-Winters forecast using the series as input data. Data from
   `bootstrapInterval` (one week by default) previous to the series is used to bootstrap the initial forecast.
   """
-  bootstrap = parseTimeOffset(bootstrapInterval)
-  previewSeconds = bootstrap.seconds + (bootstrap.days * 86400)
-
-  # ignore original data and pull new, including our preview
-  newContext = requestContext.copy()
-  newContext['prefetch'] = {}
-  newContext['startTime'] = requestContext['startTime'] -  timedelta(seconds=previewSeconds)
-  previewList = evaluateTarget(newContext, requestContext['args'][0])
   results = []
-  for series in previewList:
-    analysis = holtWintersAnalysis(series, seasonality)
-    predictions = analysis['predictions']
-    windowPoints = previewSeconds // predictions.step
+  for (series, forecast, deviation) in _holtWintersBootstrap(requestContext, seriesList, bootstrapInterval, seasonality):
     series.tags['holtWintersForecast'] = 1
     forecastName = "holtWintersForecast(%s)" % series.name
-    result = TimeSeries(forecastName, predictions.start + previewSeconds, predictions.end,
-                        predictions.step, predictions[windowPoints:], tags=series.tags,
+    result = TimeSeries(forecastName, forecast.start, forecast.end,
+                        forecast.step, forecast, tags=series.tags,
                         xFilesFactor=series.xFilesFactor)
     results.append(result)
   return results
 
 
+holtWintersForecast.prefetchContexts = _holtWintersContexts
 holtWintersForecast.group = 'Calculate'
 holtWintersForecast.params = [
   Param('seriesList', ParamTypes.seriesList, required=True),
@@ -4143,27 +4306,8 @@ def holtWintersConfidenceBands(requestContext, seriesList, delta=3, bootstrapInt
   Performs a Holt-Winters forecast using the series as input data and plots
   upper and lower bands with the predicted forecast deviations.
   """
-  bootstrap = parseTimeOffset(bootstrapInterval)
-  previewSeconds = bootstrap.seconds + (bootstrap.days * 86400)
-
-  # ignore original data and pull new, including our preview
-  newContext = requestContext.copy()
-  newContext['prefetch'] = {}
-  newContext['startTime'] = requestContext['startTime'] -  timedelta(seconds=previewSeconds)
-  previewList = evaluateTarget(newContext, requestContext['args'][0])
   results = []
-  for series in previewList:
-    analysis = holtWintersAnalysis(series, seasonality)
-    data = analysis['predictions']
-    windowPoints = previewSeconds // data.step
-    forecast = TimeSeries(data.name, data.start + previewSeconds, data.end, data.step, data[windowPoints:], xFilesFactor=series.xFilesFactor)
-    forecast.pathExpression = data.pathExpression
-
-    data = analysis['deviations']
-    windowPoints = previewSeconds // data.step
-    deviation = TimeSeries(data.name, data.start + previewSeconds, data.end, data.step, data[windowPoints:], xFilesFactor=series.xFilesFactor)
-    deviation.pathExpression = data.pathExpression
-
+  for (series, forecast, deviation) in _holtWintersBootstrap(requestContext, seriesList, bootstrapInterval, seasonality):
     seriesLength = len(forecast)
     i = 0
     upperBand = list()
@@ -4199,6 +4343,7 @@ def holtWintersConfidenceBands(requestContext, seriesList, delta=3, bootstrapInt
   return results
 
 
+holtWintersConfidenceBands.prefetchContexts = _holtWintersBandsContexts
 holtWintersConfidenceBands.group = 'Calculate'
 holtWintersConfidenceBands.params = [
   Param('seriesList', ParamTypes.seriesList, required=True),
@@ -4238,6 +4383,7 @@ def holtWintersAberration(requestContext, seriesList, delta=3, bootstrapInterval
   return results
 
 
+holtWintersAberration.prefetchContexts = _holtWintersBandsContexts
 holtWintersAberration.group = 'Calculate'
 holtWintersAberration.params = [
   Param('seriesList', ParamTypes.seriesList, required=True),
@@ -4263,6 +4409,7 @@ def holtWintersConfidenceArea(requestContext, seriesList, delta=3, bootstrapInte
   return results
 
 
+holtWintersConfidenceArea.prefetchContexts = _holtWintersBandsContexts
 holtWintersConfidenceArea.group = 'Calculate'
 holtWintersConfidenceArea.params = [
   Param('seriesList', ParamTypes.seriesList, required=True),
@@ -4290,6 +4437,13 @@ def _linearRegressionAnalysis(series):
     return factor, offset
 
 
+def _linearRegressionContexts(requestContext, seriesList, startSourceAt=None, endSourceAt=None):
+  sourceContext = requestContext.copy()
+  if startSourceAt is not None: sourceContext['startTime'] = parseATTime(startSourceAt)
+  if endSourceAt is not None: sourceContext['endTime'] = parseATTime(endSourceAt)
+  return [sourceContext]
+
+
 def linearRegression(requestContext, seriesList, startSourceAt=None, endSourceAt=None):
   """
   Graphs the linear regression function by least squares method.
@@ -4308,10 +4462,7 @@ def linearRegression(requestContext, seriesList, startSourceAt=None, endSourceAt
     &target=linearRegression(Server.instance*.threads.busy, "00:00 20140101","11:59 20140630")
   """
   results = []
-  sourceContext = requestContext.copy()
-  sourceContext['prefetch'] = {}
-  if startSourceAt is not None: sourceContext['startTime'] = parseATTime(startSourceAt)
-  if endSourceAt is not None: sourceContext['endTime'] = parseATTime(endSourceAt)
+  [sourceContext] = _linearRegressionContexts(requestContext, seriesList, startSourceAt, endSourceAt)
 
   sourceList = evaluateTarget(sourceContext, requestContext['args'][0])
 
@@ -4336,6 +4487,7 @@ def linearRegression(requestContext, seriesList, startSourceAt=None, endSourceAt
   return results
 
 
+linearRegression.prefetchContexts = _linearRegressionContexts
 linearRegression.group = 'Calculate'
 linearRegression.params = [
   Param('seriesList', ParamTypes.seriesList, required=True),
@@ -4431,6 +4583,22 @@ dashed.params = [
 ]
 
 
+def _timeStackContexts(requestContext, seriesList, timeShiftUnit='1d', timeShiftStart=0, timeShiftEnd=7):
+  # Default to negative. parseTimeOffset defaults to +
+  if timeShiftUnit[0].isdigit():
+    timeShiftUnit = '-' + timeShiftUnit
+  delta = parseTimeOffset(timeShiftUnit)
+
+  contexts = []
+  for shft in range(int(timeShiftStart), int(timeShiftEnd)):
+    myContext = requestContext.copy()
+    innerDelta = delta * shft
+    myContext['startTime'] = requestContext['startTime'] + innerDelta
+    myContext['endTime'] = requestContext['endTime'] + innerDelta
+    contexts.append(myContext)
+  return contexts
+
+
 def timeStack(requestContext, seriesList, timeShiftUnit='1d', timeShiftStart=0, timeShiftEnd=7):
   """
   Takes one metric or a wildcard seriesList, followed by a quoted string with the
@@ -4452,22 +4620,15 @@ def timeStack(requestContext, seriesList, timeShiftUnit='1d', timeShiftStart=0,
   # Default to negative. parseTimeOffset defaults to +
   if timeShiftUnit[0].isdigit():
     timeShiftUnit = '-' + timeShiftUnit
-  delta = parseTimeOffset(timeShiftUnit)
 
   if len(seriesList) < 1:
     return []
   series = seriesList[0]
 
   results = []
-  timeShiftStartint = int(timeShiftStart)
-  timeShiftEndint = int(timeShiftEnd)
+  contexts = _timeStackContexts(requestContext, seriesList, timeShiftUnit, timeShiftStart, timeShiftEnd)
 
-  for shft in range(timeShiftStartint,timeShiftEndint):
-    myContext = requestContext.copy()
-    myContext['prefetch'] = {}
-    innerDelta = delta * shft
-    myContext['startTime'] = requestContext['startTime'] + innerDelta
-    myContext['endTime'] = requestContext['endTime'] + innerDelta
+  for shft, myContext in zip(range(int(timeShiftStart), int(timeShiftEnd)), contexts):
     for shiftedSeries in evaluateTarget(myContext, requestContext['args'][0]):
       shiftedSeries.tags['timeShiftUnit'] = timeShiftUnit
       shiftedSeries.tags['timeShift'] = shft
@@ -4480,6 +4641,7 @@ def timeStack(requestContext, seriesList, timeShiftUnit='1d', timeShiftStart=0,
   return results
 
 
+timeStack.prefetchContexts = _timeStackContexts
 timeStack.group = 'Transform'
 timeStack.params = [
   Param('seriesList', ParamTypes.seriesList, required=True),
@@ -4489,6 +4651,38 @@ timeStack.params = [
 ]
 
 
+def _timeShiftContexts(requestContext, seriesList, timeShift, resetEnd=True, alignDST=False):
+  # Default to negative. parseTimeOffset defaults to +
+  if timeShift[0].isdigit():
+    timeShift = '-' + timeShift
+  delta = parseTimeOffset(timeShift)
+  myContext = requestContext.copy()
+  myContext['startTime'] = requestContext['startTime'] + delta
+  myContext['endTime'] = requestContext['endTime'] + delta
+
+  if alignDST:
+    def localDST(dt):
+      return time.localtime(time.mktime(dt.timetuple())).tm_isdst
+
+    reqStartDST = localDST(requestContext['startTime'])
+    reqEndDST   = localDST(requestContext['endTime'])
+    myStartDST  = localDST(myContext['startTime'])
+    myEndDST    = localDST(myContext['endTime'])
+
+    dstOffset = timedelta(hours=0)
+    # If the requestContext is entirely in DST, and we are entirely NOT in DST
+    if ((reqStartDST and reqEndDST) and (not myStartDST and not myEndDST)):
+        dstOffset = timedelta(hours=1)
+    # Or if the requestContext is entirely NOT in DST, and we are entirely in DST
+    elif ((not reqStartDST and not reqEndDST) and (myStartDST and myEndDST)):
+        dstOffset = timedelta(hours=-1)
+    # Otherwise, we don't do anything, because it would be visually confusing
+    myContext['startTime'] += dstOffset
+    myContext['endTime'] += dstOffset
+
+  return [myContext]
+
+
 def timeShift(requestContext, seriesList, timeShift, resetEnd=True, alignDST=False):
   """
   Takes one metric or a wildcard seriesList, followed by a quoted string with the
@@ -4523,31 +4717,7 @@ def timeShift(requestContext, seriesList, timeShift, resetEnd=True, alignDST=Fal
   # Default to negative. parseTimeOffset defaults to +
   if timeShift[0].isdigit():
     timeShift = '-' + timeShift
-  delta = parseTimeOffset(timeShift)
-  myContext = requestContext.copy()
-  myContext['prefetch'] = {}
-  myContext['startTime'] = requestContext['startTime'] + delta
-  myContext['endTime'] = requestContext['endTime'] + delta
-
-  if alignDST:
-    def localDST(dt):
-      return time.localtime(time.mktime(dt.timetuple())).tm_isdst
-
-    reqStartDST = localDST(requestContext['startTime'])
-    reqEndDST   = localDST(requestContext['endTime'])
-    myStartDST  = localDST(myContext['startTime'])
-    myEndDST    = localDST(myContext['endTime'])
-
-    dstOffset = timedelta(hours=0)
-    # If the requestContext is entirely in DST, and we are entirely NOT in DST
-    if ((reqStartDST and reqEndDST) and (not myStartDST and not myEndDST)):
-        dstOffset = timedelta(hours=1)
-    # Or if the requestContext is entirely NOT in DST, and we are entirely in DST
-    elif ((not reqStartDST and not reqEndDST) and (myStartDST and myEndDST)):
-        dstOffset = timedelta(hours=-1)
-    # Otherwise, we don't do anything, because it would be visually confusing
-    myContext['startTime'] += dstOffset
-    myContext['endTime'] += dstOffset
+  [myContext] = _timeShiftContexts(requestContext, seriesList, timeShift, resetEnd, alignDST)
 
   results = []
   if len(seriesList) < 1:
@@ -4567,6 +4737,7 @@ def timeShift(requestContext, seriesList, timeShift, resetEnd=True, alignDST=Fal
   return results
 
 
+timeShift.prefetchContexts = _timeShiftContexts
 timeShift.group = 'Transform'
 timeShift.params = [
   Param('seriesList', ParamTypes.seriesList, required=True),
@@ -5115,7 +5286,6 @@ def applyByNode(requestContext, seriesList, nodeNum, templateFunction, newName=N
     prefixes.add(prefix)
   results = []
   newContext = requestContext.copy()
-  newContext['prefetch'] = {}
   for prefix in sorted(prefixes):
     for resultSeries in evaluateTarget(newContext, templateFunction.replace('%', prefix)):
       if newName:
@@ -5266,6 +5436,34 @@ grep.params = [
 ]
 
 
+def _smartSummarizeContexts(requestContext, seriesList, intervalString, func='sum', alignTo=None):
+  # Context of the evaluation of the input aligned according to interval unit
+  if alignTo is None or isinstance(alignTo, bool):
+    return []
+
+  alignToUnit = getUnitString(alignTo)
+  requestContext = requestContext.copy()
+  s = requestContext['startTime']
+  if alignToUnit == YEARS_STRING:
+    requestContext['startTime'] = datetime(s.year, 1, 1, tzinfo = s.tzinfo)
+  elif alignToUnit == MONTHS_STRING:
+    requestContext['startTime'] = datetime(s.year, s.month, 1, tzinfo = s.tzinfo)
+  elif alignToUnit == WEEKS_STRING:
+    isoWeekDayToAlignTo = 1 if alignTo[-1].isalpha() else int(alignTo[-1])
+    daysTosubtract = s.isoweekday() - isoWeekDayToAlignTo
+    if daysTosubtract < 0: daysTosubtract += 7
+    requestContext['startTime'] = datetime(s.year, s.month, s.day, tzinfo = s.tzinfo) - timedelta(days = daysTosubtract)
+  elif alignToUnit == DAYS_STRING:
+    requestContext['startTime'] = datetime(s.year, s.month, s.day, tzinfo = s.tzinfo)
+  elif alignToUnit == HOURS_STRING:
+    requestContext['startTime'] = datetime(s.year, s.month, s.day, s.hour, tzinfo = s.tzinfo)
+  elif alignToUnit == MINUTES_STRING:
+    requestContext['startTime'] = datetime(s.year, s.month, s.day, s.hour, s.minute, tzinfo = s.tzinfo)
+  elif alignToUnit == SECONDS_STRING:
+    requestContext['startTime'] = datetime(s.year, s.month, s.day, s.hour, s.minute, s.second, tzinfo = s.tzinfo)
+  return [requestContext]
+
+
 def smartSummarize(requestContext, seriesList, intervalString, func='sum', alignTo=None):
   """
   Smarter version of summarize.
@@ -5281,27 +5479,7 @@ def smartSummarize(requestContext, seriesList, intervalString, func='sum', align
   else:
     # Adjust the start time aligning it according to interval unit
     if alignTo is not None:
-      alignToUnit = getUnitString(alignTo)
-      requestContext = requestContext.copy()
-      requestContext['prefetch'] = {}
-      s = requestContext['startTime']
-      if alignToUnit == YEARS_STRING:
-          requestContext['startTime'] = datetime(s.year, 1, 1, tzinfo = s.tzinfo)
-      elif alignToUnit == MONTHS_STRING:
-          requestContext['startTime'] = datetime(s.year, s.month, 1, tzinfo = s.tzinfo)
-      elif alignToUnit == WEEKS_STRING:
-          isoWeekDayToAlignTo = 1 if alignTo[-1].isalpha() else int(alignTo[-1])
-          daysTosubtract = s.isoweekday() - isoWeekDayToAlignTo
-          if daysTosubtract < 0: daysTosubtract += 7
-          requestContext['startTime'] = datetime(s.year, s.month, s.day, tzinfo = s.tzinfo) - timedelta(days = daysTosubtract)
-      elif alignToUnit == DAYS_STRING:
-          requestContext['startTime'] = datetime(s.year, s.month, s.day, tzinfo = s.tzinfo)
-      elif alignToUnit == HOURS_STRING:
-          requestContext['startTime'] = datetime(s.year, s.month, s.day, s.hour, tzinfo = s.tzinfo)
-      elif alignToUnit == MINUTES_STRING:
-          requestContext['startTime'] = datetime(s.year, s.month, s.day, s.hour, s.minute, tzinfo = s.tzinfo)
-      elif alignToUnit == SECONDS_STRING:
-        requestContext['startTime'] = datetime(s.year, s.month, s.day, s.hour, s.minute, s.second, tzinfo = s.tzinfo)
+      [requestContext] = _smartSummarizeContexts(requestContext, seriesList, intervalString, func, alignTo)
 
       # Ignore the originally fetched data and pull new using the modified requestContext
       seriesList = evaluateTarget(requestContext, requestContext['args'][0])
@@ -5322,6 +5500,7 @@ def smartSummarize(requestContext, seriesList, intervalString, func='sum', align
   return results
 
 
+smartSummarize.prefetchContexts = _smartSummarizeContexts
 smartSummarize.group = 'Transform'
 smartSummarize.params = [
   Param('seriesList', ParamTypes.seriesList, required=True),
@@ -5442,6 +5621,24 @@ def _summarizeValues(series, func, interval, newStart=None, newEnd=None):
   return (newValues, timestamp_)
 
 
+def _hitcountContexts(requestContext, seriesList, intervalString, alignToInterval = False):
+  # Context of the evaluation of the input aligned to the interval
+  if not alignToInterval:
+    return []
+
+  delta = parseTimeOffset(intervalString)
+  interval = int(delta.seconds + (delta.days * 86400))
+  requestContext = requestContext.copy()
+  s = requestContext['startTime']
+  if interval >= DAY:
+    requestContext['startTime'] = datetime(s.year, s.month, s.day, tzinfo = s.tzinfo)
+  elif interval >= HOUR:
+    requestContext['startTime'] = datetime(s.year, s.month, s.day, s.hour, tzinfo = s.tzinfo)
+  elif interval >= MINUTE:
+    requestContext['startTime'] = datetime(s.year, s.month, s.day, s.hour, s.minute, tzinfo = s.tzinfo)
+  return [requestContext]
+
+
 def hitcount(requestContext, seriesList, intervalString, alignToInterval = False):
   """
   Estimate hit counts from a list of time series.
@@ -5459,15 +5656,7 @@ def hitcount(requestContext, seriesList, intervalString, alignToInterval = False
   interval = int(delta.seconds + (delta.days * 86400))
 
   if alignToInterval:
-    requestContext = requestContext.copy()
-    requestContext['prefetch'] = {}
-    s = requestContext['startTime']
-    if interval >= DAY:
-      requestContext['startTime'] = datetime(s.year, s.month, s.day, tzinfo = s.tzinfo)
-    elif interval >= HOUR:
-      requestContext['startTime'] = datetime(s.year, s.month, s.day, s.hour, tzinfo = s.tzinfo)
-    elif interval >= MINUTE:
-      requestContext['startTime'] = datetime(s.year, s.month, s.day, s.hour, s.minute, tzinfo = s.tzinfo)
+    [requestContext] = _hitcountContexts(requestContext, seriesList, intervalString, alignToInterval)
 
     # Ignore the originally fetched data and pull new using
     # the modified requestContext.
@@ -5525,6 +5714,7 @@ def hitcount(requestContext, seriesList, intervalString, alignToInterval = False
   return results
 
 
+hitcount.prefetchContexts = _hitcountContexts
 hitcount.group = 'Transform'
 hitcount.params = [
   Param('seriesList', ParamTypes.seriesList, required=True),
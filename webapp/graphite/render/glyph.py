@@ -876,12 +876,15 @@ class Graph:
 
         for series in self.data:
           if 'stacked' not in series.options:
+            valuesPerPoint = series.valuesPerPoint
+            if series.pointsPerValue > 1:
+              valuesPerPoint /= series.pointsPerValue
             metaData['series'].append({
               'name': series.name,
               'start': series.start,
               'end': series.end,
               'step': series.step,
-              'valuesPerPoint': series.valuesPerPoint,
+              'valuesPerPoint': valuesPerPoint,
               'color': series.color,
               'data': series,
               'options': series.options
@@ -935,10 +938,12 @@ class LineGraph(Graph):
                   'yStepRight', 'rightWidth', 'rightColor', 'rightDashed',
                   'leftWidth', 'leftColor', 'leftDashed', 'xFormat', 'minorY',
                   'hideYAxis', 'uniqueLegend', 'vtitleRight', 'yDivisors',
-                  'connectedLimit', 'hideXAxis', 'hideNullFromLegend')
+                  'connectedLimit', 'hideXAxis', 'hideNullFromLegend',
+                  'downsample')
   validLineModes = ('staircase','slope','connected')
   validAreaModes = ('none','first','all','stacked')
   validPieModes = ('maximum', 'minimum', 'average')
+  validDownsampleModes = ('none', 'm4')
 
   def drawGraph(self,**params):
     # Make sure we've got datapoints to draw
@@ -1018,6 +1023,8 @@ class LineGraph(Graph):
     assert self.areaMode in self.validAreaModes, "Invalid area mode!"
     self.pieMode = params.get('pieMode', 'maximum').lower()
     assert self.pieMode in self.validPieModes, "Invalid pie mode!"
+    self.downsample = params.get('downsample', 'none').lower()
+    assert self.downsample in self.validDownsampleModes, "Invalid downsample mode!"
 
     # Line mode slope does not work (or even make sense) for series that have
     # only one datapoint. So if any series have one datapoint we force staircase mode.
@@ -1238,7 +1245,7 @@ class LineGraph(Graph):
         if 'stacked' in series.options:
           series.options['alpha'] = alpha
 
-          newSeries = TimeSeries(series.name, series.start, series.end, series.step*series.valuesPerPoint, [x for x in series])
+          newSeries = TimeSeries(series.name, series.start, series.end, series.step*series.valuesPerPoint/series.pointsPerValue, [x for x in series])
           newSeries.xStep = series.xStep
           newSeries.color = series.color
           if 'secondYAxis' in series.options:
@@ -1276,7 +1283,7 @@ class LineGraph(Graph):
       # Shift the beginning of drawing area to the start of the series if the
       # graph itself has a larger range
       missingPoints = (series.start - self.startTime) / series.step
-      startShift = series.xStep * (missingPoints / series.valuesPerPoint)
+      startShift = series.xStep * (missingPoints * series.pointsPerValue / series.valuesPerPoint)
       x = float(self.area['xmin']) + startShift + (self.lineWidth / 2.0)
       y = float(self.area['ymin'])
 
@@ -1428,8 +1435,19 @@ class LineGraph(Graph):
       if bestXStep < minXStep:
         drawableDataPoints = int( numberOfPixels / minXStep )
         pointsPerPixel = math.ceil( float(numberOfDataPoints) / float(drawableDataPoints) )
-        series.consolidate(pointsPerPixel)
-        series.xStep = (numberOfPixels * pointsPerPixel) / numberOfDataPoints
+        if self.downsample == 'm4':
+          # Draw the first, min, max and last values of each bucket rather than
+          # consolidating them, this keeps the peaks exact while still drawing
+          # at most 4 points per bucket. Smaller buckets are drawn as is.
+          if pointsPerPixel > 4:
+            series.consolidate(pointsPerPixel, downsample='m4')
+            series.xStep = (numberOfPixels * pointsPerPixel) / numberOfDataPoints / series.pointsPerValue
+          else:
+            series.consolidate(1)
+            series.xStep = bestXStep
+        else:
+          series.consolidate(pointsPerPixel)
+          series.xStep = (numberOfPixels * pointsPerPixel) / numberOfDataPoints
       else:
         series.xStep = bestXStep
 
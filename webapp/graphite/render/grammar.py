@@ -1,15 +1,46 @@
-from threading import Lock
+import importlib.util
 
-from graphite.render.grammar_unsafe import grammar as _grammar
+from functools import lru_cache
+from threading import local
+
+from django.conf import settings
 
 
 class ThreadSafeGrammar(object):
+    """Parses targets with a grammar of its own in each thread.
+
+    pyparsing grammars can't parse in several threads at once, so rather
+    than locking a single grammar, each thread builds its own from
+    graphite.render.grammar_unsafe the first time it parses.  The parsed
+    targets are kept in an LRU cache of TARGET_PARSE_CACHE_SIZE targets,
+    they are shared and must not be modified.
+    """
+
     def __init__(self):
-        self._lock = Lock()
+        self._local = local()
+        self._cache = None
+
+    def _grammar(self):
+        grammar = getattr(self._local, 'grammar', None)
+        if grammar is None:
+            spec = importlib.util.find_spec('graphite.render.grammar_unsafe')
+            module = importlib.util.module_from_spec(spec)
+            spec.loader.exec_module(module)
+            grammar = self._local.grammar = module.grammar
+        return grammar
+
+    def _parseString(self, instring):
+        return self._grammar().parseString(instring)
 
     def parseString(self, instring):
-        with self._lock:
-            return _grammar.parseString(instring)
+        size = settings.TARGET_PARSE_CACHE_SIZE
+        if not size:
+            return self._parseString(instring)
+
+        cache = self._cache
+        if cache is None or cache.cache_info().maxsize != size:
+            cache = self._cache = lru_cache(maxsize=size)(self._parseString)
+        return cache(instring)
 
 
 grammar = ThreadSafeGrammar()
@@ -62,11 +62,13 @@ def hashRequest(request):
     return compactHash(normalizedParams)
 
 
-def hashData(targets, startTime, endTime, xFilesFactor):
+def hashData(targets, startTime, endTime, xFilesFactor, fetchMaxStep=None):
     targetsString = ','.join(sorted(targets))
     startTimeString = startTime.strftime("%Y%m%d_%H%M")
     endTimeString = endTime.strftime("%Y%m%d_%H%M")
     myHash = targetsString + '@' + startTimeString + ':' + endTimeString + ':' + str(xFilesFactor)
+    if fetchMaxStep:
+        myHash += ':' + str(fetchMaxStep)
     return compactHash(myHash)
 
 
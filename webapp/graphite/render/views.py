@@ -15,26 +15,29 @@ import csv
 import math
 import pytz
 import six.moves.http_client
+import struct
 
 from datetime import datetime
 from time import time
 from random import shuffle
 from six.moves.urllib.parse import urlencode, urlsplit, urlunsplit, parse_qs
 
+from graphite import columnar
+from graphite.coalesce import coalesce_render
 from graphite.compat import HttpResponse
 from graphite.errors import InputParameterError, handleInputParameterError
 from graphite.user_util import getProfileByUsername
-from graphite.util import json, unpickle, pickle, msgpack, BytesIO
+from graphite.util import json, unpickle, pickle, msgpack, BytesIO, timebounds
 from graphite.storage import extractForwardHeaders
 from graphite.logger import log
-from graphite.render.evaluator import evaluateTarget
+from graphite.render.evaluator import Plan, evaluateTarget, extractPathExpressions, needsRawPoints
 from graphite.render.attime import parseATTime
 from graphite.functions import loadFunctions, PieFunction
 from graphite.render.hashing import hashRequest, hashData
 from graphite.render.glyph import GraphTypes
 from graphite.tags.models import Series, Tag, TagValue, SeriesTag  # noqa # pylint: disable=unused-import
 
-from django.http import HttpResponseServerError, HttpResponseRedirect
+from django.http import HttpResponseServerError, HttpResponseRedirect, StreamingHttpResponse
 from django.template import Context, loader
 from django.core.cache import cache
 from django.core.exceptions import ObjectDoesNotExist
@@ -47,6 +50,7 @@ loadFunctions()
 
 
 @handleInputParameterError
+@coalesce_render(hashRequest)
 def renderView(request):
   start = time()
 
@@ -78,6 +82,16 @@ def renderView(request):
   }
   data = requestContext['data']
 
+  # Let storage return coarser data if nothing needs the raw points
+  pushdown = settings.RENDER_PUSHDOWN_MAX_DATA_POINTS and requestOptions['graphType'] == 'line'
+  if pushdown and not needsRawPoints(requestOptions['targets']):
+    fetchMaxStep = _fetchMaxStep(requestContext)
+    if fetchMaxStep:
+      requestContext['fetchMaxStep'] = fetchMaxStep
+
+  if requestOptions.get('explain'):
+    return renderViewExplain(requestOptions, requestContext)
+
   response = None
 
   # First we check the request cache
@@ -115,7 +129,8 @@ def renderView(request):
       targets = requestOptions['targets']
       startTime = requestOptions['startTime']
       endTime = requestOptions['endTime']
-      dataKey = hashData(targets, startTime, endTime, requestOptions['xFilesFactor'])
+      dataKey = hashData(targets, startTime, endTime, requestOptions['xFilesFactor'],
+                         requestContext.get('fetchMaxStep'))
       cachedData = cache.get(dataKey)
       if cachedData:
         log.cache("Data-Cache hit [%s]" % dataKey)
@@ -149,6 +164,8 @@ def renderView(request):
       response = renderViewPickle(requestOptions, data)
     elif format == 'msgpack':
       response = renderViewMsgPack(requestOptions, data)
+    elif format == 'columnar':
+      response = renderViewColumnar(requestOptions, data)
 
   # if response wasn't generated above, render a graph image
   if not response:
@@ -157,7 +174,9 @@ def renderView(request):
     response = renderViewGraph(graphOptions, requestOptions, data)
 
   if useCache:
-    cache.add(requestKey, response, cacheTimeout)
+    # streaming responses are generated as they are sent and can't be cached
+    if not response.streaming:
+      cache.add(requestKey, response, cacheTimeout)
     patch_response_headers(response, cache_timeout=cacheTimeout)
   else:
     add_never_cache_headers(response)
@@ -168,6 +187,18 @@ def renderView(request):
   return response
 
 
+def _fetchMaxStep(requestContext):
+  """The coarsest step storage can return to satisfy maxDataPoints and maxStep"""
+  steps = []
+  if requestContext.get('maxDataPoints'):
+    (startTime, endTime, now) = timebounds(requestContext)
+    # keep at least maxDataPoints points, renderViewJson consolidates the rest
+    steps.append((endTime - startTime) // requestContext['maxDataPoints'])
+  if requestContext.get('maxStep'):
+    steps.append(requestContext['maxStep'])
+  return min(steps) if steps else None
+
+
 def renderViewGraph(graphOptions, requestOptions, data):
   # We've got the data, now to render it
   graphOptions['data'] = data
@@ -191,58 +222,35 @@ def renderViewGraph(graphOptions, requestOptions, data):
 
 
 def renderViewCsv(requestOptions, data):
+  if settings.RENDER_STREAMING:
+    writer = csv.writer(_Echo(), dialect='excel')
+    chunks = (writer.writerow(row) for row in _csvRows(requestOptions, data))
+    return StreamingHttpResponse(_chunked(chunks, ''), content_type='text/csv')
+
   response = HttpResponse(content_type='text/csv')
   writer = csv.writer(response, dialect='excel')
+  writer.writerows(_csvRows(requestOptions, data))
+
+  return response
 
+
+def _csvRows(requestOptions, data):
   for series in data:
     for i, value in enumerate(series):
       timestamp = datetime.fromtimestamp(series.start + (i * series.step), requestOptions['tzinfo'])
-      writer.writerow((series.name, timestamp.strftime("%Y-%m-%d %H:%M:%S"), value))
-
-  return response
+      yield (series.name, timestamp.strftime("%Y-%m-%d %H:%M:%S"), value)
 
 
 def renderViewJson(requestOptions, data):
-  series_data = []
-
-  if any(data):
-    startTime = min([series.start for series in data])
-    endTime = max([series.end for series in data])
-    timeRange = endTime - startTime
+  if settings.RENDER_STREAMING:
+    chunks = _streamJson(requestOptions, _jsonSeries(requestOptions, data))
+    if 'jsonp' in requestOptions:
+      chunks = _wrapJsonp(requestOptions['jsonp'], chunks)
+      return StreamingHttpResponse(_chunked(chunks, ''), content_type='text/javascript')
+    return StreamingHttpResponse(_chunked(chunks, ''), content_type='application/json')
 
-    for series in data:
-      if 'maxDataPoints' in requestOptions:
-        maxDataPoints = requestOptions['maxDataPoints']
-        if maxDataPoints == 1:
-          series.consolidate(len(series))
-        else:
-          numberOfDataPoints = timeRange/series.step
-          if maxDataPoints < numberOfDataPoints:
-            valuesPerPoint = math.ceil(float(numberOfDataPoints) / float(maxDataPoints))
-            secondsPerPoint = int(valuesPerPoint * series.step)
-            # Nudge start over a little bit so that the consolidation bands align with each call
-            # removing 'jitter' seen when refreshing.
-            nudge = secondsPerPoint + (series.start % series.step) - (series.start % secondsPerPoint)
-            series.start = series.start + nudge
-            valuesToLose = int(nudge/series.step)
-            for r in range(1, valuesToLose):
-              del series[0]
-            series.consolidate(valuesPerPoint)
-
-      datapoints = series.datapoints()
-
-      if 'noNullPoints' in requestOptions:
-        datapoints = [
-          point for point in datapoints
-          if point[0] is not None and not math.isnan(point[0])
-        ]
-        if not datapoints:
-          continue
-
-      series_data.append(dict(target=series.name, tags=dict(series.tags), datapoints=datapoints))
-
-  output = json.dumps(series_data, indent=(2 if requestOptions.get('pretty') else None)) \
-      .replace('NaN,', 'null,').replace('Infinity,', '1e9999,')
+  series_data = list(_jsonSeries(requestOptions, data))
+  output = _jsonEncode(series_data, requestOptions.get('pretty'))
 
   if 'jsonp' in requestOptions:
     response = HttpResponse(
@@ -256,6 +264,98 @@ def renderViewJson(requestOptions, data):
   return response
 
 
+def renderViewExplain(requestOptions, requestContext):
+  """Return the evaluation plan of the targets instead of evaluating them"""
+  plan = Plan(requestContext, requestOptions['targets'])
+  explain = plan.explain()
+  windows = {}
+  explain['pathExpressions'] = sorted(extractPathExpressions(requestContext, requestOptions['targets'], windows))
+  explain['windows'] = [
+    {'from': bounds[0], 'until': bounds[1], 'pathExpressions': sorted(windows[bounds][1])}
+    for bounds in sorted(windows)
+  ]
+  explain['shareSubexpressions'] = settings.RENDER_SHARE_SUBEXPRESSIONS
+  explain['prefetchWindows'] = settings.RENDER_PREFETCH_WINDOWS
+
+  response = HttpResponse(
+    content=_jsonEncode(explain, requestOptions.get('pretty')),
+    content_type='application/json')
+  add_never_cache_headers(response)
+  return response
+
+
+def _jsonSeries(requestOptions, data):
+  if not any(data):
+    return
+
+  startTime = min([series.start for series in data])
+  endTime = max([series.end for series in data])
+  timeRange = endTime - startTime
+
+  for series in data:
+    if 'maxDataPoints' in requestOptions:
+      maxDataPoints = requestOptions['maxDataPoints']
+      if maxDataPoints == 1:
+        series.consolidate(len(series))
+      else:
+        numberOfDataPoints = timeRange/series.step
+        if maxDataPoints < numberOfDataPoints:
+          valuesPerPoint = math.ceil(float(numberOfDataPoints) / float(maxDataPoints))
+          secondsPerPoint = int(valuesPerPoint * series.step)
+          # Nudge start over a little bit so that the consolidation bands align with each call
+          # removing 'jitter' seen when refreshing.
+          nudge = secondsPerPoint + (series.start % series.step) - (series.start % secondsPerPoint)
+          series.start = series.start + nudge
+          valuesToLose = int(nudge/series.step)
+          for r in range(1, valuesToLose):
+            del series[0]
+          series.consolidate(valuesPerPoint)
+
+    datapoints = series.datapoints()
+
+    if 'noNullPoints' in requestOptions:
+      datapoints = [
+        point for point in datapoints
+        if point[0] is not None and not math.isnan(point[0])
+      ]
+      if not datapoints:
+        continue
+
+    yield dict(target=series.name, tags=dict(series.tags), datapoints=datapoints)
+
+
+def _jsonEncode(obj, pretty):
+  return json.dumps(obj, indent=(2 if pretty else None)) \
+      .replace('NaN,', 'null,').replace('Infinity,', '1e9999,')
+
+
+def _streamJson(requestOptions, series_data):
+  """Encode a list of series one at a time, like _jsonEncode() would encode the whole list"""
+  pretty = requestOptions.get('pretty')
+  separator = '[\n  ' if pretty else '['
+  empty = True
+
+  for item in series_data:
+    output = _jsonEncode(item, pretty)
+    if pretty:
+      output = output.replace('\n', '\n  ')
+    yield separator + output
+    separator = ',\n  ' if pretty else ', '
+    empty = False
+
+  if empty:
+    yield '[]'
+  else:
+    yield '\n]' if pretty else ']'
+
+
+def _wrapJsonp(jsonp, chunks):
+  yield '%s(' % jsonp
+  for chunk in chunks:
+    yield chunk
+  yield ')'
+
+
 def renderViewDygraph(requestOptions, data):
   labels = ['Time']
   output = '{}'
@@ -322,19 +422,82 @@ def renderViewRaw(requestOptions, data):
 
 
 def renderViewPickle(requestOptions, data):
+  if settings.RENDER_STREAMING:
+    return StreamingHttpResponse(_chunked(_streamPickle(data), b''), content_type='application/pickle')
+
   response = HttpResponse(content_type='application/pickle')
   seriesInfo = [series.getInfo() for series in data]
   pickle.dump(seriesInfo, response, protocol=-1)
   return response
 
 
+def _streamPickle(data):
+  """Pickle the list of series info one series at a time.
+
+  Protocol 2 pickles are not framed, so the pickle of each series (without
+  its PROTO and STOP opcodes) can be appended to a list built by hand.
+  """
+  yield pickle.PROTO + b'\x02' + pickle.EMPTY_LIST
+  if data:
+    yield pickle.MARK
+    for series in data:
+      yield pickle.dumps(series.getInfo(), protocol=2)[2:-1]
+    yield pickle.APPENDS
+  yield pickle.STOP
+
+
 def renderViewMsgPack(requestOptions, data):
+  if settings.RENDER_STREAMING:
+    return StreamingHttpResponse(_chunked(_streamMsgPack(data), b''), content_type='application/x-msgpack')
+
   response = HttpResponse(content_type='application/x-msgpack')
   seriesInfo = [series.getInfo() for series in data]
   msgpack.dump(seriesInfo, response, use_bin_type=True)
   return response
 
 
+def _streamMsgPack(data):
+  """Pack the list of series info one series at a time"""
+  if len(data) < 16:
+    yield struct.pack('B', 0x90 | len(data))
+  elif len(data) < 2**16:
+    yield b'\xdc' + struct.pack('>H', len(data))
+  else:
+    yield b'\xdd' + struct.pack('>I', len(data))
+  for series in data:
+    yield msgpack.packb(series.getInfo(), use_bin_type=True)
+
+
+def renderViewColumnar(requestOptions, data):
+  compress = settings.RENDER_COLUMNAR_COMPRESSION
+  if settings.RENDER_STREAMING:
+    return StreamingHttpResponse(
+      _chunked(columnar.iterdump(data, compress), b''), content_type=columnar.CONTENT_TYPE)
+
+  return HttpResponse(columnar.dumps(data, compress), content_type=columnar.CONTENT_TYPE)
+
+
+class _Echo(object):
+  """File-like object returning what is written to it, to stream from csv.writer"""
+  def write(self, value):
+    return value
+
+
+def _chunked(pieces, joiner, size=65536):
+  """Join the pieces of a streamed response into chunks of about size bytes"""
+  buffered = []
+  length = 0
+  for piece in pieces:
+    buffered.append(piece)
+    length += len(piece)
+    if length >= size:
+      yield joiner.join(buffered)
+      buffered = []
+      length = 0
+  if buffered:
+    yield joiner.join(buffered)
+
+
 def parseOptions(request):
   queryParams = request.GET.copy()
   queryParams.update(request.POST)
@@ -388,6 +551,7 @@ def parseOptions(request):
       requestOptions['jsonp'] = queryParams['jsonp']
 
   requestOptions['pretty'] = bool(queryParams.get('pretty'))
+  requestOptions['explain'] = bool(queryParams.get('explain'))
 
   if 'noCache' in queryParams:
     requestOptions['noCache'] = True
@@ -58,6 +58,11 @@ WHISPER_DIR = ''
 RRD_DIR = ''
 STANDARD_DIRS = []
 
+# Read whisper files through mmap, keeping the parsed headers of up to
+# WHISPER_HEADER_CACHE_SIZE files in memory
+WHISPER_MMAP = False
+WHISPER_HEADER_CACHE_SIZE = 10000
+
 # Timeout settings
 FIND_TIMEOUT = None  # default 3.0 see below
 FETCH_TIMEOUT = None  # default 6.0 see below
@@ -68,6 +73,13 @@ CLUSTER_SERVERS = []
 # Worker Pool
 USE_WORKER_POOL = True
 POOL_MAX_WORKERS = 10
+# Read the files of a local fetch in parallel (0 disables)
+FETCH_POOL_MAX_WORKERS = 0
+FETCH_POOL_MAX_WORKERS_PER_REQUEST = 4
+
+# Keep an in-memory index of STANDARD_DIRS for StandardFinder
+STANDARD_FINDER_INDEX = False
+STANDARD_FINDER_INDEX_REFRESH_INTERVAL = 60
 
 # This settings control whether https is used to communicate between cluster members
 INTRACLUSTER_HTTPS = False
@@ -80,6 +92,19 @@ REMOTE_STORE_MERGE_RESULTS = True
 REMOTE_STORE_FORWARD_HEADERS = []
 REMOTE_STORE_USE_POST = False
 REMOTE_BUFFER_SIZE = 1024 * 1024 # Set to 0 to prevent streaming deserialization
+REMOTE_POOL_MAXSIZE = 5
+# Send a hedged request to a cluster server slower than its usual latency
+REMOTE_HEDGE_REQUESTS = False
+REMOTE_HEDGE_PERCENTILE = 95
+REMOTE_HEDGE_MIN_DELAY = 0.1
+REMOTE_HEDGE_BUDGET = 0.05
+# Retry failed cluster servers after an exponential backoff
+REMOTE_CIRCUIT_BREAKER = False
+REMOTE_CIRCUIT_BREAKER_MIN_DELAY = 1.0
+# Time out requests to cluster servers based on their usual latency
+REMOTE_ADAPTIVE_TIMEOUT = False
+REMOTE_ADAPTIVE_TIMEOUT_FACTOR = 3.0
+REMOTE_ADAPTIVE_TIMEOUT_MIN = 1.0
 
 # Carbonlink settings
 CARBON_METRIC_PREFIX='carbon'
@@ -89,6 +114,8 @@ CARBONLINK_HASHING_KEYFUNC = None
 CARBONLINK_HASHING_TYPE = 'carbon_ch'
 CARBONLINK_RETRY_DELAY = 15
 CARBONLINK_PICKLE_PROTOCOL = -1
+CARBONLINK_QUERY_BULK = False
+CARBONLINK_QUERY_BULK_RETRY_DELAY = 3600
 REPLICATION_FACTOR = 1
 
 # Cache settings.
@@ -100,10 +127,63 @@ FIND_CACHE_DURATION = 300
 FIND_TOLERANCE = 2 * FIND_CACHE_DURATION
 DEFAULT_CACHE_DURATION = 60 #metric data and graphs are cached for one minute by default
 DEFAULT_CACHE_POLICY = []
+INCREMENTAL_DATA_CACHE = False
+INCREMENTAL_DATA_CACHE_DURATION = 3600
+INCREMENTAL_DATA_CACHE_OVERLAP = 120
+
+# Coalesce identical concurrent render requests and fetches
+COALESCE_REQUESTS = False
+COALESCE_REQUESTS_ACROSS_PROCESSES = False
+
+# Stale-while-revalidate cache of find and index results
+FIND_RESULT_CACHE = False
+FIND_RESULT_CACHE_DURATION = 60
+FIND_RESULT_CACHE_STALE = 300
+FIND_RESULT_CACHE_JITTER = 0.2
+FIND_RESULT_CACHE_FILE = ''
+FIND_RESULT_CACHE_FILE_SLOTS = 1024
+FIND_RESULT_CACHE_FILE_SLOT_SIZE = 65536
+
+# Stream csv, json, pickle, msgpack and columnar render responses series by series
+RENDER_STREAMING = False
+
+# zlib compress columnar render responses
+RENDER_COLUMNAR_COMPRESSION = False
+
+# Let storage return coarser data for render requests with maxDataPoints or
+# maxStep when none of their targets needs the raw points
+RENDER_PUSHDOWN_MAX_DATA_POINTS = False
+
+# Number of parsed render targets to cache, 0 to parse them every time
+TARGET_PARSE_CACHE_SIZE = 1000
+
+# Evaluate the function calls repeated within or across the targets of a
+# render request once
+RENDER_SHARE_SUBEXPRESSIONS = False
+
+# Fetch the other time windows functions like timeShift and movingAverage
+# evaluate their input in along with the request window
+RENDER_PREFETCH_WINDOWS = False
+
+# Evaluate the targets of a render request in parallel (0 disables), in at
+# most RENDER_POOL_MAX_WORKERS_PER_REQUEST threads per request, until the pool
+# threads used RENDER_POOL_CPU_TIME_PER_REQUEST seconds of CPU time for it
+RENDER_POOL_MAX_WORKERS = 0
+RENDER_POOL_MAX_WORKERS_PER_REQUEST = 4
+RENDER_POOL_CPU_TIME_PER_REQUEST = 0
+
+# Continue Holt-Winters models from states checkpointed in the cache every
+# HOLT_WINTERS_STATE_INTERVAL seconds instead of bootstrapping them each time
+HOLT_WINTERS_STATE_CACHE = False
+HOLT_WINTERS_STATE_INTERVAL = 3600
+HOLT_WINTERS_STATE_CACHE_DURATION = 86400
 
 # this setting controls the default xFilesFactor used for query-time aggregation
 DEFAULT_XFILES_FACTOR = 0
 
+# Use NumPy (if installed) for vectorized processing of series values
+USE_NUMPY = False
+
 # These can also be configured using:
 # https://docs.djangoproject.com/en/1.11/topics/logging/
 LOG_RENDERING_PERFORMANCE = False
@@ -158,6 +238,10 @@ TAGDB_REDIS_PORT = 6379
 TAGDB_REDIS_DB = 0
 TAGDB_REDIS_PASSWORD = ''
 
+TAGDB_MEMORY_SYNC_INTERVAL = 60
+TAGDB_MEMORY_SNAPSHOT = ''
+TAGDB_MEMORY_SNAPSHOT_INTERVAL = 3600
+
 TAGDB_HTTP_URL = ''
 TAGDB_HTTP_USER = ''
 TAGDB_HTTP_PASSWORD = ''
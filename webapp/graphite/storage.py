@@ -8,8 +8,10 @@ import types
 
 from collections import defaultdict
 from copy import deepcopy
+from functools import partial
 from shutil import move
 from tempfile import mkstemp
+from threading import Lock
 
 from django.conf import settings
 from django.core.cache import cache
@@ -20,14 +22,17 @@ try:
 except ImportError:  # python < 2.7 compatibility
     from django.utils.importlib import import_module
 
+from graphite.coalesce import SingleFlight
 from graphite.logger import log
 from graphite.errors import InputParameterError
+from graphite.findcache import dump_nodes, find_keys, get_find_cache, load_nodes
 from graphite.node import LeafNode
 from graphite.intervals import Interval, IntervalSet
 from graphite.finders.utils import FindQuery, BaseFinder
 from graphite.readers import MultiReader
 from graphite.worker_pool.pool import get_pool, pool_exec, Job, PoolTimeoutError
 from graphite.render.grammar import grammar
+from graphite.render.hashing import compactHash
 
 
 def get_finders(finder_path):
@@ -58,6 +63,15 @@ def get_tagdb(tagdb_path):
     return getattr(module, class_name)(settings, cache=cache, log=log)
 
 
+def _job_timeout(job, timeout):
+    """Return the adaptive timeout of the finder running a job"""
+    finder = getattr(job.func, '__self__', None)
+    if not hasattr(finder, 'adaptive_timeout'):
+        return timeout
+    operation = 'fetch' if job.func.__name__ == 'fetch' else 'find'
+    return finder.adaptive_timeout(timeout, operation)
+
+
 class Store(object):
     def __init__(self, finders=None, tagdb=None):
         if finders is None:
@@ -71,19 +85,31 @@ class Store(object):
             tagdb = get_tagdb(settings.TAGDB or 'graphite.tags.base.DummyTagDB')
         self.tagdb = tagdb
 
+        self.fetches = SingleFlight('fetch')
+
+        self._find_cache = None
+        self._find_cache_lock = Lock()
+
+    @property
+    def find_cache(self):
+        with self._find_cache_lock:
+            if self._find_cache is None:
+                self._find_cache = get_find_cache()
+        return self._find_cache
+
     def get_finders(self, local=False):
         for finder in self.finders:
-            # Support legacy finders by defaulting to 'disabled = False'
-            if getattr(finder, 'disabled', False):
-                continue
-
             # Support legacy finders by defaulting to 'local = True'
             if local and not getattr(finder, 'local', True):
                 continue
 
+            # Support legacy finders by defaulting to 'disabled = False'
+            if getattr(finder, 'disabled', False):
+                continue
+
             yield finder
 
-    def pool_exec(self, jobs, timeout):
+    def pool_exec(self, jobs, timeout, job_timeout=None):
         if not jobs:
             return []
 
@@ -91,18 +117,26 @@ class Store(object):
         if settings.USE_WORKER_POOL:
             thread_count = min(len(self.finders), settings.POOL_MAX_WORKERS)
 
+        if job_timeout is not None:
+            return pool_exec(get_pool('finders', thread_count), jobs, timeout, job_timeout)
         return pool_exec(get_pool('finders', thread_count), jobs, timeout)
 
     def wait_jobs(self, jobs, timeout, context):
         if not jobs:
             return []
 
+        job_timeout = None
+        if settings.REMOTE_ADAPTIVE_TIMEOUT:
+            # don't wait for each cluster server beyond the time it usually
+            # takes to respond, while waiting for the other finders
+            job_timeout = partial(_job_timeout, timeout=timeout)
+
         start = time.time()
         results = []
         failed = []
         done = 0
         try:
-            for job in self.pool_exec(jobs, timeout):
+            for job in self.pool_exec(jobs, timeout, job_timeout):
                 elapsed = time.time() - start
                 done += 1
                 if job.exception:
@@ -152,6 +186,19 @@ class Store(object):
         if not patterns:
             return []
 
+        if settings.COALESCE_REQUESTS:
+            # requests forwarding different headers may not see the same data
+            headers = tuple(sorted((requestContext.get('forwardHeaders') or {}).items()))
+            key = (tuple(patterns), startTime, endTime, now, bool(requestContext.get('localOnly')),
+                   requestContext.get('fetchMaxStep'), headers)
+            (results, shared) = self.fetches.do(
+                key, self._fetch, patterns, startTime, endTime, now, requestContext)
+            # the results are shared with other callers, don't let them see changes to the list
+            return list(results) if shared else results
+
+        return self._fetch(patterns, startTime, endTime, now, requestContext)
+
+    def _fetch(self, patterns, startTime, endTime, now, requestContext):
         log.debug(
             'graphite.storage.Store.fetch :: Starting fetch on all backends')
 
@@ -234,6 +281,14 @@ class Store(object):
         if not requestContext:
             requestContext = {}
 
+        if not settings.FIND_RESULT_CACHE:
+            return self._get_index(requestContext)
+
+        headers = sorted((requestContext.get('forwardHeaders') or {}).items())
+        key = 'find-index:%s' % compactHash(repr((bool(requestContext.get('localOnly')), headers)))
+        return self.find_cache.get(key, lambda: self._get_index(requestContext))
+
+    def _get_index(self, requestContext):
         context = 'get_index'
         jobs = [
             Job(finder.get_index, context, requestContext=requestContext)
@@ -282,6 +337,14 @@ class Store(object):
                      pattern, matched_leafs, warn_threshold))
 
     def _find(self, query):
+        if not settings.FIND_RESULT_CACHE:
+            return self._find_nodes(query)
+
+        (key, fallback_keys) = find_keys(query)
+        infos = self.find_cache.get(key, lambda: dump_nodes(self._find_nodes(query)), fallback_keys)
+        return load_nodes(self, query, infos)
+
+    def _find_nodes(self, query):
         context = 'find %s' % query
         jobs = [
             Job(finder.find_nodes, context, query)
@@ -137,8 +137,10 @@ class LocalDatabaseTagDB(BaseTagDB):
             cursor.execute(sql, params)
 
             series_id = None
+            tags = {}
 
-            tags = {tag: value for (series_id, tag, value) in cursor}
+            for (series_id, tag, value) in cursor:
+                tags[tag] = value
 
             if not tags:
                 return None
@@ -0,0 +1,382 @@
+"""TagDB keeping an inverted index of the local database tags in memory"""
+import os
+import pickle
+import re
+import time
+
+from array import array
+from bisect import bisect_left
+from itertools import chain
+from tempfile import mkstemp
+from threading import Lock, RLock
+
+from django.db import connection
+
+from graphite.tags.localdatabase import LocalDatabaseTagDB
+from graphite.tags.utils import TaggedSeries
+
+
+class TagIndex(object):
+    """Inverted index of tagged series.
+
+    ``postings`` maps each tag to a dict mapping each of its values to the
+    sorted array of the ids of the series with that tag value.  ``paths``
+    maps the ids of the series to their paths, ``ids`` the other way around.
+    """
+
+    def __init__(self):
+        self.postings = {}
+        self.paths = {}
+        self.ids = {}
+        self.max_id = 0
+
+    def add(self, series_id, path, tags):
+        if series_id in self.paths:
+            self.remove(series_id)
+
+        self.paths[series_id] = path
+        self.ids[path] = series_id
+        self.max_id = max(self.max_id, series_id)
+
+        for tag, value in tags.items():
+            postings = self.postings.setdefault(tag, {}).setdefault(value, array('L'))
+            if not postings or postings[-1] < series_id:
+                postings.append(series_id)
+            else:
+                postings.insert(bisect_left(postings, series_id), series_id)
+
+    def remove(self, series_id):
+        path = self.paths.pop(series_id, None)
+        if path is None:
+            return
+        del self.ids[path]
+
+        for tag, value in TaggedSeries.parse(path).tags.items():
+            values = self.postings.get(tag, {})
+            postings = values.get(value)
+            if postings is None:
+                continue
+            i = bisect_left(postings, series_id)
+            if i < len(postings) and postings[i] == series_id:
+                del postings[i]
+            if not postings:
+                del values[value]
+            if not values:
+                del self.postings[tag]
+
+
+def _matcher(operator, spec):
+    """Return (matches_empty, match) for a tagspec, match(value) is True if value matches"""
+    if operator == '=':
+        return spec == '', lambda value: value == spec
+
+    if operator == '!=':
+        return spec != '', lambda value: value != spec
+
+    if operator in ('=~', '!=~'):
+        # make sure regex is anchored
+        if not spec.startswith('^'):
+            spec = '^(' + spec + ')'
+        pattern = re.compile(spec)
+        if operator == '=~':
+            return bool(pattern.match('')), lambda value: pattern.match(value) is not None
+        return not pattern.match(''), lambda value: pattern.match(value) is None
+
+    raise ValueError("Invalid operator %s" % operator)
+
+
+def _contains(postings, series_id):
+    i = bisect_left(postings, series_id)
+    return i < len(postings) and postings[i] == series_id
+
+
+class MemoryTagDB(LocalDatabaseTagDB):
+    """
+    Stores tag information in the local database like LocalDatabaseTagDB, and
+    answers queries from an inverted index of it kept in memory.
+
+    The index is loaded when first used, from the snapshot file in
+    TAGDB_MEMORY_SNAPSHOT if there is one, and synced with the database every
+    TAGDB_MEMORY_SYNC_INTERVAL seconds: the series added since the last sync
+    are loaded, and the whole index is loaded again if series were deleted.
+    Series tagged or deleted through this TagDB are indexed right away.
+
+    Whole indexes are built and saved to the snapshot before they replace the
+    current one, so queries only wait for the swap.  Once it is out of date,
+    the snapshot is saved again at most every TAGDB_MEMORY_SNAPSHOT_INTERVAL
+    seconds, by loading the whole index again.
+    """
+
+    def __init__(self, settings, *args, **kwargs):
+        super(MemoryTagDB, self).__init__(settings, *args, **kwargs)
+        self.index = None
+        self.last_sync = None
+        self.last_snapshot = None
+        self.snapshot_stale = False
+        self.lock = RLock()
+        self.sync_lock = Lock()
+
+    def sync(self, force=False):
+        """Sync the index with the database if it is out of date.
+
+        The first sync blocks until the index is loaded, later syncs run in
+        at most one thread while others keep using the current index.
+        """
+        interval = self.settings.TAGDB_MEMORY_SYNC_INTERVAL
+        if not force and self.last_sync is not None and time.time() - self.last_sync < interval:
+            return
+
+        if not self.sync_lock.acquire(self.last_sync is None):
+            return
+        try:
+            if force or self.last_sync is None or time.time() - self.last_sync >= interval:
+                start = time.time()
+                self._sync()
+                self.last_sync = time.time()
+                self.log_info('sync', 'completed in {sec:.6}s'.format(sec=self.last_sync - start))
+        finally:
+            self.sync_lock.release()
+
+    def _sync(self):
+        if self.index is None:
+            index = self._load_snapshot()
+            if index is None:
+                self._rebuild()
+                return
+            with self.lock:
+                self.index = index
+
+        if self._load(self.index, self.index.max_id):
+            self.snapshot_stale = True
+
+        with connection.cursor() as cursor:
+            cursor.execute('SELECT COUNT(*) FROM tags_series')
+            (count, ) = cursor.fetchone()
+
+        if count != len(self.index.paths):
+            # series were deleted, or added with lower ids
+            self._rebuild()
+        elif self.snapshot_stale and self.settings.TAGDB_MEMORY_SNAPSHOT and (
+                time.time() - self.last_snapshot >= self.settings.TAGDB_MEMORY_SNAPSHOT_INTERVAL):
+            self._rebuild()
+
+    def _rebuild(self):
+        """Load the whole index and save it to the snapshot before using it"""
+        index = TagIndex()
+        self._load(index, 0)
+        self._save_snapshot(index)
+        with self.lock:
+            self.index = index
+
+    def _load(self, index, after_id):
+        """Add the series with an id greater than after_id to the index
+
+        The lock is only taken to update the index in use, other indexes are
+        built without it.
+        """
+        with connection.cursor() as cursor:
+            sql = 'SELECT s.id, s.path, t.tag, v.value'
+            sql += ' FROM tags_series AS s'
+            sql += ' JOIN tags_seriestag AS st ON st.series_id=s.id'
+            sql += ' JOIN tags_tag AS t ON t.id=st.tag_id'
+            sql += ' JOIN tags_tagvalue AS v ON v.id=st.value_id'
+            sql += ' WHERE s.id>%s'
+            sql += ' ORDER BY s.id'
+            cursor.execute(sql, [after_id])
+
+            series = []
+            for (series_id, path, tag, value) in cursor:
+                if not series or series[-1][0] != series_id:
+                    series.append((series_id, path, {}))
+                series[-1][2][tag] = value
+
+        if index is self.index:
+            with self.lock:
+                for (series_id, path, tags) in series:
+                    index.add(series_id, path, tags)
+        else:
+            for (series_id, path, tags) in series:
+                index.add(series_id, path, tags)
+
+        return bool(series)
+
+    def _load_snapshot(self):
+        path = self.settings.TAGDB_MEMORY_SNAPSHOT
+        if not path or not os.path.exists(path):
+            return None
+
+        try:
+            with open(path, 'rb') as f:
+                index = pickle.load(f)
+        except Exception:
+            if self.log:
+                self.log.exception('Failed to load TagDB snapshot %s' % path)
+            return None
+
+        if not isinstance(index, TagIndex):
+            return None
+        self.last_snapshot = os.path.getmtime(path)
+        return index
+
+    def _save_snapshot(self, index):
+        """Save an index that isn't in use yet to the snapshot file"""
+        path = self.settings.TAGDB_MEMORY_SNAPSHOT
+        if not path:
+            return
+
+        self.last_snapshot = time.time()
+        fd, tmp = mkstemp(dir=os.path.dirname(os.path.abspath(path)))
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                pickle.dump(index, f, protocol=-1)
+            os.rename(tmp, path)
+            self.snapshot_stale = False
+        except Exception:
+            if self.log:
+                self.log.exception('Failed to save TagDB snapshot %s' % path)
+            try:
+                os.unlink(tmp)
+            except OSError:
+                pass
+
+    def _find_series(self, tags, requestContext=None):
+        self.sync()
+
+        with self.lock:
+            values_by_tag = self.index.postings
+            # lists of the postings of the values matching each tagspec that
+            # doesn't match empty values, and of the values that don't match
+            # each tagspec that does
+            includes = []
+            excludes = []
+
+            for tagspec in tags:
+                (tag, operator, spec) = self.parse_tagspec(tagspec)
+                (matches_empty, match) = _matcher(operator, spec)
+                values = values_by_tag.get(tag, {})
+
+                if matches_empty:
+                    excludes.append([postings for value, postings in values.items() if not match(value)])
+                elif operator == '=':
+                    includes.append([values[spec]] if spec in values else [])
+                else:
+                    includes.append([postings for value, postings in values.items() if match(value)])
+
+            if not includes:
+                raise ValueError("At least one tagspec must not match the empty string")
+
+            # intersect the most selective tagspecs first
+            includes.sort(key=lambda lists: sum(len(postings) for postings in lists))
+
+            candidates = set(chain.from_iterable(includes[0]))
+            for lists in includes[1:]:
+                if not candidates:
+                    break
+                if len(candidates) * len(lists) * 16 < sum(len(postings) for postings in lists):
+                    # look the candidates up in the postings instead of walking them
+                    candidates = set(
+                        series_id for series_id in candidates
+                        if any(_contains(postings, series_id) for postings in lists))
+                else:
+                    candidates.intersection_update(chain.from_iterable(lists))
+
+            for lists in excludes:
+                if not candidates:
+                    break
+                candidates.difference_update(chain.from_iterable(lists))
+
+            paths = self.index.paths
+            return sorted(paths[series_id] for series_id in candidates)
+
+    def get_series(self, path, requestContext=None):
+        self.sync()
+
+        with self.lock:
+            series_id = self.index.ids.get(path)
+        if series_id is None:
+            return None
+
+        tags = self.parse(path).tags
+        return TaggedSeries(tags['name'], tags, series_id=series_id)
+
+    def list_tags(self, tagFilter=None, limit=None, requestContext=None):
+        self.sync()
+
+        if tagFilter:
+            # make sure regex is anchored
+            if not tagFilter.startswith('^'):
+                tagFilter = '^(' + tagFilter + ')'
+            tagFilter = re.compile(tagFilter)
+
+        with self.lock:
+            tags = sorted(self.index.postings)
+
+        if tagFilter:
+            tags = [tag for tag in tags if tagFilter.match(tag)]
+        if limit:
+            tags = tags[:int(limit)]
+
+        return [{'tag': tag} for tag in tags]
+
+    def get_tag(self, tag, valueFilter=None, limit=None, requestContext=None):
+        self.sync()
+
+        with self.lock:
+            if tag not in self.index.postings:
+                return None
+
+        return {
+            'tag': tag,
+            'values': self.list_values(
+                tag,
+                valueFilter=valueFilter,
+                limit=limit,
+                requestContext=requestContext
+            ),
+        }
+
+    def list_values(self, tag, valueFilter=None, limit=None, requestContext=None):
+        self.sync()
+
+        if valueFilter:
+            # make sure regex is anchored
+            if not valueFilter.startswith('^'):
+                valueFilter = '^(' + valueFilter + ')'
+            valueFilter = re.compile(valueFilter)
+
+        with self.lock:
+            values = sorted(
+                (value, len(postings))
+                for value, postings in self.index.postings.get(tag, {}).items()
+                if not valueFilter or valueFilter.match(value)
+            )
+
+        if limit:
+            values = values[:int(limit)]
+
+        return [{'value': value, 'count': count} for (value, count) in values]
+
+    def tag_series(self, series, requestContext=None):
+        path = super(MemoryTagDB, self).tag_series(series, requestContext)
+
+        self.sync()
+        curr = self._get_series(self._path_hash(path))
+        if curr:
+            with self.lock:
+                self.index.add(curr.id, path, curr.tags)
+            self.snapshot_stale = True
+
+        return path
+
+    def del_series(self, series, requestContext=None):
+        result = super(MemoryTagDB, self).del_series(series, requestContext)
+
+        self.sync()
+        path = self.parse(series).path
+        with self.lock:
+            series_id = self.index.ids.get(path)
+            if series_id is not None:
+                self.index.remove(series_id)
+                self.snapshot_stale = True
+
+        return result
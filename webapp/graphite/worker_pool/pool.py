@@ -82,7 +82,7 @@ class PoolTimeoutError(Exception):
     pass
 
 
-def pool_exec(pool, jobs, timeout):
+def pool_exec(pool, jobs, timeout, job_timeout=None):
     """Execute a list of jobs, yielding each one as it completes.
 
     If a pool is specified then the jobs will be executed asynchronously,
@@ -91,9 +91,15 @@ def pool_exec(pool, jobs, timeout):
     If not all jobs have been executed after the specified timeout a
     PoolTimeoutError will be raised. When operating synchronously the
     timeout is checked before each job is run.
+
+    If job_timeout is given, it returns the timeout of each job instead of
+    timeout: jobs aren't waited for beyond their own timeout, and the
+    PoolTimeoutError is raised once all the jobs left are past theirs.
     """
     start = time.time()
-    deadline = start + timeout
+    deadlines = dict(
+        (job, start + (timeout if job_timeout is None else job_timeout(job)))
+        for job in jobs)
     if pool:
         queue = six.moves.queue.Queue()
 
@@ -104,22 +110,24 @@ def pool_exec(pool, jobs, timeout):
         for job in jobs:
             pool.apply_async(func=pool_executor, args=[job])
 
-        done = 0
-        total = len(jobs)
-
-        while done < total:
-            wait_time = max(0, deadline - time.time())
+        pending = set(jobs)
+        while pending:
+            wait_time = max(0, max(deadlines[job] for job in pending) - time.time())
             try:
                 job = queue.get(True, wait_time)
             except six.moves.queue.Empty:
                 raise PoolTimeoutError("Timed out after %fs" % (time.time() - start))
 
-            done += 1
+            pending.discard(job)
             yield job
     else:
+        timed_out = False
         for job in jobs:
-            if time.time() > deadline:
-                raise PoolTimeoutError("Timed out after %fs" % (time.time() - start))
+            if time.time() > deadlines[job]:
+                timed_out = True
+                continue
 
             job.run()
             yield job
+        if timed_out:
+            raise PoolTimeoutError("Timed out after %fs" % (time.time() - start))
@@ -0,0 +1,106 @@
+import random
+import unittest
+
+from django.test import override_settings
+
+from .base import TestCase
+
+from graphite import arrays
+from graphite.functions.aggfuncs import aggFuncs
+from graphite.render.datalib import TimeSeries
+
+try:
+    from itertools import izip_longest
+except ImportError:
+    from itertools import zip_longest as izip_longest
+
+
+@unittest.skipIf(not arrays.np, 'numpy not installed')
+class ArraysTest(TestCase):
+
+    def assertValuesEqual(self, result, expected):
+        self.assertEqual(len(result), len(expected))
+        for i, (r, e) in enumerate(zip(result, expected)):
+            if e is None:
+                self.assertIsNone(r, 'index %d' % i)
+            else:
+                self.assertAlmostEqual(r, e, msg='index %d' % i)
+
+    def _gen_series_list(self, count=5, length=40, seed=1):
+        rand = random.Random(seed)
+        seriesList = []
+        for i in range(count):
+            # vary the length so padding with None is exercised
+            values = [rand.choice([None, rand.randint(-50, 50) / 2.0]) for _ in range(length - i)]
+            seriesList.append(TimeSeries('test.series.%d' % i, 0, length, 1, values))
+        return seriesList
+
+    def test_enabled(self):
+        self.assertFalse(arrays.enabled())
+        with override_settings(USE_NUMPY=True):
+            self.assertTrue(arrays.enabled())
+
+    def test_toArray_fromArray(self):
+        values = [1, None, 2.5]
+        array = arrays.toArray(values)
+        self.assertEqual(array.dtype, arrays.np.float64)
+        self.assertIs(arrays.toArray(array), array)
+        self.assertEqual(arrays.fromArray(array), [1.0, None, 2.5])
+        self.assertEqual(arrays.fromArray(array, arrays.np.array([False, False, True])), [None, None, 2.5])
+
+    def test_toGapArray(self):
+        array = arrays.toGapArray([1, None, 2.5])
+        self.assertEqual(array.dtype, arrays.np.float64)
+        self.assertEqual(arrays.fromArray(array), [1.0, None, 2.5])
+        # NaN values aren't gaps
+        self.assertIsNone(arrays.toGapArray([1, float('nan'), None]))
+        self.assertIsNone(arrays.toGapArray(['a', None]))
+
+    def test_stack(self):
+        seriesList = [
+            TimeSeries('a', 0, 3, 1, [1, 2, 3]),
+            TimeSeries('b', 0, 2, 1, [None, 5]),
+        ]
+        matrix = arrays.stack(seriesList)
+        self.assertEqual(matrix.shape, (2, 3))
+        self.assertEqual(arrays.fromArray(matrix[1]), [None, 5.0, None])
+
+    def test_aggregate(self):
+        seriesList = self._gen_series_list()
+        for func, aggFunc in aggFuncs.items():
+            for xFilesFactor in [0, 0.5, 1]:
+                expected = []
+                for row in izip_longest(*seriesList):
+                    nonNull = len([v for v in row if v is not None])
+                    if nonNull and nonNull / len(row) >= xFilesFactor:
+                        expected.append(aggFunc(row))
+                    else:
+                        expected.append(None)
+                result = arrays.aggregate(seriesList, func, xFilesFactor)
+                self.assertValuesEqual(result, expected)
+
+    def test_aggregate_count_ints(self):
+        seriesList = self._gen_series_list()
+        result = arrays.aggregate(seriesList, 'count', 0)
+        self.assertTrue(all(isinstance(v, int) for v in result if v is not None))
+
+    def test_aggregate_consolidated(self):
+        seriesList = [
+            TimeSeries('a', 0, 4, 1, [1, 2, 3, 4]),
+            TimeSeries('b', 0, 4, 2, [10, 20]),
+        ]
+        seriesList[0].consolidate(2)
+        self.assertValuesEqual(arrays.aggregate(seriesList, 'sum', 0), [11.5, 23.5])
+
+    def test_aggregate_nan(self):
+        seriesList = [
+            TimeSeries('a', 0, 2, 1, [1, float('nan')]),
+            TimeSeries('b', 0, 2, 1, [2, 3]),
+        ]
+        with self.assertRaisesRegex(ValueError, 'NaN'):
+            arrays.aggregate(seriesList, 'sum', 0)
+
+    def test_reduceRows_invalid(self):
+        matrix = arrays.np.zeros((2, 2))
+        with self.assertRaisesRegex(ValueError, "Unsupported reduction: 'bogus'"):
+            arrays.reduceRows(matrix, matrix == 0, 'bogus')
@@ -0,0 +1,90 @@
+import socket
+
+try:
+    from unittest.mock import patch
+except ImportError:
+    from mock import patch
+
+from .base import TestCase
+
+from graphite.carbonlink import CarbonLinkPool
+
+
+class CarbonLinkPoolBulkTest(TestCase):
+
+    def setUp(self):
+        super(CarbonLinkPoolBulkTest, self).setUp()
+        self.pool = CarbonLinkPool([('127.0.0.1', 7002, 'a'), ('127.0.0.2', 7002, 'b')], 1)
+        self.metrics = ['hosts.worker%d.cpu' % i for i in range(10)]
+        self.hosts = dict((metric, self.pool.select_host(metric)) for metric in self.metrics)
+
+    def _bulk_response(self, host, request, description):
+        self.assertEqual(request['type'], 'cache-query-bulk')
+        for metric in request['metrics']:
+            self.assertEqual(self.hosts[metric], host)
+        return {'datapointsByMetric': dict((metric, [(1, 1.0)]) for metric in request['metrics'])}
+
+    @patch('graphite.carbonlink.CarbonLinkPool.query')
+    @patch('graphite.carbonlink.CarbonLinkPool.send_request_to_host')
+    def test_query_bulk(self, send_request_to_host, query):
+        send_request_to_host.side_effect = self._bulk_response
+
+        results = self.pool.query_bulk(self.metrics + self.metrics[:2])
+
+        self.assertEqual(results, dict((metric, [(1, 1.0)]) for metric in self.metrics))
+        # one request per carbon instance
+        self.assertEqual(send_request_to_host.call_count, len(set(self.hosts.values())))
+        query.assert_not_called()
+
+    @patch('graphite.carbonlink.CarbonLinkPool.query')
+    @patch('graphite.carbonlink.CarbonLinkPool.send_request_to_host')
+    def test_query_bulk_unsupported(self, send_request_to_host, query):
+        send_request_to_host.return_value = {'error': 'Invalid request type "cache-query-bulk"'}
+        query.side_effect = lambda metric: [(2, 2.0)]
+
+        results = self.pool.query_bulk(self.metrics)
+        self.assertEqual(results, dict((metric, [(2, 2.0)]) for metric in self.metrics))
+        self.assertEqual(query.call_count, len(self.metrics))
+
+        # unsupported hosts are remembered
+        send_request_to_host.reset_mock()
+        self.pool.query_bulk(self.metrics)
+        send_request_to_host.assert_not_called()
+
+        # for a while, they might get upgraded
+        with self.settings(CARBONLINK_QUERY_BULK_RETRY_DELAY=0):
+            self.pool.query_bulk(self.metrics)
+        self.assertEqual(send_request_to_host.call_count, len(set(self.hosts.values())))
+
+    @patch('graphite.carbonlink.CarbonLinkPool.query')
+    @patch('graphite.carbonlink.CarbonLinkPool.send_request_to_host')
+    def test_query_bulk_error(self, send_request_to_host, query):
+        send_request_to_host.return_value = {'error': 'Out of memory'}
+        query.side_effect = lambda metric: [(2, 2.0)]
+
+        # other errors fall back to cache-query for this request only
+        results = self.pool.query_bulk(self.metrics)
+        self.assertEqual(results, dict((metric, [(2, 2.0)]) for metric in self.metrics))
+        self.assertEqual(self.pool.bulk_unsupported, {})
+
+        send_request_to_host.reset_mock()
+        self.pool.query_bulk(self.metrics)
+        self.assertEqual(send_request_to_host.call_count, len(set(self.hosts.values())))
+
+    @patch('graphite.carbonlink.CarbonLinkPool.query')
+    @patch('graphite.carbonlink.CarbonLinkPool.send_request_to_host')
+    def test_query_bulk_host_down(self, send_request_to_host, query):
+        send_request_to_host.side_effect = socket.error('Connection refused')
+
+        results = self.pool.query_bulk(self.metrics)
+        self.assertEqual(results, dict((metric, []) for metric in self.metrics))
+        query.assert_not_called()
+
+    @patch('graphite.carbonlink.CarbonLinkPool.query')
+    @patch('graphite.carbonlink.CarbonLinkPool.send_request_to_host')
+    def test_query_bulk_carbon_metrics(self, send_request_to_host, query):
+        query.side_effect = Exception('broken')
+
+        results = self.pool.query_bulk(['carbon.agents.a.cpuUsage'])
+        self.assertEqual(results, {'carbon.agents.a.cpuUsage': []})
+        send_request_to_host.assert_not_called()
@@ -0,0 +1,175 @@
+import threading
+import time
+
+from django.core.cache import cache
+from django.http import HttpResponse
+from django.test import RequestFactory, override_settings
+
+from .base import TestCase
+
+from graphite.coalesce import SingleFlight, cache_lock, coalesce_render, wait_for_cache
+
+
+LOCMEM_CACHE = {'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}}
+
+
+class SingleFlightTest(TestCase):
+
+    def _run_concurrently(self, count, func):
+        results = [None] * count
+        errors = [None] * count
+
+        def run(i):
+            try:
+                results[i] = func()
+            except Exception as e:
+                errors[i] = e
+
+        threads = [threading.Thread(target=run, args=(i,)) for i in range(count)]
+        for thread in threads:
+            thread.start()
+        return threads, results, errors
+
+    def test_do(self):
+        flight = SingleFlight('test')
+        self.assertEqual(flight.do('key', lambda x: x * 2, 21), (42, False))
+        self.assertEqual(flight.calls, {})
+
+    def test_do_concurrent(self):
+        flight = SingleFlight('test')
+        release = threading.Event()
+        calls = []
+
+        def slow():
+            calls.append(1)
+            release.wait()
+            return ['result']
+
+        threads, results, errors = self._run_concurrently(5, lambda: flight.do('key', slow))
+
+        # give all callers time to queue up behind the first one
+        time.sleep(0.1)
+        release.set()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(errors, [None] * 5)
+        self.assertEqual([result for result, _ in results], [['result']] * 5)
+        self.assertEqual(sorted(shared for _, shared in results), [False, True, True, True, True])
+        self.assertEqual(flight.calls, {})
+
+    def test_do_exception(self):
+        flight = SingleFlight('test')
+        release = threading.Event()
+
+        def fail():
+            release.wait()
+            raise ValueError('broken')
+
+        threads, results, errors = self._run_concurrently(3, lambda: flight.do('key', fail))
+        time.sleep(0.1)
+        release.set()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual([str(e) for e in errors], ['broken'] * 3)
+        self.assertEqual(flight.calls, {})
+
+        # the key can be used again after a failure
+        self.assertEqual(flight.do('key', lambda: 1), (1, False))
+
+
+@override_settings(CACHES=LOCMEM_CACHE)
+class CacheLockTest(TestCase):
+
+    def setUp(self):
+        super(CacheLockTest, self).setUp()
+        cache.clear()
+
+    def test_cache_lock(self):
+        with cache_lock('key', 10) as lock:
+            self.assertTrue(lock.acquired)
+            self.assertTrue(cache.get('lock:key'))
+            with cache_lock('key', 10) as other:
+                self.assertFalse(other.acquired)
+            self.assertTrue(cache.get('lock:key'))
+        self.assertIsNone(cache.get('lock:key'))
+
+    def test_wait_for_cache(self):
+        # nobody is computing the value
+        self.assertIsNone(wait_for_cache('key', 10))
+
+        cache.set('key', 'value')
+        self.assertEqual(wait_for_cache('key', 10), 'value')
+
+    def test_wait_for_cache_timeout(self):
+        cache.set('lock:key', True)
+        start = time.time()
+        self.assertIsNone(wait_for_cache('key', 0.1, interval=0.01))
+        self.assertGreaterEqual(time.time() - start, 0.1)
+
+
+class CoalesceRenderTest(TestCase):
+
+    def setUp(self):
+        super(CoalesceRenderTest, self).setUp()
+        self.factory = RequestFactory()
+        self.calls = []
+        self.release = threading.Event()
+
+        @coalesce_render(lambda request: request.GET.get('target'))
+        def view(request):
+            self.calls.append(request)
+            self.release.wait()
+            return HttpResponse(request.GET.get('target'))
+
+        self.view = view
+
+    def test_disabled(self):
+        self.release.set()
+        self.view(self.factory.get('/render', {'target': 'a'}))
+        self.view(self.factory.get('/render', {'target': 'a'}))
+        self.assertEqual(len(self.calls), 2)
+
+    @override_settings(COALESCE_REQUESTS=True)
+    def test_coalesced(self):
+        responses = []
+        threads = [
+            threading.Thread(target=lambda: responses.append(self.view(self.factory.get('/render', {'target': 'a'}))))
+            for _ in range(3)
+        ]
+        for thread in threads:
+            thread.start()
+        time.sleep(0.1)
+        self.release.set()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(len(self.calls), 1)
+        self.assertEqual([r.content for r in responses], [b'a'] * 3)
+        # waiting requests get their own copy of the response
+        self.assertEqual(len(set(id(r) for r in responses)), 3)
+
+    @override_settings(COALESCE_REQUESTS=True, COALESCE_REQUESTS_ACROSS_PROCESSES=True, CACHES=LOCMEM_CACHE)
+    def test_coalesced_across_processes(self):
+        self.release.set()
+        cache.clear()
+
+        # another process is rendering the request and stores the response in the cache
+        cache.set('lock:a', True)
+        cache.set('a', HttpResponse('cached'))
+        response = self.view(self.factory.get('/render', {'target': 'a'}))
+        self.assertEqual(response.content, b'cached')
+        self.assertEqual(len(self.calls), 0)
+
+        # nobody else is rendering the request
+        response = self.view(self.factory.get('/render', {'target': 'b'}))
+        self.assertEqual(response.content, b'b')
+        self.assertEqual(len(self.calls), 1)
+        self.assertIsNone(cache.get('lock:b'))
+
+        # noCache requests don't wait
+        response = self.view(self.factory.get('/render', {'target': 'a', 'noCache': '1'}))
+        self.assertEqual(response.content, b'a')
+        self.assertEqual(len(self.calls), 2)
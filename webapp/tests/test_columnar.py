@@ -0,0 +1,145 @@
+import math
+import struct
+import zlib
+
+from django.test import override_settings
+
+from .base import TestCase
+
+from graphite import arrays, columnar
+from graphite.render.datalib import TimeSeries
+
+
+class ColumnarTest(TestCase):
+
+    def _series(self):
+        series = [
+            TimeSeries('test', 1, 13, 1, [1, None, 3.5, float('nan'), 5, None, None, None, None, 10, 11, float('inf')]),
+            TimeSeries('test2;a=b', 1, 9, 2, [None] * 8),
+            TimeSeries(u'testé', 1, 1, 1, []),
+            TimeSeries('test.consolidated', 0, 100, 10, list(range(10)), xFilesFactor=0.5),
+        ]
+        series[3].consolidate(3)
+        return series
+
+    def _assertRoundTrip(self, series, compress=False):
+        encoded = columnar.dumps(series, compress)
+        self.assertEqual(encoded, b''.join(columnar.iterdump(series, compress)))
+
+        for decoded in (columnar.loads(encoded), columnar.load(_Stream(encoded))):
+            self._assertDecoded(decoded, series)
+        return encoded
+
+    def _assertDecoded(self, decoded, series):
+        expected = [s.getInfo() for s in series]
+        self.assertEqual(len(decoded), len(expected))
+        for result, info in zip(decoded, expected):
+            values, expected_values = result.pop('values'), info.pop('values')
+            if arrays.isArray(values):
+                values = arrays.fromArray(values)
+            self.assertEqual(result, info)
+            self.assertEqual(len(values), len(expected_values))
+            for value, expected_value in zip(values, expected_values):
+                if expected_value is not None and math.isnan(expected_value):
+                    self.assertTrue(math.isnan(value))
+                else:
+                    self.assertEqual(value, expected_value)
+
+    def test_round_trip(self):
+        encoded = self._assertRoundTrip(self._series())
+        self.assertEqual(encoded[:6], b'GCOL\x01\x00')
+        self._assertRoundTrip([])
+
+    def test_round_trip_compressed(self):
+        encoded = self._assertRoundTrip(self._series(), compress=True)
+        self.assertEqual(encoded[:6], b'GCOL\x01\x01')
+        zlib.decompress(encoded[6:])
+
+    def test_round_trip_numpy(self):
+        if not arrays.np:
+            self.skipTest('numpy not installed')
+        with override_settings(USE_NUMPY=True):
+            encoded = self._assertRoundTrip(self._series())
+        # both implementations produce the same encoding
+        self.assertEqual(encoded, columnar.dumps(self._series()))
+
+    def test_numpy_arrays(self):
+        if not arrays.np:
+            self.skipTest('numpy not installed')
+        series = [
+            TimeSeries('a', 0, 30, 10, [1.0, 2.0, 3.0]),
+            TimeSeries('b', 0, 30, 10, [None, 1.5, None]),
+            TimeSeries('c', 0, 30, 10, [float('nan'), 1.5, None]),
+        ]
+        encoded = columnar.dumps(series)
+        with override_settings(USE_NUMPY=True):
+            (a, b, c) = [info['values'] for info in columnar.loads(encoded)]
+
+        # values without gaps are a view of the response
+        self.assertTrue(arrays.isArray(a))
+        self.assertFalse(a.flags.owndata)
+        self.assertEqual(a.tolist(), [1.0, 2.0, 3.0])
+
+        # gaps are NaN
+        self.assertTrue(arrays.isArray(b))
+        self.assertEqual(arrays.fromArray(b), [None, 1.5, None])
+
+        # NaN values aren't turned into gaps
+        self.assertFalse(arrays.isArray(c))
+        self.assertTrue(math.isnan(c[0]))
+        self.assertEqual(c[1:], [1.5, None])
+
+    def test_load_incremental(self):
+        for compress in (False, True):
+            encoded = columnar.dumps(self._series(), compress)
+            stream = _Stream(encoded)
+            self._assertDecoded(columnar.load(stream), self._series())
+
+            # the stream is read in pieces, not as a whole
+            self.assertNotIn(None, stream.reads)
+            if compress:
+                self.assertEqual(set(stream.reads[1:]), set([columnar._CHUNK_SIZE]))
+            else:
+                self.assertGreater(len(stream.reads), 3)
+                self.assertLess(max(stream.reads), len(encoded))
+
+            with self.assertRaisesRegex(ValueError, 'Truncated columnar data'):
+                columnar.load(_Stream(encoded[:len(encoded) // 2]))
+
+    def test_layout(self):
+        encoded = columnar.dumps([TimeSeries('a', 0, 30, 10, [None, 1.5, None])])
+        (count, length) = struct.unpack_from('<II', encoded, 6)
+        self.assertEqual(count, 1)
+        values_offset = 14 + length
+        self.assertEqual(struct.unpack_from('<I', encoded, values_offset), (3,))
+        self.assertEqual(struct.unpack_from('<3d', encoded, values_offset + 4), (0.0, 1.5, 0.0))
+        self.assertEqual(encoded[values_offset + 28:], b'\x02')
+
+    def test_invalid(self):
+        encoded = columnar.dumps(self._series())
+
+        with self.assertRaisesRegex(ValueError, 'Invalid columnar data'):
+            columnar.loads(b'GPIK' + encoded[4:])
+
+        with self.assertRaisesRegex(ValueError, 'Unsupported columnar data version 2'):
+            columnar.loads(b'GCOL\x02' + encoded[5:])
+
+        with self.assertRaisesRegex(ValueError, 'Truncated columnar data'):
+            columnar.loads(encoded[:-3])
+
+
+class _Stream(object):
+    """File-like object recording the sizes it is read with"""
+
+    def __init__(self, data):
+        self.data = data
+        self.offset = 0
+        self.reads = []
+
+    def read(self, size=None):
+        self.reads.append(size)
+        if size is None or size < 0:
+            size = len(self.data) - self.offset
+        chunk = self.data[self.offset:self.offset + size]
+        self.offset += len(chunk)
+        return chunk
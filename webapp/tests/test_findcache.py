@@ -0,0 +1,237 @@
+import os
+import shutil
+import tempfile
+import threading
+import time
+
+import whisper
+
+from django.conf import settings
+from django.test import override_settings
+from mock import patch
+
+from .base import TestCase
+
+from graphite.finders.standard import StandardFinder
+from graphite.findcache import CachedReader, FileCache, FindCache, get_find_cache
+from graphite.node import BranchNode, LeafNode
+from graphite.storage import Store
+
+
+class FileCacheTest(TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.dir)
+        self.path = os.path.join(self.dir, 'find.cache')
+
+    def test_get_set(self):
+        cache = FileCache(self.path, 16, 256)
+        self.assertEqual(os.path.getsize(self.path), 16 * 256)
+
+        self.assertIsNone(cache.get('a'))
+        self.assertEqual(cache.get('a', 'default'), 'default')
+
+        cache.set('a', ['value', 1.5], 60)
+        self.assertEqual(cache.get('a'), ['value', 1.5])
+
+        # another process sees the same values
+        self.assertEqual(FileCache(self.path, 16, 256).get('a'), ['value', 1.5])
+
+        # expired
+        cache.set('b', 'value', -1)
+        self.assertIsNone(cache.get('b'))
+
+        # too large for a slot
+        cache.set('c', 'x' * 256, 60)
+        self.assertIsNone(cache.get('c'))
+
+        cache.delete('a')
+        self.assertIsNone(cache.get('a'))
+
+    def test_add(self):
+        cache = FileCache(self.path, 16, 256)
+        self.assertTrue(cache.add('lock', True, 60))
+        self.assertFalse(cache.add('lock', True, 60))
+        cache.delete('lock')
+        self.assertTrue(cache.add('lock', True, 60))
+
+        # too large for a slot
+        self.assertFalse(cache.add('large', 'x' * 256, 60))
+        self.assertIsNone(cache.get('large'))
+
+        # the live value of another key isn't replaced
+        cache = FileCache(os.path.join(self.dir, 'locks'), 1, 256)
+        self.assertTrue(cache.add('a', True, 60))
+        self.assertFalse(cache.add('b', True, 60))
+        self.assertTrue(cache.get('a'))
+        cache.delete('a')
+        self.assertTrue(cache.add('b', True, 60))
+        cache.set('c', True, -1)
+        self.assertTrue(cache.add('b', True, 60))
+
+    def test_collision(self):
+        # with a single slot, keys replace each other
+        cache = FileCache(self.path, 1, 256)
+        cache.set('a', 1, 60)
+        cache.set('b', 2, 60)
+        self.assertIsNone(cache.get('a'))
+        self.assertEqual(cache.get('b'), 2)
+
+        # deleting a key doesn't delete the key stored in its slot
+        cache.delete('a')
+        self.assertEqual(cache.get('b'), 2)
+
+
+class FindCacheTest(TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.dir)
+        self.cache = FindCache(FileCache(os.path.join(self.dir, 'find.cache'), 16, 1024))
+
+    def wait_refresh(self):
+        for _ in range(100):
+            if not self.cache.refreshing:
+                return
+            time.sleep(0.01)
+        self.fail('refresh did not complete')
+
+    def test_get(self):
+        calls = []
+
+        def compute():
+            calls.append(1)
+            return len(calls)
+
+        self.assertEqual(self.cache.get('key', compute), 1)
+        self.assertEqual(self.cache.get('key', compute), 1)
+        self.assertEqual(len(calls), 1)
+
+    @override_settings(FIND_RESULT_CACHE_JITTER=0.5)
+    def test_jitter(self):
+        with patch('graphite.findcache.random.random', return_value=1.0):
+            self.cache.get('key', lambda: 'value')
+        (fresh_until, value) = self.cache.backend.get('key')
+        self.assertAlmostEqual(fresh_until, time.time() + settings.FIND_RESULT_CACHE_DURATION * 0.5, delta=1)
+
+    def test_stale_while_revalidate(self):
+        with self.settings(FIND_RESULT_CACHE_DURATION=0):
+            self.assertEqual(self.cache.get('key', lambda: 'old'), 'old')
+
+        # the stale value is served while it's computed again
+        self.assertEqual(self.cache.get('key', lambda: 'new'), 'old')
+        self.wait_refresh()
+        self.assertEqual(self.cache.get('key', lambda: 'newer'), 'new')
+        self.assertIsNone(self.cache.backend.get('lock:key'))
+
+    def test_refresh_once(self):
+        with self.settings(FIND_RESULT_CACHE_DURATION=0):
+            self.cache.get('key', lambda: 'old')
+
+        # another process is refreshing the value
+        self.cache.backend.add('lock:key', True, 60)
+        self.assertEqual(self.cache.get('key', lambda: 'new'), 'old')
+        self.assertEqual(self.cache.refreshing, set())
+        self.assertEqual(self.cache.backend.get('key')[1], 'old')
+
+    def test_refresh_failed(self):
+        def compute():
+            raise Exception('failed')
+
+        with self.settings(FIND_RESULT_CACHE_DURATION=0):
+            self.cache.get('key', lambda: 'old')
+
+        with patch('graphite.findcache.log.exception') as log_exception:
+            self.assertEqual(self.cache.get('key', compute), 'old')
+            self.wait_refresh()
+        self.assertEqual(log_exception.call_count, 1)
+        self.assertEqual(self.cache.get('key', compute), 'old')
+
+    def test_refresh_locks(self):
+        # with a single slot, an entry and the lock of its refresh would
+        # replace each other
+        with self.settings(FIND_RESULT_CACHE_FILE=os.path.join(self.dir, 'single.cache'), FIND_RESULT_CACHE_FILE_SLOTS=1):
+            self.cache = get_find_cache()
+        self.assertTrue(os.path.exists(os.path.join(self.dir, 'single.cache.locks')))
+        with self.settings(FIND_RESULT_CACHE_DURATION=0):
+            self.cache.get('key', lambda: 'old')
+
+        computing = threading.Event()
+
+        def compute():
+            computing.wait(5)
+            return 'new'
+
+        self.assertEqual(self.cache.get('key', compute), 'old')
+        # the stale value is still served while it's computed again
+        self.assertEqual(self.cache.get('key', lambda: 'other'), 'old')
+        self.assertTrue(self.cache.locks.get('lock:key'))
+        computing.set()
+        self.wait_refresh()
+        self.assertEqual(self.cache.get('key', lambda: 'other'), 'new')
+        self.assertIsNone(self.cache.locks.get('lock:key'))
+
+    def test_fallback_keys(self):
+        self.cache.get('previous', lambda: 'previous')
+
+        self.assertEqual(self.cache.get('key', lambda: 'current', ['previous']), 'previous')
+        self.wait_refresh()
+        self.assertEqual(self.cache.get('key', lambda: 'newer', ['previous']), 'current')
+
+
+class StoreFindCacheTest(TestCase):
+    hostcpu = os.path.join(settings.WHISPER_DIR, 'hosts/hostname/cpu.wsp')
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.dir)
+
+        for host in ['worker1', 'worker2']:
+            path = self.hostcpu.replace('hostname', host)
+            os.makedirs(os.path.dirname(path))
+            whisper.create(path, [(1, 60)])
+            whisper.update(path, 1, int(time.time()))
+        self.addCleanup(shutil.rmtree, os.path.join(settings.WHISPER_DIR, 'hosts'))
+
+        self.finder = StandardFinder([settings.WHISPER_DIR])
+        self.store = Store(finders=[self.finder])
+
+    def test_find(self):
+        expected = sorted((node.path, node.is_leaf) for node in self.store.find('hosts.*.cpu'))
+
+        with self.settings(FIND_RESULT_CACHE=True, FIND_RESULT_CACHE_FILE=os.path.join(self.dir, 'find.cache')):
+            with patch.object(self.finder, 'find_nodes', wraps=self.finder.find_nodes) as find_nodes:
+                nodes = list(self.store.find('hosts.*.cpu'))
+                self.assertEqual(find_nodes.call_count, 1)
+
+                nodes = list(self.store.find('hosts.*.cpu'))
+                self.assertEqual(find_nodes.call_count, 1)
+
+                self.assertEqual(sorted((node.path, node.is_leaf) for node in nodes), expected)
+                for node in nodes:
+                    self.assertIsInstance(node, LeafNode)
+                    self.assertIsInstance(node.reader, CachedReader)
+                    self.assertEqual(len(node.intervals), 1)
+
+                # fetching a cached node finds it again
+                now = int(time.time())
+                (time_info, values) = nodes[0].fetch(now - 10, now)
+                self.assertEqual(find_nodes.call_count, 2)
+                self.assertEqual(time_info[2], 1)
+
+                self.assertEqual([node.path for node in self.store.find('hosts.*', leaves_only=True)], [])
+                self.assertEqual(
+                    [(node.path, type(node)) for node in self.store.find('hosts')],
+                    [('hosts', BranchNode)])
+                self.assertEqual(find_nodes.call_count, 4)
+
+    def test_get_index(self):
+        with self.settings(FIND_RESULT_CACHE=True, FIND_RESULT_CACHE_FILE=os.path.join(self.dir, 'find.cache')):
+            with patch.object(self.finder, 'get_index', wraps=self.finder.get_index) as get_index:
+                self.assertEqual(self.store.get_index(), ['hosts.worker1.cpu', 'hosts.worker2.cpu'])
+                self.assertEqual(self.store.get_index(), ['hosts.worker1.cpu', 'hosts.worker2.cpu'])
+                self.assertEqual(get_index.call_count, 1)
+
+                self.assertEqual(self.store.get_index({'localOnly': True}), ['hosts.worker1.cpu', 'hosts.worker2.cpu'])
+                self.assertEqual(get_index.call_count, 2)
@@ -1,10 +1,12 @@
 from __future__ import absolute_import
 
+import fnmatch
 import gzip
 import os
 from os.path import join, dirname, isdir
 import random
 import shutil
+import threading
 import time
 import unittest
 from six.moves import range
@@ -24,14 +26,17 @@ except ImportError:
     whisper = False
 
 from django.conf import settings
+from django.test import override_settings
 
 from graphite.intervals import Interval, IntervalSet
 from graphite.node import LeafNode, BranchNode
 from graphite.storage import Store, FindQuery, get_finders
-from graphite.finders.standard import scandir
-from graphite.finders import get_real_metric_path
-from graphite.finders.utils import BaseFinder
+from graphite.finders.index import DirectoryIndex
+from graphite.finders.standard import FileSystem, StandardFinder, scandir
+from graphite.finders import get_real_metric_path, compile_pattern, expand_braces, match_entries, split_pattern
+from graphite.finders.utils import BaseFinder, _fetch_nodes
 from graphite.readers.utils import BaseReader
+from graphite.worker_pool.pool import PoolTimeoutError
 from tests.base import TestCase
 
 
@@ -66,6 +71,87 @@ class FinderTest(TestCase):
         self.assertEqual(time_info, (100, 200, 10))
         self.assertEqual(len(series), 10)
 
+    @override_settings(FETCH_POOL_MAX_WORKERS=4, FETCH_POOL_MAX_WORKERS_PER_REQUEST=3)
+    def test_parallel_fetch(self):
+        finder = DummyFinder()
+        threads = set()
+
+        def fetch(reader, start_time, end_time):
+            threads.add(threading.current_thread())
+            return (start_time, end_time, 10), [reader.path]
+
+        with patch.object(DummyReader, 'fetch', autospec=True, side_effect=fetch):
+            results = finder.fetch(['bar.*'], 100, 200)
+
+        # results are returned in the order the nodes were found
+        self.assertEqual([result['path'] for result in results], ['bar.%d' % i for i in range(10)])
+        self.assertEqual([result['values'] for result in results], [['bar.%d' % i] for i in range(10)])
+        self.assertNotIn(threading.current_thread(), threads)
+        self.assertLessEqual(len(threads), 3)
+
+    @override_settings(FETCH_POOL_MAX_WORKERS=4, FETCH_TIMEOUT=0.1)
+    def test_parallel_fetch_timeout(self):
+        finder = DummyFinder()
+        calls = []
+
+        def fetch(reader, start_time, end_time):
+            calls.append(reader.path)
+            time.sleep(0.08)
+            return (start_time, end_time, 10), []
+
+        with patch.object(DummyReader, 'fetch', autospec=True, side_effect=fetch):
+            with self.assertRaises(PoolTimeoutError):
+                finder.fetch(['bar.*'], 100, 200)
+            # reads stop once the deadline is passed
+            time.sleep(0.2)
+            self.assertLess(len(calls), 10)
+
+    def test_fetch_nodes_deadline(self):
+        finder = DummyFinder()
+        leaves = [(node, FindQuery('bar.*', 100, 200)) for node in finder.find_nodes(FindQuery('bar.*', 100, 200))]
+
+        with patch.object(DummyReader, 'fetch', autospec=True, return_value=((100, 200, 10), [])):
+            self.assertEqual(len(_fetch_nodes(leaves, 100, 200, None, None, {}, deadline=time.time() + 60)), 10)
+            # a chunk past its deadline fails rather than returning part of the nodes
+            with self.assertRaises(PoolTimeoutError):
+                _fetch_nodes(leaves, 100, 200, None, None, {}, deadline=time.time() - 1)
+
+
+class MatchEntriesTest(TestCase):
+    entries = ['foo', 'bar', 'baz', 'baz1', 'qux.wsp', 'qux.rrd', 'a-1', 'b-2', '.hidden']
+
+    def expected(self, pattern):
+        # what matching every variant separately with fnmatch returns
+        return set(
+            entry
+            for variant in expand_braces(pattern)
+            for entry in fnmatch.filter(self.entries, variant)
+        )
+
+    def test_match_entries(self):
+        patterns = [
+            'foo', 'ba?', 'ba*', '*', 'ba[rz]', 'ba[!r]*', '{foo,bar}', '{ba{r,z},foo}',
+            '{foo,ba*}', 'qux.*', '{a,b}-{1,2}', '[ab]-?', '{}', '{foo', 'foo}', '[', '.*',
+        ]
+        for pattern in patterns:
+            result = match_entries(self.entries, pattern)
+            self.assertEqual(set(result), self.expected(pattern), pattern)
+            # entries are only matched once
+            self.assertEqual(len(result), len(set(result)), pattern)
+
+    def test_compile_pattern_cached(self):
+        compile_pattern.cache_clear()
+        self.assertIs(compile_pattern('{foo,ba*}'), compile_pattern('{foo,ba*}'))
+        self.assertEqual(compile_pattern.cache_info().hits, 1)
+
+    def test_split_pattern(self):
+        self.assertEqual(split_pattern('a.b*.c'), [['a', 'b*', 'c']])
+        # variants within a component are kept together
+        self.assertEqual(split_pattern('a.{b,c}.{d,e}'), [['a', '{b,c}', '{d,e}']])
+        # variants spanning components are expanded first
+        self.assertEqual(split_pattern('a.{b.c,d}.e'), [['a', 'b', 'c', 'e'], ['a', 'd', 'e']])
+        self.assertEqual(split_pattern('a.{b,{c.d,e}}'), [['a', 'b'], ['a', 'c', 'd'], ['a', 'e']])
+
 
 class DummyReader(BaseReader):
     __slots__ = ('path',)
@@ -329,6 +415,128 @@ class StandardFinderTest(TestCase):
             self.assertNotIn(miss, paths)
             self.wipe_whisper()
 
+    @patch('graphite.finders.standard.scandir', wraps=scandir_mock)
+    def test_standard_finder_index(self, scandir_mock):
+        self.addCleanup(self.wipe_whisper)
+        for path in ['foo.wsp', 'foo/bar/baz.wsp', 'foo/bar/qux.wsp.gz', 'foo/baz1/baz.wsp',
+                     'bar/baz/foo.wsp', 'x/y/z/w.wsp']:
+            self.create_whisper(join(*path.split('/')), gz=path.endswith('.gz'))
+
+        queries = ['*', 'foo.*', 'foo.ba?.*', 'foo.ba[rz]*.baz', '{foo,bar}.{bar,baz}.*',
+                   'foo.{bar}.baz', 'foo.{bar,}.baz', '**', 'x.**', 'foo.**.baz', 'missing.*']
+
+        def find(pattern):
+            finder = StandardFinder([settings.WHISPER_DIR])
+            return sorted(
+                (node.path, node.is_leaf) for node in finder.find_nodes(FindQuery(pattern, None, None)))
+
+        expected = dict((pattern, find(pattern)) for pattern in queries)
+
+        with self.settings(STANDARD_FINDER_INDEX=True):
+            finder = StandardFinder([settings.WHISPER_DIR])
+            finder.filesystem(settings.WHISPER_DIR)
+            finder.indexes[settings.WHISPER_DIR].refresh(wait=True)
+            for pattern in queries:
+                scandir_mock.reset_mock()
+                nodes = finder.find_nodes(FindQuery(pattern, None, None))
+                self.assertEqual(sorted((node.path, node.is_leaf) for node in nodes), expected[pattern], pattern)
+                self.assertEqual(scandir_mock.call_count, 0)
+
+            self.assertEqual(
+                finder.get_index({}),
+                ['bar.baz.foo', 'foo', 'foo.bar.baz', 'foo.baz1.baz', 'x.y.z.w'])
+
+    def test_directory_index_background(self):
+        self.addCleanup(self.wipe_whisper)
+        self.create_whisper(join('foo', 'bar.wsp'))
+
+        started = threading.Event()
+        release = threading.Event()
+        refresh_dir = DirectoryIndex._refresh_dir
+
+        def _refresh_dir(index, directory, path, ancestors):
+            started.set()
+            release.wait(5)
+            return refresh_dir(index, directory, path, ancestors)
+
+        with self.settings(STANDARD_FINDER_INDEX=True):
+            finder = StandardFinder([settings.WHISPER_DIR])
+            with patch.object(DirectoryIndex, '_refresh_dir', _refresh_dir):
+                # queries don't wait for the index to be built
+                self.assertIsInstance(finder.filesystem(settings.WHISPER_DIR), FileSystem)
+                self.assertTrue(started.wait(5))
+                nodes = finder.find_nodes(FindQuery('foo.*', None, None))
+                self.assertEqual([node.path for node in nodes], ['foo.bar'])
+                self.assertIsInstance(finder.filesystem(settings.WHISPER_DIR), FileSystem)
+
+                release.set()
+                finder.indexes[settings.WHISPER_DIR].refresh(wait=True)
+            self.assertIsInstance(finder.filesystem(settings.WHISPER_DIR), DirectoryIndex)
+
+    def test_directory_index_refresh(self):
+        self.addCleanup(self.wipe_whisper)
+        self.create_whisper(join('foo', 'bar.wsp'))
+
+        index = DirectoryIndex(settings.WHISPER_DIR, 60)
+        index.refresh(wait=True)
+        foo = join(settings.WHISPER_DIR, 'foo')
+        self.assertEqual(index.listdir(foo), (['bar.wsp'], []))
+        self.assertTrue(index.isfile(join(foo, 'bar.wsp')))
+        self.assertTrue(index.isdir(foo))
+        self.assertFalse(index.isdir(join(foo, 'bar.wsp')))
+
+        # new files only show up once the index is refreshed
+        self.create_whisper(join('foo', 'baz', 'qux.wsp'))
+        index.refresh(wait=True)
+        self.assertEqual(index.listdir(foo), (['bar.wsp'], []))
+        index.refresh(force=True, wait=True)
+        self.assertEqual(index.listdir(foo), (['bar.wsp'], ['baz']))
+        self.assertTrue(index.isfile(join(foo, 'baz', 'qux.wsp')))
+
+        # only directories which changed are scanned again
+        old = time.time() - 10
+        for path in [settings.WHISPER_DIR, foo, join(foo, 'baz')]:
+            os.utime(path, (old, old))
+        index.refresh(force=True, wait=True)
+        with patch('graphite.finders.index.scandir') as scandir_mock:
+            os.remove(join(foo, 'bar.wsp'))
+            index.refresh(force=True, wait=True)
+            self.assertEqual(scandir_mock.call_count, 1)
+            self.assertEqual(scandir_mock.call_args[0][0], foo)
+
+    @override_settings(CARBONLINK_QUERY_BULK=True)
+    @patch('graphite.carbonlink.CarbonLinkPool.query')
+    @patch('graphite.carbonlink.CarbonLinkPool.query_bulk')
+    def test_standard_finder_fetch_carbonlink_bulk(self, query_bulk, query):
+        self.addCleanup(self.wipe_whisper)
+        self.create_whisper(join('foo', 'bar.wsp'))
+        self.create_whisper(join('foo', 'baz.wsp'))
+
+        now = int(time.time())
+        query_bulk.return_value = {
+            'foo.bar': [(now, 42.0)],
+            'foo.baz': {},
+        }
+
+        finder = get_finders('graphite.finders.standard.StandardFinder')[0]
+        results = finder.fetch(['foo.*'], now - 10, now, now=now)
+
+        query_bulk.assert_called_once()
+        self.assertEqual(sorted(query_bulk.call_args[0][0]), ['foo.bar', 'foo.baz'])
+        query.assert_not_called()
+
+        values = dict((result['path'], result['values']) for result in results)
+        self.assertEqual(values['foo.bar'][-1], 42.0)
+        self.assertEqual(values['foo.baz'], [None] * 10)
+
+        # disabled, each reader queries carbonlink itself
+        query_bulk.reset_mock()
+        query.return_value = []
+        with self.settings(CARBONLINK_QUERY_BULK=False):
+            finder.fetch(['foo.*'], now - 10, now, now=now)
+        query_bulk.assert_not_called()
+        self.assertEqual(query.call_count, 2)
+
     def dummy_realpath(path):
         return path.replace("some/symbolic/path", "this/is/the/real/path")
 
@@ -405,6 +613,13 @@ class CeresFinderTest(TestCase):
         nodes = finder.find_nodes(FindQuery('{bar,foo}.{bar,baz}.{baz,foo}', None, None))
         self.assertEqual(len(list(nodes)), 2)
 
+        # variants spanning several path components
+        nodes = finder.find_nodes(FindQuery('{foo.bar,bar.baz}.*', None, None))
+        self.assertEqual(sorted(node.path for node in nodes), ['bar.baz.foo', 'foo.bar.baz'])
+
+        nodes = finder.find_nodes(FindQuery('{foo.bar,foo.*}.baz', None, None))
+        self.assertEqual(len(list(nodes)), 1)
+
         nodes = finder.find_nodes(FindQuery('foo;bar=baz', None, None))
         self.assertEqual(len(list(nodes)), 1)
 
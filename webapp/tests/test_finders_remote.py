@@ -1,7 +1,9 @@
 import logging
+import time
 
 from urllib3.response import HTTPResponse
 
+from django.conf import settings
 from django.test import override_settings
 from mock import patch
 
@@ -57,6 +59,289 @@ class RemoteFinderTest(TestCase):
       with patch('graphite.finders.remote.time.time', lambda: 110):
         self.assertFalse(finder.disabled)
 
+    @override_settings(
+      REMOTE_CIRCUIT_BREAKER=True,
+      REMOTE_CIRCUIT_BREAKER_MIN_DELAY=1,
+      REMOTE_RETRY_DELAY=10,
+      FETCH_TIMEOUT=5)
+    def test_circuit_breaker(self):
+      finder = RemoteFinder('127.0.0.1')
+      self.assertEqual(finder.state, 'closed')
+      self.assertFalse(finder.disabled)
+
+      with patch('graphite.finders.remote.time.time', lambda: 100):
+        finder.fail()
+        self.assertEqual(finder.state, 'open')
+        self.assertTrue(finder.disabled)
+
+      # a single request probes the host once the delay has passed
+      with patch('graphite.finders.remote.time.time', lambda: 101):
+        self.assertEqual(finder.state, 'half-open')
+        self.assertFalse(finder.disabled)
+        self.assertFalse(finder.disabled)
+        self.assertTrue(finder.claim_probe())
+        self.assertTrue(finder.disabled)
+        self.assertFalse(finder.claim_probe())
+
+      # the probe timed out, let another one through
+      with patch('graphite.finders.remote.time.time', lambda: 106):
+        self.assertFalse(finder.disabled)
+        self.assertTrue(finder.claim_probe())
+        self.assertTrue(finder.disabled)
+
+        # the probe failed, the delay doubles
+        finder.fail()
+        self.assertEqual(finder.retry_delay, 2)
+
+      with patch('graphite.finders.remote.time.time', lambda: 107):
+        self.assertTrue(finder.disabled)
+
+      with patch('graphite.finders.remote.time.time', lambda: 108):
+        self.assertFalse(finder.disabled)
+
+        # the probe succeeded
+        finder.succeed()
+        self.assertEqual(finder.state, 'closed')
+        self.assertFalse(finder.disabled)
+        self.assertEqual(finder.retry_delay, 1)
+
+      # the delay is capped
+      finder.failures = 10
+      self.assertEqual(finder.retry_delay, 10)
+
+      self.assertEqual(list(finder.health.results), [False, False, True])
+      self.assertEqual(finder.health.error_rate, 2.0 / 3)
+
+    @override_settings(
+      REMOTE_CIRCUIT_BREAKER=True,
+      REMOTE_CIRCUIT_BREAKER_MIN_DELAY=1,
+      FETCH_TIMEOUT=5)
+    @patch('urllib3.PoolManager.request')
+    def test_circuit_breaker_probe(self, http_request):
+      finder = RemoteFinder('127.0.0.1')
+      http_request.return_value = HTTPResponse(body=BytesIO(b'ok'), status=200, preload_content=False)
+
+      with patch('graphite.finders.remote.time.time', lambda: 100):
+        finder.fail()
+
+      with patch('graphite.finders.remote.time.time', lambda: 101):
+        # only one request is sent to probe the host
+        finder.claim_probe()
+        with self.assertRaisesRegex(Exception, 'Host is already being probed'):
+          finder.request('/metrics/find/', fields=[('query', 'a')])
+        self.assertEqual(http_request.call_count, 0)
+
+      with patch('graphite.finders.remote.time.time', lambda: 106):
+        result = finder.request('/metrics/find/', fields=[('query', 'a')])
+        self.assertEqual(result.data, b'ok')
+        self.assertEqual(http_request.call_count, 1)
+        self.assertEqual(len(finder.health.latencies['find']), 1)
+        self.assertEqual(len(finder.health.latencies['fetch']), 0)
+
+        http_request.return_value = HTTPResponse(body=BytesIO(b'ok'), status=200, preload_content=False)
+        finder.request('/render/', fields=[('target', 'a')], operation='fetch')
+        self.assertEqual(len(finder.health.latencies['find']), 1)
+        self.assertEqual(len(finder.health.latencies['fetch']), 1)
+
+    @override_settings(
+      REMOTE_ADAPTIVE_TIMEOUT=True,
+      REMOTE_ADAPTIVE_TIMEOUT_FACTOR=3,
+      REMOTE_ADAPTIVE_TIMEOUT_MIN=1)
+    def test_adaptive_timeout(self):
+      finder = RemoteFinder('127.0.0.1')
+
+      # too few requests to know the latency of the host
+      finder.health.latencies['find'].extend([0.1] * 10)
+      self.assertEqual(finder.adaptive_timeout(10), 10)
+
+      finder.health.latencies['find'].extend([0.1] * 89 + [2])
+      self.assertEqual(finder.adaptive_timeout(10), 6)
+      self.assertEqual(finder.adaptive_timeout(5), 5)
+      self.assertEqual(finder.adaptive_timeout(None), None)
+
+      finder.health.latencies['find'].extend([0.1] * 100)
+      self.assertEqual(finder.adaptive_timeout(10), 1)
+
+      with self.settings(REMOTE_ADAPTIVE_TIMEOUT=False):
+        self.assertEqual(finder.adaptive_timeout(10), 10)
+
+      # slow fetches don't lengthen the timeout of finds, nor fast finds
+      # shorten the timeout of fetches
+      finder.health.latencies['fetch'].extend([3] * 100)
+      self.assertEqual(finder.adaptive_timeout(10), 1)
+      self.assertEqual(finder.adaptive_timeout(10, 'find'), 1)
+      self.assertEqual(finder.adaptive_timeout(20, 'fetch'), 9)
+
+    @override_settings(REMOTE_HEDGE_PERCENTILE=90, REMOTE_HEDGE_MIN_DELAY=0.1)
+    def test_hedge_delay(self):
+      finder = RemoteFinder('127.0.0.1')
+      self.assertIsNone(finder.replica_url)
+
+      finder.health.latencies['find'].extend([0.5] * 19)
+      self.assertIsNone(finder.hedge_delay())
+
+      finder.health.latencies['find'].extend([0.01] * 81)
+      self.assertEqual(finder.hedge_delay(), 0.5)
+
+      finder.health.latencies['find'].extend([0.01] * 19)
+      self.assertEqual(finder.hedge_delay(), 0.1)
+
+    @patch('urllib3.PoolManager.request')
+    @override_settings(
+      INTRACLUSTER_HTTPS=False,
+      REMOTE_STORE_USE_POST=False,
+      REMOTE_HEDGE_REQUESTS=True,
+      REMOTE_HEDGE_MIN_DELAY=0.05,
+      REMOTE_HEDGE_BUDGET=1)
+    def test_hedged_request(self, http_request):
+      finder = RemoteFinder('127.0.0.1?replica=127.0.0.2')
+      self.assertEqual(finder.replica_url, 'http://127.0.0.2')
+
+      responses = {
+        'http://127.0.0.1/metrics/find/': HTTPResponse(body=BytesIO(b'slow'), status=200, preload_content=False),
+        'http://127.0.0.2/metrics/find/': HTTPResponse(body=BytesIO(b'fast'), status=200, preload_content=False),
+      }
+
+      def request(method, url, **kwargs):
+        if url.startswith('http://127.0.0.1/'):
+          time.sleep(0.5)
+        return responses[url]
+
+      http_request.side_effect = request
+
+      # too few requests to know the latency of the host, no hedging
+      result = finder.request('/metrics/find/', fields=[('query', 'a.b')], timeout=10)
+      self.assertEqual(result.read(), b'slow')
+      self.assertEqual(http_request.call_count, 1)
+
+      # the primary is slower than usual, the replica responds first
+      responses['http://127.0.0.1/metrics/find/'] = HTTPResponse(body=BytesIO(b'slow'), status=200, preload_content=False)
+      finder.health.latencies['find'].extend([0.01] * 20)
+      result = finder.request('/metrics/find/', fields=[('query', 'a.b')], timeout=10)
+      self.assertEqual(result.read(), b'fast')
+      self.assertEqual(http_request.call_count, 3)
+      self.assertEqual(http_request.call_args_list[2][0], ('GET', 'http://127.0.0.2/metrics/find/'))
+
+      # the late response is closed
+      loser = responses['http://127.0.0.1/metrics/find/']
+      for _ in range(20):
+        if loser.closed:
+          break
+        time.sleep(0.1)
+      self.assertTrue(loser.closed)
+
+      # waiting for the responses is bounded by the request timeout
+      def slow_request(method, url, **kwargs):
+        time.sleep(1)
+        return HTTPResponse(body=BytesIO(b'slow'), status=200, preload_content=False)
+
+      http_request.side_effect = slow_request
+      start = time.time()
+      with self.assertRaisesRegex(Exception, 'Error requesting http://127.0.0.1/metrics/find/\\?query=a.b: Timed out'):
+        finder.request('/metrics/find/', fields=[('query', 'a.b')], timeout=0.2)
+      self.assertLess(time.time() - start, 0.8)
+      finder.succeed()
+
+      # failed hedged requests fail the host
+      http_request.side_effect = Exception('failed')
+      with self.assertRaisesRegex(Exception, 'Error requesting http://127.0.0.1/metrics/find/\\?query=a.b: failed'):
+        finder.request('/metrics/find/', fields=[('query', 'a.b')], timeout=10)
+      self.assertTrue(finder.disabled)
+
+    @override_settings(REMOTE_HEDGE_BUDGET=0.25, POOL_MAX_WORKERS=1)
+    def test_hedge_budget(self):
+      finder = RemoteFinder('127.0.0.1?replica=127.0.0.2')
+
+      # a hedged request is earned every 4 requests
+      for _ in range(3):
+        finder.earn_hedge()
+      self.assertFalse(finder.claim_hedge())
+      finder.earn_hedge()
+      self.assertTrue(finder.claim_hedge())
+      self.assertFalse(finder.claim_hedge())
+      finder.release_pool()
+
+      # at most the hedged requests of 100 requests are saved up
+      for _ in range(1000):
+        finder.earn_hedge()
+      self.assertEqual(finder.hedge_budget, 25)
+
+      # no hedging while the threads of the pool are busy
+      self.assertTrue(RemoteFinder.claim_pool())
+      self.assertTrue(RemoteFinder.claim_pool())
+      try:
+        self.assertFalse(finder.claim_hedge())
+        self.assertEqual(finder.hedge_budget, 25)
+      finally:
+        RemoteFinder.release_pool()
+        RemoteFinder.release_pool()
+      self.assertTrue(finder.claim_hedge())
+      finder.release_pool()
+      self.assertEqual(RemoteFinder.pool_jobs, 0)
+
+    @patch('urllib3.PoolManager.request')
+    @override_settings(
+      INTRACLUSTER_HTTPS=False,
+      REMOTE_STORE_USE_POST=False,
+      REMOTE_HEDGE_REQUESTS=True,
+      REMOTE_HEDGE_MIN_DELAY=0.05,
+      REMOTE_HEDGE_BUDGET=1)
+    def test_hedged_request_over_budget(self, http_request):
+      finder = RemoteFinder('127.0.0.1?replica=127.0.0.2')
+      finder.health.latencies['find'].extend([0.01] * 20)
+
+      def request(method, url, **kwargs):
+        time.sleep(0.2)
+        return HTTPResponse(body=BytesIO(b'slow'), status=200, preload_content=False)
+
+      http_request.side_effect = request
+
+      # the budget is spent, the slow request isn't sent twice
+      finder.hedge_budget = -1
+      result = finder.request('/metrics/find/', fields=[('query', 'a.b')], timeout=10)
+      self.assertEqual(result.read(), b'slow')
+      self.assertEqual(http_request.call_count, 1)
+
+      # the pool is saturated, the request is sent without it
+      finder.hedge_budget = 10
+      jobs = RemoteFinder.pool_jobs
+      RemoteFinder.pool_jobs = 2 * settings.POOL_MAX_WORKERS
+      try:
+        result = finder.request('/metrics/find/', fields=[('query', 'a.b')], timeout=10)
+      finally:
+        RemoteFinder.pool_jobs = jobs
+      self.assertEqual(result.read(), b'slow')
+      self.assertEqual(http_request.call_count, 2)
+      self.assertEqual(finder.hedge_budget, 11)
+
+      # all the threads of the pool are released
+      for _ in range(20):
+        if not RemoteFinder.pool_jobs:
+          break
+        time.sleep(0.1)
+      self.assertEqual(RemoteFinder.pool_jobs, 0)
+
+    @patch('urllib3.PoolManager.request')
+    @override_settings(
+      INTRACLUSTER_HTTPS=False,
+      REMOTE_STORE_USE_POST=False,
+      REMOTE_HEDGE_REQUESTS=True,
+      REMOTE_HEDGE_MIN_DELAY=0.05)
+    def test_hedged_request_no_replica(self, http_request):
+      finder = RemoteFinder('127.0.0.1')
+      finder.health.latencies['find'].extend([0.01] * 20)
+
+      def request(method, url, **kwargs):
+        time.sleep(0.2)
+        return HTTPResponse(body=BytesIO(b'slow'), status=200, preload_content=False)
+
+      http_request.side_effect = request
+
+      # hosts without a replica aren't sent the request twice
+      result = finder.request('/metrics/find/', fields=[('query', 'a.b')], timeout=10)
+      self.assertEqual(result.read(), b'slow')
+      self.assertEqual(http_request.call_count, 1)
+
     @override_settings(REMOTE_BUFFER_SIZE=1024 * 1024)
     def test_find_nodes_with_buffering(self):
       self._test_find_nodes()
@@ -3,6 +3,7 @@ import inspect
 import math
 import pytz
 import six
+import unittest
 
 from datetime import datetime
 from fnmatch import fnmatch
@@ -12,12 +13,14 @@ from six.moves import range
 
 from .base import TestCase
 from django.conf import settings
+from django.test import override_settings
 
 try:
     from django.urls import reverse
 except ImportError:  # Django < 1.10
     from django.urls import reverse
 
+from graphite import arrays
 from graphite.errors import NormalizeEmptyResultError, InputParameterError
 from graphite.functions import _SeriesFunctions, loadFunctions, safe
 from graphite.render.datalib import TimeSeries
@@ -25,7 +28,7 @@ from graphite.render import functions
 from graphite.render.evaluator import evaluateTarget
 from graphite.render.grammar import grammar
 from graphite.tags.utils import TaggedSeries
-from graphite.util import json
+from graphite.util import epoch, json
 
 
 def return_greater(series, value):
@@ -689,6 +692,30 @@ class FunctionsTest(TestCase):
         result = functions.aggregate({}, [], 'sum')
         self.assertEqual(result, [])
 
+    @unittest.skipIf(not arrays.np, 'numpy not installed')
+    def test_aggregate_numpy(self):
+        seriesList = self._gen_series_list_with_data(
+            key=['collectd.test-db1.load.value', 'collectd.test-db2.load.value', 'collectd.test-db3.load.value'],
+            start=0,
+            end=4,
+            data=[[1, None, 3, None], [4, 5, None, None], [7, 8, 9]]
+        )
+
+        for func in ['sum', 'total', 'average', 'avg_zero', 'median', 'min', 'max', 'diff', 'stddev', 'count', 'range', 'multiply', 'last']:
+            for xFilesFactor in [None, 0.5, 1]:
+                expected = functions.aggregate({}, copy.deepcopy(seriesList), func, xFilesFactor)
+                with override_settings(USE_NUMPY=True):
+                    result = functions.aggregate({}, copy.deepcopy(seriesList), func, xFilesFactor)
+                self.assertEqual(result, expected)
+
+        # NaN values are aggregated like without NumPy
+        seriesList[0][1] = float('nan')
+        for func in ['sum', 'max', 'min']:
+            expected = functions.aggregate({}, copy.deepcopy(seriesList), func)
+            with override_settings(USE_NUMPY=True):
+                result = functions.aggregate({}, copy.deepcopy(seriesList), func)
+            self.assertEqual([str(v) for v in result[0]], [str(v) for v in expected[0]])
+
     def test_averageSeries(self):
         seriesList = self._generate_series_list()
         data = list(range(0,101))
@@ -5272,6 +5299,21 @@ class FunctionsTest(TestCase):
         result = functions.holtWintersAnalysis(seriesList)
         self.assertEqual(result, expectedResults)
 
+    def test_holtWintersAnalysis_checkpoint(self):
+        values = [(i % 24) + (i % 7) * 0.5 if i % 11 else None for i in range(24 * 5)]
+        series = TimeSeries('collectd.test-db0.load.value', 0, 24 * 5 * 3600, 3600, values)
+        expected = functions.holtWintersAnalysis(series)
+
+        head = TimeSeries('collectd.test-db0.load.value', 0, 24 * 5 * 3600, 3600, values)
+        checkpoint = functions.holtWintersAnalysis(head, checkpoint=50)['checkpoint']
+        self.assertEqual(len(checkpoint['seasonals']), 24)
+
+        # continuing from the checkpoint gives the same results as the whole analysis
+        tail = TimeSeries('collectd.test-db0.load.value', 50 * 3600, 24 * 5 * 3600, 3600, values[50:])
+        result = functions.holtWintersAnalysis(tail, state=checkpoint)
+        self.assertEqual(list(result['predictions']), list(expected['predictions'])[50:])
+        self.assertEqual(list(result['deviations']), list(expected['deviations'])[50:])
+
     def test_movingSum_evaluateTarget_returns_none(self):
         start = 10
         end = start + 15
@@ -5436,6 +5478,49 @@ class FunctionsTest(TestCase):
             )
         self.assertEqual(result, expectedResults)
 
+    @override_settings(
+        HOLT_WINTERS_STATE_CACHE=True,
+        CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}},
+    )
+    def test_holtWintersForecast_state_cache(self):
+        step = 600
+        tz = pytz.timezone(settings.TIME_ZONE)
+        starts = []
+
+        def gen_seriesList(start, end):
+            series = TimeSeries('collectd.test-db0.load.value', start, end, step,
+                                [(t // step) % 10 + (t // 86400) for t in range(start, end, step)])
+            series.pathExpression = series.name
+            return [series]
+
+        def mock_evaluateTarget(requestContext, targets):
+            starts.append(int(epoch(requestContext['startTime'])))
+            return gen_seriesList(starts[-1], int(epoch(requestContext['endTime'])))
+
+        def forecast(hour):
+            requestContext = self._build_requestContext(
+                startTime=datetime(1970, 2, 8, hour, 0, 0, 0, tz),
+                endTime=datetime(1970, 2, 8, hour + 2, 0, 0, 0, tz)
+            )
+            requestContext['now'] = requestContext['endTime']
+            (startTime, endTime) = (int(epoch(requestContext['startTime'])), int(epoch(requestContext['endTime'])))
+            with patch('graphite.render.functions.evaluateTarget', mock_evaluateTarget):
+                return functions.holtWintersForecast(requestContext, gen_seriesList(startTime, endTime))
+
+        start = int(epoch(datetime(1970, 2, 8, 0, 0, 0, 0, tz)))
+        result = forecast(0)
+        self.assertEqual(starts, [start - 7 * 86400])
+
+        # the second request continues the model checkpointed by the first one
+        result = forecast(1)
+        self.assertEqual(starts[1], start - step)
+
+        expected = functions.holtWintersAnalysis(gen_seriesList(start - 7 * 86400, start + 3 * 3600)[0])
+        self.assertEqual(len(result), 1)
+        self.assertEqual(result[0].name, 'holtWintersForecast(collectd.test-db0.load.value)')
+        self.assertEqual((result[0].start, result[0].end), (start + 3600, start + 3 * 3600))
+        self.assertEqual(list(result[0]), list(expected['predictions'])[-12:])
+
     def test_holtWintersConfidenceBands(self):
         points=10
         step=600
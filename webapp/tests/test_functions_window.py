@@ -0,0 +1,78 @@
+import math
+import random
+
+from .base import TestCase
+
+from graphite.errors import InputParameterError
+from graphite.functions.aggfuncs import aggFuncs, aggFuncAliases
+from graphite.functions.window import SlidingWindow, slidingWindow
+
+
+def bruteForce(values, size, func, xFilesFactor):
+    aggFunc = aggFuncs.get(func) or aggFuncAliases[func]
+    result = []
+    for i in range(size, len(values) + 1):
+        nonNull = [v for v in values[i - size:i] if v is not None]
+        if nonNull and len(nonNull) / size >= xFilesFactor:
+            result.append(aggFunc(nonNull))
+        else:
+            result.append(None)
+    return result
+
+
+class SlidingWindowTest(TestCase):
+
+    def assertValuesEqual(self, result, expected):
+        self.assertEqual(len(result), len(expected))
+        for i, (r, e) in enumerate(zip(result, expected)):
+            if e is None:
+                self.assertIsNone(r, 'index %d' % i)
+            else:
+                self.assertAlmostEqual(r, e, msg='index %d' % i)
+
+    def test_slidingWindow_matches_aggfuncs(self):
+        rand = random.Random(3)
+        values = [rand.choice([None, None, rand.randint(-20, 20), rand.randint(-100, 100) / 8.0]) for _ in range(150)]
+
+        for func in list(aggFuncs) + list(aggFuncAliases):
+            for size in [1, 2, 5, 17]:
+                for xFilesFactor in [0, 0.5, 1]:
+                    self.assertValuesEqual(
+                        list(slidingWindow(values, size, func, xFilesFactor)),
+                        bruteForce(values, size, func, xFilesFactor),
+                    )
+
+    def test_slidingWindow_larger_than_series(self):
+        self.assertEqual(list(slidingWindow([1, 2, 3], 5, 'sum', 0)), [])
+
+    def test_slidingWindow_zero_size(self):
+        self.assertEqual(list(slidingWindow([1, 2, 3], 0, 'sum', 0)), [None, None, None, None])
+
+    def test_slidingWindow_all_none(self):
+        self.assertEqual(list(slidingWindow([None] * 5, 2, 'average', 0)), [None] * 4)
+
+    def test_SlidingWindow_resets_sum(self):
+        window = SlidingWindow(2, 'sum')
+        for value in [0.1, 0.2, None, None]:
+            window.push(value)
+        self.assertEqual(window.count(), 0)
+        self.assertEqual(window.total, 0)
+        self.assertIsNone(window.value())
+        window.push(0.3)
+        self.assertEqual(window.value(), 0.3)
+
+    def test_SlidingWindow_sum_drift(self):
+        # large values leaving the window don't swallow the small ones
+        values = [1e16, 1.0, 1.0, 1.0, 1.0, 1.0, 0.1, 0.2, 0.3] + [0.1] * 1000
+        sums = [math.fsum(values[i:i + 4]) for i in range(len(values) - 3)]
+        self.assertValuesEqual(list(slidingWindow(values, 4, 'sum', 0)), sums)
+        self.assertValuesEqual(list(slidingWindow(values, 4, 'average', 0)), [s / 4 for s in sums])
+
+        window = SlidingWindow(3, 'sum')
+        for value in [0.1] * 1000:
+            window.push(value)
+        self.assertEqual(window.value(), sum([0.1] * 3))
+
+    def test_SlidingWindow_invalid_func(self):
+        with self.assertRaisesRegex(InputParameterError, 'Unsupported aggregation function: bogus'):
+            SlidingWindow(2, 'bogus')
@@ -6,6 +6,7 @@ import time
 from mock import patch
 
 from django.conf import settings
+from django.test import override_settings
 try:
     from django.urls import reverse
 except ImportError:  # Django < 1.10
@@ -14,6 +15,7 @@ from .base import TestCase
 
 import whisper
 
+from graphite.finders.remote import RemoteFinder
 from graphite.util import unpickle, msgpack, json
 
 
@@ -493,6 +495,32 @@ class MetricsTester(TestCase):
         data = json.loads(response.content)
         self.assertEqual(data['results'], [u''])
 
+    @override_settings(FIND_TIMEOUT=3, FETCH_TIMEOUT=5)
+    def test_peers_view(self):
+        url = reverse('metrics_peers')
+
+        finder = RemoteFinder('127.0.0.1')
+        finder.health.latencies['fetch'].extend([0.01] * 99 + [1])
+        finder.succeed()
+        finder.fail()
+
+        with patch('graphite.metrics.views.STORE.finders', [finder]):
+            response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response['Cache-Control'], 'no-cache')
+        self.assertEqual(json.loads(response.content), [{
+            'host': '127.0.0.1',
+            'state': 'open',
+            'failures': 1,
+            'requests': 2,
+            'errorRate': 0.5,
+            'latency': {
+              'find': {'p50': None, 'p90': None, 'p99': None},
+              'fetch': {'p50': 0.01, 'p90': 0.01, 'p99': 1},
+            },
+            'timeout': {'find': 3, 'fetch': 5},
+        }])
+
     def test_get_metadata_view(self):
         """Stub to test get_metadata_view.  This currently doesn't test a valid key """
         self.create_whisper_hosts()
@@ -4,8 +4,10 @@ import mock
 
 from urllib3.response import HTTPResponse
 
+from graphite import columnar
 from graphite.finders.remote import RemoteFinder
 from graphite.readers.remote import RemoteReader
+from graphite.render.datalib import TimeSeries
 from graphite.util import pickle, BytesIO, msgpack
 from graphite.wsgi import application  # NOQA makes sure we have a working WSGI app
 
@@ -244,3 +246,19 @@ class RemoteReaderTests(TestCase):
           'preload_content': False,
           'timeout': 10,
         })
+
+        # the step limit pushed down to storage is forwarded to the peer
+        http_request.return_value = HTTPResponse(body=BytesIO(pickle.dumps(data)), status=200, preload_content=False)
+        result = reader.fetch(startTime, endTime, requestContext={'fetchMaxStep': 300})
+        self.assertEqual(result, expected_response)
+        self.assertEqual(http_request.call_args[1]['fields'][-1], ('maxStep', 300))
+
+        # columnar response
+        http_request.return_value = HTTPResponse(
+          body=BytesIO(columnar.dumps([TimeSeries(**series) for series in data])),
+          status=200,
+          preload_content=False,
+          headers={'Content-Type': 'application/x-graphite-columnar'}
+        )
+        result = reader.fetch(startTime, endTime)
+        self.assertEqual(result, expected_response)
@@ -1,6 +1,7 @@
 from .base import TestCase
 
 from graphite.readers import merge_with_cache
+from graphite.readers.utils import consolidate
 from graphite.wsgi import application  # NOQA makes sure we have a working WSGI app
 from six.moves import range
 
@@ -435,3 +436,25 @@ class MergeWithCacheTests(TestCase):
     @staticmethod
     def _create_none_window(points_per_window):
         return [None for _ in range(0, points_per_window)]
+
+
+class ConsolidateTests(TestCase):
+
+    def test_consolidate(self):
+        values = [1, 2, None, 4, 5, None, None, 8]
+
+        # buckets are aligned on the new step
+        time_info, consolidated = consolidate(102, 1, values, 5, 'sum')
+        self.assertEqual(time_info, (100, 110, 5))
+        self.assertEqual(consolidated, [3, 17])
+
+        time_info, consolidated = consolidate(100, 2, values, 4, 'max')
+        self.assertEqual(time_info, (100, 116, 4))
+        self.assertEqual(consolidated, [2, 4, 5, 8])
+
+        time_info, consolidated = consolidate(100, 2, values, 4, 'average')
+        self.assertEqual(consolidated, [1.5, 4, 5, 8])
+
+        time_info, consolidated = consolidate(100, 2, [None] * 4, 8, 'average')
+        self.assertEqual(time_info, (96, 112, 8))
+        self.assertEqual(consolidated, [None, None])
@@ -10,7 +10,11 @@ from django.conf import settings
 import whisper
 import gzip
 
-from graphite.readers import WhisperReader, GzippedWhisperReader
+from graphite import arrays
+from graphite.finders.standard import StandardFinder
+from graphite.finders.utils import FindQuery
+from graphite.readers import WhisperReader, GzippedWhisperReader, MmapWhisperReader
+from graphite.readers.whisper import HeaderCache, _read_header
 from graphite.wsgi import application  # NOQA makes sure we have a working WSGI app
 
 
@@ -151,6 +155,34 @@ class WhisperReadersTests(TestCase):
         (_, values) = reader.fetch(self.start_ts-5, self.start_ts)
         self.assertEqual(values, [None, None, None, None, 1.0])
 
+    # Confirm fetch reads from a lower resolution archive when allowed to
+    def test_WhisperReader_fetch_max_step(self):
+        self.create_whisper_hosts()
+        self.addCleanup(self.wipe_whisper_hosts)
+
+        whisper.create(self.worker2 + '.tmp', [(1, 60), (10, 60), (60, 60)])
+        os.rename(self.worker2 + '.tmp', self.worker2)
+        now = self.start_ts - self.start_ts % 60
+        whisper.update_many(self.worker2, [(now - i, i) for i in range(1, 60)], now=now)
+
+        reader = WhisperReader(self.worker2, 'hosts.worker2.cpu')
+        self.assertEqual(reader.select_archive(now - 50, now, 9), None)
+        self.assertEqual(reader.select_archive(now - 50, now, 30), 10)
+        self.assertEqual(reader.select_archive(now - 50, now, 60), 60)
+        # the 10s archive doesn't cover the start of the range
+        self.assertEqual(reader.select_archive(now - 1000, now, 30), None)
+
+        ((start, end, step), values) = reader.fetch(now - 50, now, now=now)
+        self.assertEqual(step, 1)
+        self.assertEqual(len(values), 50)
+
+        ((start, end, step), values) = reader.fetch(
+            now - 50, now, now=now, requestContext={'fetchMaxStep': 30})
+        self.assertEqual(step, 10)
+        self.assertEqual(len(values), 5)
+        # the archive holds the averages of the points
+        self.assertEqual(values[:4], [35.5, 25.5, 15.5, 5.5])
+
     # Whisper Reader broken file
     @mock.patch('whisper.fetch')
     def test_WhisperReader_fetch_returns_no_data(self, whisper_fetch):
@@ -200,3 +232,121 @@ class WhisperReadersTests(TestCase):
 
         (_, values) = reader.fetch(self.start_ts-5, self.start_ts)
         self.assertEqual(values, [None, None, None, None, 1.0])
+
+    #
+    # MmapWhisperReader tests
+    #
+
+    # Confirm fetch returns the same points as whisper
+    def test_MmapWhisperReader_fetch(self):
+        self.create_whisper_hosts()
+        self.addCleanup(self.wipe_whisper_hosts)
+
+        whisper.create(self.worker2 + '.tmp', [(1, 60), (10, 60), (60, 60)], aggregationMethod='max')
+        os.rename(self.worker2 + '.tmp', self.worker2)
+        now = self.start_ts
+        # the archives wrap around
+        whisper.update_many(self.worker2, [(now - i, i) for i in range(0, 3000, 3)], now=now)
+
+        reader = MmapWhisperReader(self.worker2, 'hosts.worker2.cpu')
+        self.assertEqual(reader.info(), whisper.info(self.worker2))
+        self.assertEqual(reader.get_raw_step(), 1)
+
+        for (fromTime, untilTime, archiveToSelect) in [
+            (now - 50, now, None),
+            (now - 70, now - 30, None),
+            (now - 500, now, None),
+            (now - 3000, now, None),
+            (now - 100000, now, None),
+            (now - 100, now - 100, None),
+            (now - 500, now, 10),
+            (now - 3000, now, 1),
+        ]:
+            expected = whisper.fetch(self.worker2, fromTime, untilTime, now=now, archiveToSelect=archiveToSelect)
+            self.assertEqual(
+                reader.fetch_data(fromTime, untilTime, now=now, archiveToSelect=archiveToSelect), expected)
+
+            # decoded with NumPy
+            if arrays.np:
+                with self.settings(USE_NUMPY=True):
+                    result = reader.fetch_data(fromTime, untilTime, now=now, archiveToSelect=archiveToSelect)
+                self.assertEqual(result, expected)
+                self.assertEqual(
+                    [type(value) for value in result[1]], [type(value) for value in expected[1]])
+
+        # the range is in the future
+        self.assertIsNone(reader.fetch_data(now + 10, now + 20, now=now))
+
+        with self.assertRaises(ValueError):
+            reader.fetch_data(now - 50, now, now=now, archiveToSelect=30)
+
+        with self.assertRaises(whisper.InvalidTimeInterval):
+            reader.fetch_data(now, now - 50, now=now)
+
+        reader = MmapWhisperReader(self.worker1, 'hosts.worker1.cpu')
+        (_, values) = reader.fetch(self.start_ts - 5, self.start_ts)
+        self.assertEqual(values, [None, None, None, None, 1.0])
+
+    # Confirm headers are parsed once
+    def test_MmapWhisperReader_header_cache(self):
+        self.create_whisper_hosts()
+        self.addCleanup(self.wipe_whisper_hosts)
+
+        with mock.patch('graphite.readers.whisper._read_header', wraps=_read_header) as read_header:
+            for _ in range(3):
+                reader = MmapWhisperReader(self.worker1, 'hosts.worker1.cpu')
+                reader.fetch(self.start_ts - 5, self.start_ts)
+                reader.get_intervals()
+            self.assertEqual(read_header.call_count, 1)
+
+            # the file was replaced
+            whisper.create(self.worker1 + '.tmp', [(10, 60)])
+            os.rename(self.worker1 + '.tmp', self.worker1)
+            reader = MmapWhisperReader(self.worker1, 'hosts.worker1.cpu')
+            self.assertEqual(reader.get_raw_step(), 10)
+            self.assertEqual(read_header.call_count, 2)
+
+    def test_HeaderCache(self):
+        cache = HeaderCache()
+        with self.settings(WHISPER_HEADER_CACHE_SIZE=2):
+            cache.set('a', 1)
+            cache.set('b', 2)
+            self.assertEqual(cache.get('a'), 1)
+            cache.set('c', 3)
+            # b is the least recently used
+            self.assertEqual(list(cache.headers), ['a', 'c'])
+            self.assertIsNone(cache.get('b'))
+
+    def test_MmapWhisperReader_broken_file(self):
+        self.create_whisper_hosts()
+        self.addCleanup(self.wipe_whisper_hosts)
+
+        # empty file
+        reader = MmapWhisperReader(self.worker3, 'hosts.worker3.cpu')
+        with self.assertRaises(whisper.CorruptWhisperFile):
+            reader.fetch(self.start_ts - 5, self.start_ts)
+
+        # truncated file
+        with open(self.worker2, 'rb+') as f:
+            f.truncate(100)
+        reader = MmapWhisperReader(self.worker2, 'hosts.worker2.cpu')
+        with self.assertRaises(whisper.CorruptWhisperFile):
+            reader.fetch(self.start_ts - 5, self.start_ts)
+
+    @mock.patch('graphite.logger.log.exception')
+    def test_MmapWhisperReader_missing_file(self, log_exception):
+        path = 'missing/file.wsp'
+        reader = MmapWhisperReader(path, 'hosts.worker2.cpu')
+
+        self.assertEqual(reader.fetch(self.start_ts-5, self.start_ts), None)
+        log_exception.assert_called_with("Failed fetch of whisper file '%s'" % path)
+
+    def test_StandardFinder_mmap(self):
+        self.create_whisper_hosts()
+        self.addCleanup(self.wipe_whisper_hosts)
+
+        finder = StandardFinder([settings.WHISPER_DIR])
+        query = FindQuery('hosts.worker1.cpu', None, None)
+        self.assertEqual([type(node.reader) for node in finder.find_nodes(query)], [WhisperReader])
+        with self.settings(WHISPER_MMAP=True):
+            self.assertEqual([type(node.reader) for node in finder.find_nodes(query)], [MmapWhisperReader])
@@ -3,20 +3,24 @@ import copy
 import os
 import time
 import math
+import pytz
 import logging
 import shutil
 import sys
+import threading
 import django
 
 from mock import patch
 
+from graphite import arrays
 from graphite.render.datalib import TimeSeries
 from graphite.render.hashing import ConsistentHashRing, hashRequest, hashData
-from graphite.render.evaluator import evaluateTarget, extractPathExpressions, evaluateScalarTokens
+from graphite.errors import InputParameterError
+from graphite.render.evaluator import Plan, copyResult, evaluateTarget, extractPathExpressions, evaluateScalarTokens, needsRawPoints, dependsOnOrder
 from graphite.render.functions import NormalizeEmptyResultError
 from graphite.render.grammar import grammar
-from graphite.render.views import renderViewJson
-from graphite.util import pickle, msgpack, json
+from graphite.render.views import renderViewColumnar, renderViewCsv, renderViewJson, renderViewMsgPack, renderViewPickle
+from graphite.util import pickle, msgpack, json, timebounds
 import whisper
 
 from django.conf import settings
@@ -25,6 +29,7 @@ try:
 except ImportError:  # Django < 1.10
     from django.urls import reverse
 from django.http import HttpRequest, QueryDict
+from django.test import override_settings
 from .base import TestCase
 
 # Silence logging during tests
@@ -103,6 +108,90 @@ class RenderTest(TestCase):
         outputs = extractPathExpressions({'template': {'test': 'blah', '1': 'baz'}}, test_input)
         self.assertEqual(sorted(outputs), sorted(expected_output))
 
+    def test_render_extractPathExpressions_windows(self):
+        start = datetime(2020, 1, 8, 0, 0, 0, tzinfo=pytz.utc)
+        end = datetime(2020, 1, 9, 0, 0, 0, tzinfo=pytz.utc)
+        requestContext = {'startTime': start, 'endTime': end, 'now': end}
+        day = 86400
+
+        windows = {}
+        outputs = extractPathExpressions(requestContext, [
+            'timeShift(a.*, "1d")',
+            'b.c|movingAverage("1h")|alias("b")',
+            'movingAverage(c.d, 5)',
+            'timeShift(movingAverage(d.e, "1h"), "7d")',
+            'timeStack(template(e.$1, "f"), "1d", 0, 2)',
+            'timeShift(g.h, "0d")',
+        ], windows)
+
+        self.assertEqual(sorted(outputs), ['a.*', 'b.c', 'c.d', 'd.e', 'e.f', 'g.h'])
+        (start, end, now) = timebounds(requestContext)
+        self.assertEqual(dict((bounds, sorted(paths)) for bounds, (context, paths) in windows.items()), {
+            (start - day, end - day, now): ['a.*', 'e.f'],
+            (start - 3600, end, now): ['b.c', 'd.e'],
+            (start - 7 * day, end - 7 * day, now): ['d.e'],
+            (start - 7 * day - 3600, end - 7 * day, now): ['d.e'],
+        })
+        for bounds, (context, paths) in windows.items():
+            self.assertEqual(timebounds(context), bounds)
+
+        # the windows are only extracted if asked for
+        self.assertEqual(sorted(extractPathExpressions(requestContext, ['timeShift(a.*, "1d")'])), ['a.*'])
+
+    def test_render_evaluateTarget_prefetch_windows(self):
+        start = datetime(2020, 1, 8, 0, 0, 0, tzinfo=pytz.utc)
+        end = datetime(2020, 1, 9, 0, 0, 0, tzinfo=pytz.utc)
+        calls = []
+
+        def fetch(patterns, startTime, endTime, now, requestContext):
+            calls.append((patterns, startTime, endTime))
+            return [
+                {
+                    'pathExpression': pattern,
+                    'name': pattern,
+                    'time_info': (startTime, endTime, 3600),
+                    'values': list(range(startTime // 3600, endTime // 3600)),
+                }
+                for pattern in patterns
+            ]
+
+        from graphite.render.datalib import prefetchData
+        rounds = []
+
+        def countedPrefetchData(*args):
+            prefetchData(*args)
+            rounds.append(len(calls))
+
+        targets = ['timeShift(a.b, "1d")', 'movingAverage(a.b, "1h")']
+        results = {}
+        for enabled in (False, True):
+            del calls[:]
+            del rounds[:]
+            with self.settings(RENDER_PREFETCH_WINDOWS=enabled):
+                with patch('graphite.render.datalib.STORE.fetch', fetch):
+                    with patch('graphite.render.evaluator.prefetchData', countedPrefetchData):
+                        results[enabled] = evaluateTarget(
+                            {'startTime': start, 'endTime': end, 'now': end, 'localOnly': False}, targets)
+            self.assertEqual(sorted(calls), [
+                (['a.b'], 1578355200, 1578441600),
+                (['a.b'], 1578438000, 1578528000),
+                (['a.b'], 1578441600, 1578528000),
+            ])
+
+        # all the windows are fetched before the functions are evaluated
+        self.assertEqual(rounds, [3, 3, 3])
+        self.assertEqual(results[True], results[False])
+        self.assertEqual(list(results[True][0]), list(range(438432, 438456)))
+
+    def test_render_needsRawPoints(self):
+        self.assertFalse(needsRawPoints(['a.b.c', '', 'alias(a.*, "x")|color("red")']))
+        self.assertFalse(needsRawPoints(['aliasByNode(seriesByTag("name=a"), 1)']))
+        self.assertFalse(needsRawPoints(['areaBetween(group=stacked(a.*))']))
+        self.assertTrue(needsRawPoints(['a.b.c', 'sumSeries(a.*)']))
+        self.assertTrue(needsRawPoints(['alias(a.*, "x")|maxSeries()']))
+        self.assertTrue(needsRawPoints(['alias(derivative(a.*), "x")']))
+        self.assertTrue(needsRawPoints(['template(a.$1, "b")']))
+
     @patch('graphite.render.evaluator.prefetchData', lambda *_: None)
     @patch('graphite.render.evaluator.fetchData', lambda requestContext, expression: [expression])
     def test_render_evaluateTokens_template(self):
@@ -189,6 +278,281 @@ class RenderTest(TestCase):
             tokens.number = ScalarTokenNumber()
             evaluateScalarTokens(tokens)
 
+    def test_grammar_cache(self):
+        target = 'sumSeries(a.b.*)|alias("x")'
+        self.assertIs(grammar.parseString(target), grammar.parseString(target))
+        self.assertEqual(grammar.parseString(target).expression.call.funcname, 'sumSeries')
+
+        with self.settings(TARGET_PARSE_CACHE_SIZE=0):
+            self.assertIsNot(grammar.parseString(target), grammar.parseString(target))
+
+        with self.settings(TARGET_PARSE_CACHE_SIZE=1):
+            tokens = grammar.parseString(target)
+            self.assertIs(grammar.parseString(target), tokens)
+            grammar.parseString('a.b.c')
+            self.assertIsNot(grammar.parseString(target), tokens)
+
+    def test_grammar_threads(self):
+        from graphite.worker_pool.pool import get_pool
+
+        targets = ['sumSeries(a.b%d.*, c.d)|alias("x%d")' % (i, i) for i in range(50)]
+        with self.settings(TARGET_PARSE_CACHE_SIZE=0):
+            pool = get_pool('test_grammar', 4)
+            results = pool.map(lambda target: grammar.parseString(target).expression.call.raw, targets)
+        self.assertEqual(results, ['sumSeries(a.b%d.*, c.d)' % i for i in range(50)])
+
+    @patch('graphite.render.evaluator.prefetchData', lambda *_: None)
+    @patch('graphite.render.evaluator.fetchData', lambda requestContext, expression: [TimeSeries(expression, 0, 1, 1, [1])])
+    def test_render_evaluateTarget_cached(self):
+        # evaluating a cached target doesn't change it
+        target = 'a.b|alias("x")|aliasSub("x", "y")'
+        for _ in range(2):
+            outputs = evaluateTarget({}, target)
+            self.assertEqual([series.name for series in outputs], ['y'])
+        self.assertEqual(len(grammar.parseString(target).expression.pipedCalls), 2)
+
+        target = 'a.b|timeShift("1d")|alias("x")'
+        for _ in range(2):
+            outputs = evaluateTarget({'startTime': datetime(2020, 1, 2), 'endTime': datetime(2020, 1, 3), 'localOnly': False, 'data': []}, target)
+            self.assertEqual([series.name for series in outputs], ['x'])
+
+    def test_render_plan(self):
+        plan = Plan({}, [
+            'asPercent(sumSeries(a.*), sumSeries(a.*))',
+            'sumSeries(a.*)|scale(2)',
+            'scale(sumSeries(a.*), 2.0)',
+            'stacked(b)',
+            'stacked(b)',
+            'template(sumSeries(a.$x), x="*")',
+            '',
+        ])
+        explain = plan.explain()
+        self.assertEqual([target['expression'] for target in explain['targets']], [
+            'asPercent(sumSeries(a.*),sumSeries(a.*))',
+            'scale(sumSeries(a.*),2)',
+            'scale(sumSeries(a.*),2.0)',
+            'stacked(b)',
+            'stacked(b)',
+            'sumSeries(a.*)',
+        ])
+        self.assertEqual(explain['calls'], [
+            {'expression': 'sumSeries(a.*)', 'args': [], 'uses': 5, 'shared': True},
+            {'expression': 'asPercent(sumSeries(a.*),sumSeries(a.*))', 'args': ['sumSeries(a.*)', 'sumSeries(a.*)'],
+             'uses': 1, 'shared': False},
+            {'expression': 'scale(sumSeries(a.*),2)', 'args': ['sumSeries(a.*)'], 'uses': 1, 'shared': False},
+            {'expression': 'scale(sumSeries(a.*),2.0)', 'args': ['sumSeries(a.*)'], 'uses': 1, 'shared': False},
+            {'expression': 'stacked(b)', 'args': [], 'uses': 2, 'shared': False},
+        ])
+
+        # the arguments of a shared call are only used once
+        plan = Plan({}, ['scale(sumSeries(a.*), 2)', 'scale(sumSeries(a.*), 2)'])
+        self.assertEqual(plan.uses, {'scale(sumSeries(a.*),2)': 2, 'sumSeries(a.*)': 1})
+
+    @patch('graphite.render.evaluator.prefetchData', lambda *_: None)
+    @patch('graphite.render.evaluator.fetchData', lambda requestContext, expression: [
+        TimeSeries(expression.replace('*', str(i)), 0, 3, 1, [i, None, 2 * i], pathExpression=expression)
+        for i in range(1, 3)])
+    def test_render_evaluateTarget_shared(self):
+        targets = [
+            'alias(sumSeries(a.*), "x")',
+            'sumSeries(a.*)|scale(10)',
+            'asPercent(sumSeries(a.*), sumSeries(a.*))',
+            'sumSeries(a.*)',
+        ]
+        expected = evaluateTarget({}, targets)
+        self.assertEqual([series.name for series in expected], [
+            'x', 'scale(sumSeries(a.*),10)', 'asPercent(sumSeries(a.*),sumSeries(a.*))', 'sumSeries(a.*)'])
+
+        from graphite.render.functions import sumSeries
+        calls = []
+
+        def countedSumSeries(requestContext, *seriesLists):
+            calls.append(seriesLists)
+            return sumSeries(requestContext, *seriesLists)
+
+        with self.settings(RENDER_SHARE_SUBEXPRESSIONS=True):
+            with patch.dict('graphite.functions._SeriesFunctions', {'sumSeries': countedSumSeries}):
+                requestContext = {}
+                outputs = evaluateTarget(requestContext, targets)
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(outputs, expected)
+        self.assertEqual([series.tags['name'] for series in outputs], [series.tags['name'] for series in expected])
+        self.assertNotIn('plan', requestContext)
+
+    @patch('graphite.render.evaluator.prefetchData', lambda *_: None)
+    @patch('graphite.render.evaluator.fetchData', lambda requestContext, expression: [
+        TimeSeries(expression.replace('*', str(i)), 0, 3, 1, [i, None, 2 * i], pathExpression=expression)
+        for i in range(1, 3)])
+    def test_render_evaluateTarget_shared_modified(self):
+        from graphite.render.functions import sumSeries
+
+        def markedSumSeries(requestContext, *seriesLists):
+            seriesList = sumSeries(requestContext, *seriesLists)
+            for series in seriesList:
+                series.options['marks'] = ['sum']
+            return seriesList
+
+        def modify(requestContext, seriesList):
+            # modifies the series it is given in place
+            for series in seriesList:
+                series[0] = 100
+                series.options['marks'].append('modified')
+                series.tags['modified'] = 1
+            return seriesList
+
+        functions = {'sumSeries': markedSumSeries, 'modify': modify}
+        for targets in (['modify(sumSeries(a.*))', 'sumSeries(a.*)'], ['sumSeries(a.*)', 'modify(sumSeries(a.*))']):
+            with patch.dict('graphite.functions._SeriesFunctions', functions):
+                expected = evaluateTarget({}, targets)
+                with self.settings(RENDER_SHARE_SUBEXPRESSIONS=True):
+                    outputs = evaluateTarget({}, targets)
+            self.assertEqual(outputs, expected)
+            # the target using the sum as is doesn't see the changes of the other one
+            for (target, series) in zip(targets, outputs):
+                modified = target.startswith('modify')
+                self.assertEqual(series[0], 100 if modified else 3)
+                self.assertEqual(series.options['marks'], ['sum', 'modified'] if modified else ['sum'])
+                self.assertEqual('modified' in series.tags, modified)
+
+    def test_render_copyResult(self):
+        values = [1.0, None, 3.0]
+        if arrays.np:
+            values = arrays.np.array([1, float('nan'), 3])
+        series = TimeSeries('a', 0, 3, 1, values, tags={'name': 'a', 'host': 'x'})
+        series.options['marks'] = ['a']
+        copied = copyResult([series])[0]
+        self.assertIs(type(copied), type(series))
+        self.assertEqual(copied, series)
+        self.assertEqual(copied.tags, series.tags)
+        self.assertEqual(list(copied), [1.0, None, 3.0])
+
+        copied.options['marks'].append('b')
+        copied.tags['host'] = 'y'
+        if arrays.np:
+            # the array of the series isn't shared
+            copied.asarray()[0] = 10
+        else:
+            copied[0] = 10
+        self.assertEqual(series.options['marks'], ['a'])
+        self.assertEqual(series.tags['host'], 'x')
+        self.assertEqual(list(series), [1.0, None, 3.0])
+
+    @patch('graphite.render.evaluator.prefetchData', lambda *_: None)
+    @patch('graphite.render.evaluator.fetchData', lambda requestContext, expression: [
+        TimeSeries(expression.replace('*', str(i)), 0, 3, 1, [i, None, 2 * i], pathExpression=expression)
+        for i in range(1, 3)])
+    def test_render_evaluateTarget_parallel(self):
+        targets = ['sumSeries(a.*)', 'b.*', 'offset(sumSeries(c.*), 2)', 'alias(sumSeries(a.*), "x")']
+        expected = evaluateTarget({}, targets)
+
+        from graphite.render.functions import scale, sumSeries
+        barrier = threading.Barrier(2, timeout=5)
+        threads = set()
+
+        def concurrentScale(requestContext, seriesList, factor):
+            # only returns once another target is evaluated at the same time
+            threads.add(threading.current_thread())
+            barrier.wait()
+            return scale(requestContext, seriesList, factor)
+
+        with self.settings(RENDER_POOL_MAX_WORKERS=4, RENDER_POOL_MAX_WORKERS_PER_REQUEST=2):
+            with patch.dict('graphite.functions._SeriesFunctions', {'scale': concurrentScale}):
+                outputs = evaluateTarget({}, ['scale(a.*, 1)', 'scale(b.*, 2)'] + targets)
+        self.assertEqual(len(threads), 2)
+        self.assertEqual(outputs[4:], expected)
+        self.assertEqual([series.name for series in outputs[:4]], [
+            'scale(a.1,1)', 'scale(a.2,1)', 'scale(b.1,2)', 'scale(b.2,2)'])
+
+        # the calls shared between targets evaluated in parallel are evaluated once
+        calls = []
+
+        def countedSumSeries(requestContext, *seriesLists):
+            calls.append(seriesLists)
+            return sumSeries(requestContext, *seriesLists)
+
+        with self.settings(RENDER_POOL_MAX_WORKERS=4, RENDER_SHARE_SUBEXPRESSIONS=True):
+            with patch.dict('graphite.functions._SeriesFunctions', {'sumSeries': countedSumSeries}):
+                requestContext = {}
+                outputs = evaluateTarget(requestContext, targets)
+        self.assertEqual(len(calls), 2)
+        self.assertEqual(outputs, expected)
+        self.assertNotIn('plan', requestContext)
+
+        # the error of the first target that fails is raised
+        with self.settings(RENDER_POOL_MAX_WORKERS=4):
+            with self.assertRaisesRegex(InputParameterError, 'unknown function: first'):
+                evaluateTarget({}, targets + ['first(a.*)', 'second(a.*)'])
+
+    @patch('graphite.render.evaluator.prefetchData', lambda *_: None)
+    @patch('graphite.render.evaluator.fetchData', lambda requestContext, expression: [
+        TimeSeries(expression.replace('*', str(i)), 0, 3, 1, [i, None, 2 * i], pathExpression=expression)
+        for i in range(1, 3)])
+    def test_render_evaluateTarget_parallel_contexts(self):
+        from graphite.render import evaluator
+        contexts = []
+
+        def recordedEvaluateTargetTokens(requestContext, target):
+            contexts.append(requestContext)
+            return evaluator.evaluateTokens(requestContext, target)
+
+        requestContext = {'prefetched': {(0, 60, 60): {'a.*': []}}}
+        with self.settings(RENDER_POOL_MAX_WORKERS=4):
+            with patch('graphite.render.evaluator.evaluateTargetTokens', recordedEvaluateTargetTokens):
+                evaluator.evaluateTargetsParallel(requestContext, [grammar.parseString('a.*')] * 3, evaluator.get_pool('render', 4))
+        # each target stores the windows its functions fetch in a map of its own
+        self.assertEqual(len(set(id(context['prefetched']) for context in contexts + [requestContext])), 4)
+        self.assertEqual(len(set(id(context['prefetched'][(0, 60, 60)]) for context in contexts + [requestContext])), 4)
+        for context in contexts:
+            self.assertEqual(context['prefetched'], requestContext['prefetched'])
+
+    @patch('graphite.render.evaluator.prefetchData', lambda *_: None)
+    @patch('graphite.render.evaluator.fetchData', lambda requestContext, expression: [
+        TimeSeries(expression.replace('*', str(i)), 0, 3, 1, [i, None, 2 * i], pathExpression=expression)
+        for i in range(1, 3)])
+    def test_render_evaluateTarget_parallel_cpu_time(self):
+        from graphite.render.functions import scale
+        threads = []
+
+        def busyScale(requestContext, seriesList, factor):
+            threads.append(threading.current_thread())
+            sum(range(100000))
+            return scale(requestContext, seriesList, factor)
+
+        targets = ['scale(a.*, %d)' % i for i in range(8)]
+        with self.settings(RENDER_POOL_MAX_WORKERS=4, RENDER_POOL_CPU_TIME_PER_REQUEST=1e-9):
+            with patch.dict('graphite.functions._SeriesFunctions', {'scale': busyScale}):
+                outputs = evaluateTarget({}, targets)
+        self.assertEqual(len(outputs), 16)
+        # once a pool thread used the budget, the thread of the request evaluates the other targets
+        self.assertLessEqual(len([thread for thread in threads if thread is not threading.current_thread()]), 3)
+
+    def test_render_dependsOnOrder(self):
+        self.assertFalse(dependsOnOrder(grammar.parseString(target) for target in ['a.*', 'sumSeries(a.*)|alias("x")']))
+        self.assertTrue(dependsOnOrder(grammar.parseString(target) for target in ['a.*', 'a.*|stacked()']))
+        self.assertTrue(dependsOnOrder([grammar.parseString('alias(setXFilesFactor(a.*, 0.5), "x")')]))
+
+    def test_render_view_explain(self):
+        url = reverse('render')
+        with self.settings(RENDER_SHARE_SUBEXPRESSIONS=True):
+            response = self.client.get(url, {
+                'target': ['sumSeries(a.*)|alias("x")', 'sumSeries(a.*)'], 'explain': '1'})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response['Content-Type'], 'application/json')
+        self.assertEqual(json.loads(response.content), {
+            'targets': [
+                {'target': 'sumSeries(a.*)|alias("x")', 'expression': "alias(sumSeries(a.*),'x')"},
+                {'target': 'sumSeries(a.*)', 'expression': 'sumSeries(a.*)'},
+            ],
+            'calls': [
+                {'expression': 'sumSeries(a.*)', 'args': [], 'uses': 2, 'shared': True},
+                {'expression': "alias(sumSeries(a.*),'x')", 'args': ['sumSeries(a.*)'], 'uses': 1, 'shared': False},
+            ],
+            'pathExpressions': ['a.*'],
+            'windows': [],
+            'shareSubexpressions': True,
+            'prefetchWindows': False,
+        })
+
     def test_render_view(self):
         url = reverse('render')
 
@@ -514,6 +878,101 @@ class RenderTest(TestCase):
         self.assertEqual(responsejsonp['content-type'], 'text/javascript')
         self.assertEqual(resp_text(responsejsonp), 'test(' + resp_text(response) + ')')
 
+    def test_render_view_pushdown(self):
+        self.addCleanup(self.wipe_whisper)
+        whisper.create(self.db, [(1, 600), (10, 600)])
+        ts = int(time.time())
+        whisper.update_many(self.db, [(ts - i, i) for i in range(1, 300)], now=ts)
+
+        url = reverse('render')
+        params = {'target': 'test', 'format': 'json', 'from': ts - 300, 'until': ts, 'now': ts, 'maxDataPoints': 10}
+
+        with patch('whisper.fetch', wraps=whisper.fetch) as fetch:
+            response = self.client.get(url, params)
+            self.assertEqual(response.status_code, 200)
+            self.assertIsNone(fetch.call_args[1]['archiveToSelect'])
+            expected = json.loads(response.content)
+            self.assertEqual(len(expected[0]['datapoints']), 10)
+
+            with self.settings(RENDER_PUSHDOWN_MAX_DATA_POINTS=True):
+                # read from the 10s archive, then consolidated to 30s by renderViewJson
+                response = self.client.get(url, params)
+                self.assertEqual(fetch.call_args[1]['archiveToSelect'], 10)
+                result = json.loads(response.content)
+                self.assertEqual(len(result[0]['datapoints']), 10)
+
+                # derivative() needs the raw points
+                response = self.client.get(url, dict(params, target='derivative(test)'))
+                self.assertIsNone(fetch.call_args[1]['archiveToSelect'])
+
+    @override_settings(
+        HOLT_WINTERS_STATE_CACHE=True,
+        CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}},
+    )
+    def test_render_view_holtWinters_state_cache(self):
+        self.addCleanup(self.wipe_whisper)
+        # 6 hours of 10s points, 8 days of 1m points
+        whisper.create(self.db, [(10, 2160), (60, 11520)])
+        ts = int(time.time())
+        ts -= ts % 60
+        whisper.update_many(self.db, [(ts - i * 60, i % 1440) for i in range(1, 11520)], now=ts)
+        whisper.update_many(self.db, [(ts - i * 10, (i // 6) % 1440) for i in range(1, 2160)], now=ts)
+
+        url = reverse('render')
+        params = {'target': 'holtWintersForecast(test)', 'format': 'json', 'from': ts - 3600, 'until': ts, 'now': ts, 'noCache': 1}
+
+        with patch('whisper.fetch', wraps=whisper.fetch) as fetch:
+            response = self.client.get(url, params)
+            self.assertEqual(response.status_code, 200)
+            # the request window is read from the 10s archive, the bootstrap interval from the 1m one
+            fetch.reset_mock()
+
+            response = self.client.get(url, params)
+            self.assertEqual(response.status_code, 200)
+            # the model is continued from its checkpoint, with points of the archive it was checkpointed with
+            self.assertEqual(fetch.call_count, 2)
+            (args, kwargs) = fetch.call_args_list[-1]
+            self.assertGreaterEqual(args[1], ts - 2 * 3600)
+            self.assertEqual(kwargs['archiveToSelect'], 60)
+
+        with self.settings(HOLT_WINTERS_STATE_CACHE=False):
+            expected = self.client.get(url, params)
+        self.assertEqual(json.loads(response.content), json.loads(expected.content))
+
+    def test_render_streaming(self):
+        data = [
+            TimeSeries('test', 1, 6, 1, [1, None, 3.5, float('nan'), 5]),
+            TimeSeries('test2;a=b', 1, 6, 1, [None, 2, 3, 4, float('inf')]),
+        ]
+        data[1].tags = {'name': 'test2', 'a': 'b'}
+        options = [
+            {},
+            {'pretty': 1},
+            {'jsonp': 'test'},
+            {'maxDataPoints': 2, 'noNullPoints': 1},
+        ]
+        views = [
+            (renderViewCsv, {}),
+            (renderViewPickle, {}),
+            (renderViewMsgPack, {}),
+            (renderViewColumnar, {}),
+        ] + [(renderViewJson, o) for o in options]
+
+        for view, o in views:
+            for series in [data, data[:1], []]:
+                requestOptions = dict(o, tzinfo=pytz.utc)
+                expected = view(requestOptions, copy.deepcopy(series))
+                with override_settings(RENDER_STREAMING=True):
+                    response = view(requestOptions, copy.deepcopy(series))
+                self.assertTrue(response.streaming)
+                self.assertEqual(response['content-type'], expected['content-type'])
+                content = b''.join(response.streaming_content)
+                if view is renderViewPickle:
+                    # streamed pickles use protocol 2, compare what they decode to
+                    self.assertEqual(repr(pickle.loads(content)), repr(pickle.loads(expected.content)))
+                else:
+                    self.assertEqual(content, expected.content)
+
     def verify_maxDataPoints(self, data, tests):
         requestOptions = {}
         for (maxDataPoints, expectedData) in tests:
@@ -1,4 +1,11 @@
+import copy
+import os
+import pickle
 import pytz
+import random
+import time
+import unittest
+import whisper
 
 from datetime import datetime
 from mock import mock, patch
@@ -6,9 +13,12 @@ import sys
 
 from .base import TestCase
 from django.conf import settings
+from django.test import override_settings
 
-from graphite.render.datalib import TimeSeries, fetchData, _merge_results, prefetchData
+from graphite import arrays
+from graphite.render.datalib import ArrayTimeSeries, Tags, TimeSeries, fetchData, _merge_results, _splice, prefetchData
 from graphite.util import timebounds
+from graphite.worker_pool.pool import get_pool
 from six.moves import range
 
 
@@ -35,6 +45,16 @@ class TimeSeriesTest(TestCase):
       series = TimeSeries("collectd.test-db.load.value;", 0, 2, 1, [1, 2])
       self.assertEqual(series.tags, {'name': 'collectd.test-db.load.value;'})
 
+    def test_TimeSeries_tags(self):
+      series = TimeSeries("collectd.test-db.load.value", 0, 1, 1, [1], tags={'name': 'a', 'x': 1})
+      self.assertIsInstance(series.tags, Tags)
+      self.assertEqual(series.tags['x'], '1')
+
+      series.tags = {'name': 'b'}
+      self.assertIsInstance(series.tags, Tags)
+      with self.assertRaisesRegex(Exception, 'Invalid tags specified'):
+        series.tags = 'name=b'
+
     def test_TimeSeries_equal_list(self):
       values = list(range(0,100))
       series = TimeSeries("collectd.test-db.load.value", 0, len(values), 1, values)
@@ -255,6 +275,157 @@ class TimeSeriesTest(TestCase):
       with self.assertRaisesRegex(Exception, "Invalid consolidation function: 'bogus'"):
         _ = list(series)
 
+    def test_TimeSeries_iterate_valuesPerPoint_m4(self):
+      values = [3, 1, None, 8, 2, 5, None, None, None, None, 4, float('nan'), 6, 9, 0, 7, 2]
+
+      series = TimeSeries("collectd.test-db.load.value", 0, len(values), 1, values, consolidate='sum')
+      self.assertEqual(series.pointsPerValue, 1)
+
+      series.consolidate(5, downsample='m4')
+      self.assertEqual(series.valuesPerPoint, 5)
+      self.assertEqual(series.pointsPerValue, 4)
+      self.assertEqual(list(series), [
+        3, 1, 8, 2,
+        5, 5, 5, 5,
+        4, 9, 0, 0,
+        7, 7, 2, 2,
+      ])
+
+      # buckets below the xFilesFactor are gaps
+      series.xFilesFactor = 0.5
+      self.assertEqual(list(series)[4:8], [None, None, None, None])
+
+      # consolidating again resets the downsampling
+      series.consolidate(5)
+      self.assertEqual(series.pointsPerValue, 1)
+      self.assertEqual(len(list(series)), 4)
+
+    @unittest.skipIf(not arrays.np, 'numpy not installed')
+    def test_TimeSeries_iterate_numpy(self):
+      rand = random.Random(42)
+      values = [rand.choice([None, rand.randint(-100, 100) / 4.0]) for _ in range(103)]
+
+      for func in ['sum', 'average', 'avg', 'avg_zero', 'max', 'min', 'first', 'last']:
+        for valuesPerPoint in [2, 3, 7, 200]:
+          for xFilesFactor in [0, 0.5, 1]:
+            series = TimeSeries("collectd.test-db.load.value", 0, len(values), 1, values, consolidate=func, xFilesFactor=xFilesFactor)
+            series.consolidate(valuesPerPoint)
+            expected = list(series)
+
+            with override_settings(USE_NUMPY=True):
+              self.assertTrue(arrays.enabled())
+              series.consolidate(valuesPerPoint)
+              self.assertIsInstance(series, ArrayTimeSeries)
+              result = list(series)
+
+            self.assertEqual(len(result), len(expected))
+            for r, e in zip(result, expected):
+              if e is None:
+                self.assertIsNone(r)
+              else:
+                self.assertAlmostEqual(r, e)
+
+    @unittest.skipIf(not arrays.np, 'numpy not installed')
+    @override_settings(USE_NUMPY=True)
+    def test_TimeSeries_iterate_numpy_fallback(self):
+      series = TimeSeries("collectd.test-db.load.value", 0, 2, 1, ['a', 'b', 'c'], consolidate='first')
+      series.consolidate(2)
+      self.assertEqual(list(series), ['a', 'c'])
+
+      series = TimeSeries("collectd.test-db.load.value", 0, 5, 1, [1, 2, 3], consolidate='bogus')
+      series.consolidate(2)
+      with self.assertRaisesRegex(Exception, "Invalid consolidation function: 'bogus'"):
+        _ = list(series)
+
+    @unittest.skipIf(not arrays.np, 'numpy not installed')
+    @override_settings(USE_NUMPY=True)
+    def test_TimeSeries_array_storage(self):
+      values = arrays.np.array([1, 2, float('nan'), 4, 5, 6])
+      series = TimeSeries("collectd.test-db.load.value", 0, 6, 1, values, consolidate='sum')
+      self.assertIsInstance(series, ArrayTimeSeries)
+      self.assertEqual(list.__len__(series), 0)
+      self.assertEqual(len(series), 6)
+      # the series has a copy of the array
+      self.assertIsNot(series.asarray(), values)
+      series.asarray()[0] = 10
+      self.assertEqual(values[0], 1)
+      series.asarray()[0] = 1
+
+      # consolidating doesn't fill the list
+      series.consolidate(2)
+      self.assertEqual(list(series), [3.0, 4.0, 11.0])
+      series.consolidationFunc = 'max'
+      self.assertEqual(list(series), [2.0, 4.0, 6.0])
+      self.assertIsInstance(series, ArrayTimeSeries)
+      self.assertEqual(list.__len__(series), 0)
+
+      # using it as a list does
+      series[0] = 10
+      self.assertNotIsInstance(series, ArrayTimeSeries)
+      self.assertEqual(list.__len__(series), 6)
+      self.assertNotIn('_array', series.__dict__)
+      self.assertEqual(list(series), [10, 4.0, 6.0])
+      series.consolidate(1)
+      self.assertEqual(list(series), [10, 2.0, None, 4.0, 5.0, 6.0])
+
+      # list series are converted when consolidated
+      series.consolidate(3)
+      self.assertIsInstance(series, ArrayTimeSeries)
+      self.assertEqual(list.__len__(series), 0)
+      self.assertEqual(list(series), [10.0, 6.0])
+
+      # series compared to each other are both filled
+      other = TimeSeries("collectd.test-db.load.value", 0, 6, 1, values, consolidate='max')
+      other.consolidate(3)
+      series.consolidate(3)
+      self.assertNotEqual(series, other)
+      other[0] = 10
+      self.assertEqual(series, other)
+
+      # pickling and copying keep the values
+      series = TimeSeries("collectd.test-db.load.value", 0, 6, 1, values)
+      for copied in (pickle.loads(pickle.dumps(series)), copy.deepcopy(series)):
+        self.assertIs(type(copied), TimeSeries)
+        self.assertEqual(copied, series)
+        self.assertEqual(list(copied), [1.0, 2.0, None, 4.0, 5.0, 6.0])
+
+    @unittest.skipIf(not arrays.np, 'numpy not installed')
+    @override_settings(USE_NUMPY=True)
+    def test_TimeSeries_array_storage_m4(self):
+      values = arrays.np.array([1, 5, float('nan'), 4])
+      series = TimeSeries("collectd.test-db.load.value", 0, 4, 1, values)
+      series.consolidate(4, downsample='m4')
+      self.assertEqual(list(series), [1.0, 1.0, 5.0, 4.0])
+
+      # m4 and unknown functions fall back to the list
+      series = TimeSeries("collectd.test-db.load.value", 0, 4, 1, values, consolidate='bogus')
+      series.consolidate(2)
+      with self.assertRaisesRegex(Exception, "Invalid consolidation function: 'bogus'"):
+        _ = list(series)
+
+    @unittest.skipIf(not arrays.np, 'numpy not installed')
+    def test_TimeSeries_consolidate_numpy_nan(self):
+      values = [1, float('nan'), 3, None, None, 2, float('nan'), None]
+      for func in ['sum', 'average', 'max', 'min', 'first', 'last']:
+        series = TimeSeries("collectd.test-db.load.value", 0, 8, 1, values, consolidate=func)
+        series.consolidate(2)
+        expected = [str(v) for v in series]
+        with override_settings(USE_NUMPY=True):
+          series.consolidate(2)
+          self.assertEqual([str(v) for v in series], expected, func)
+
+    @unittest.skipIf(not arrays.np, 'numpy not installed')
+    def test_TimeSeries_array_values(self):
+      values = arrays.np.array([1.0, float('nan'), 3.0])
+      series = TimeSeries("collectd.test-db.load.value", 0, 3, 1, values)
+      self.assertEqual(list(series), [1.0, None, 3.0])
+      self.assertIsInstance(series[0], float)
+
+      array = series.asarray()
+      self.assertEqual(array.dtype, arrays.np.float64)
+      self.assertEqual(array[0], 1.0)
+      self.assertTrue(arrays.np.isnan(array[1]))
+
 
 class DatalibFunctionTest(TestCase):
     def _build_requestContext(self, startTime=datetime(1970, 1, 1, 0, 0, 0, 0, pytz.timezone(settings.TIME_ZONE)), endTime=datetime(1970, 1, 1, 0, 59, 0, 0, pytz.timezone(settings.TIME_ZONE)), data=[], tzinfo=pytz.utc):
@@ -409,3 +580,179 @@ class DatalibFunctionTest(TestCase):
         prefetchData(requestContext, ['test'])
 
         self.assertEqual(requestContext['prefetched'][timebounds(requestContext)], {})
+
+    def _fake_fetch(self, names, calls):
+      # mimics whisper's alignment of the returned interval
+      def fetch(patterns, startTime, endTime, now, requestContext):
+        calls.append((patterns, startTime, endTime))
+        step = 60
+        start = startTime - (startTime % step) + step
+        end = endTime - (endTime % step) + step
+        return [
+          {
+            'pathExpression': pattern,
+            'name': name,
+            'time_info': (start, end, step),
+            'values': [ts // step for ts in range(start, end, step)],
+          }
+          for pattern in patterns
+          for name in names
+        ]
+      return fetch
+
+    @override_settings(
+      INCREMENTAL_DATA_CACHE=True,
+      CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}},
+    )
+    def test_prefetchData_incremental(self):
+      calls = []
+      tz = pytz.timezone(settings.TIME_ZONE)
+
+      def requestContext(minute):
+        return {
+          'startTime': datetime(1970, 1, 1, 0, minute - 10, 0, 0, tz),
+          'endTime': datetime(1970, 1, 1, 0, minute, 0, 0, tz),
+          'now': datetime(1970, 1, 1, 0, minute, 0, 0, tz),
+        }
+
+      with patch('graphite.render.datalib.STORE.fetch', self._fake_fetch(['a.b', 'a.c'], calls)):
+        first = requestContext(20)
+        prefetchData(first, ['a.*'])
+        self.assertEqual(calls, [(['a.*'], 600, 1200)])
+
+        second = requestContext(25)
+        prefetchData(second, ['a.*'])
+        # only the tail since the end of the cached window (minus the overlap) is fetched
+        self.assertEqual(calls[1], (['a.*'], 1080, 1500))
+
+        expected = self._fake_fetch(['a.b', 'a.c'], [])(['a.*'], 900, 1500, 1500, {})
+        prefetched = second['prefetched'][timebounds(second)]['a.*']
+        self.assertEqual(prefetched, [(r['name'], (r['time_info'], r['values'])) for r in expected])
+
+      # a new series showed up, the whole window is fetched again
+      with patch('graphite.render.datalib.STORE.fetch', self._fake_fetch(['a.b', 'a.c', 'a.d'], calls)):
+        third = requestContext(26)
+        prefetchData(third, ['a.*'])
+        self.assertEqual(calls[2:], [(['a.*'], 1380, 1560), (['a.*'], 960, 1560)])
+        self.assertEqual(len(third['prefetched'][timebounds(third)]['a.*']), 3)
+
+      # windows that don't end now bypass the cache
+      with patch('graphite.render.datalib.STORE.fetch', self._fake_fetch(['a.b'], calls)):
+        past = requestContext(20)
+        past['now'] = datetime(1970, 1, 1, 1, 0, 0, 0, tz)
+        prefetchData(past, ['a.*'])
+        self.assertEqual(calls[4:], [(['a.*'], 600, 1200)])
+
+    @override_settings(
+      INCREMENTAL_DATA_CACHE=True,
+      CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}},
+    )
+    def test_prefetchData_incremental_archives(self):
+      db = os.path.join(settings.WHISPER_DIR, 'incremental.wsp')
+      # 1 hour of 10s points, 1 day of 1m points
+      whisper.create(db, [(10, 360), (60, 1440)])
+      self.addCleanup(os.remove, db)
+      ts = int(time.time())
+      ts -= ts % 60
+      whisper.update_many(db, [(ts + 300 - i * 10, i) for i in range(1, 1000)], now=ts + 300)
+
+      def requestContext(now):
+        return {
+          'startTime': datetime.fromtimestamp(now - 3 * 3600, pytz.utc),
+          'endTime': datetime.fromtimestamp(now, pytz.utc),
+          'now': datetime.fromtimestamp(now, pytz.utc),
+        }
+
+      with patch('whisper.fetch', wraps=whisper.fetch) as fetch:
+        prefetchData(requestContext(ts), ['incremental'])
+        self.assertEqual(fetch.call_count, 1)
+
+        second = requestContext(ts + 300)
+        prefetchData(second, ['incremental'])
+        # the tail is read from the archive of the cached window, and spliced onto it
+        self.assertEqual(fetch.call_count, 2)
+        self.assertEqual(fetch.call_args[1]['archiveToSelect'], 60)
+
+      expected = requestContext(ts + 300)
+      with self.settings(INCREMENTAL_DATA_CACHE=False):
+        prefetchData(expected, ['incremental'])
+      self.assertEqual(
+        second['prefetched'][timebounds(second)]['incremental'],
+        expected['prefetched'][timebounds(expected)]['incremental'])
+
+    def test_prefetchData_windows(self):
+      calls = []
+      tz = pytz.timezone(settings.TIME_ZONE)
+
+      def requestContext(minute):
+        return {
+          'startTime': datetime(1970, 1, 1, 0, minute - 10, 0, 0, tz),
+          'endTime': datetime(1970, 1, 1, 0, minute, 0, 0, tz),
+          'now': datetime(1970, 1, 1, 0, 20, 0, 0, tz),
+        }
+
+      fake_fetch = self._fake_fetch(['a.b'], calls)
+
+      def fetch(patterns, startTime, endTime, now, requestContext):
+        if startTime == 0:
+          raise Exception('failed')
+        return fake_fetch(patterns, startTime, endTime, now, requestContext)
+
+      for pool in (True, False):
+        del calls[:]
+        context = requestContext(20)
+        windows = {
+          timebounds(requestContext(15)): (requestContext(15), set(['a.*', 'b.*'])),
+          timebounds(requestContext(10)): (requestContext(10), set(['a.*'])),
+        }
+        with self.settings(USE_WORKER_POOL=pool):
+          with patch('graphite.render.datalib.STORE.fetch', fetch):
+            with patch('graphite.render.datalib.log.info') as log_info:
+              prefetchData(context, ['a.*'], windows)
+        self.assertEqual(sorted(calls), [(['a.*'], 600, 1200), (['a.*', 'b.*'], 300, 900)])
+        # the windows that failed are left to the functions
+        self.assertEqual(log_info.call_count, 1)
+        self.assertEqual(sorted(context['prefetched']), [(300, 900, 1200), (600, 1200, 1200)])
+        self.assertEqual(sorted(context['prefetched'][(300, 900, 1200)]), ['a.*', 'b.*'])
+
+        # the windows already prefetched aren't fetched again
+        prefetchData(context, ['a.*'], {timebounds(requestContext(15)): (requestContext(15), set(['a.*']))})
+        self.assertEqual(len(calls), 2)
+
+    def test_prefetchData_windows_pool(self):
+      tz = pytz.timezone(settings.TIME_ZONE)
+
+      def requestContext(minute):
+        return {
+          'startTime': datetime(1970, 1, 1, 0, minute - 10, 0, 0, tz),
+          'endTime': datetime(1970, 1, 1, 0, minute, 0, 0, tz),
+          'now': datetime(1970, 1, 1, 0, 20, 0, 0, tz),
+        }
+
+      with patch.dict('graphite.worker_pool.pool._pools', clear=True):
+        with patch('graphite.render.datalib.STORE.fetch', self._fake_fetch(['a.b'], [])):
+          # a single other window doesn't size the pool shared by all the requests
+          prefetchData(requestContext(20), ['a.*'], {timebounds(requestContext(15)): (requestContext(15), set(['a.*']))})
+        pool = get_pool('prefetch')
+      pool.close()
+      self.assertEqual(pool._processes, settings.POOL_MAX_WORKERS)
+
+    def test__splice(self):
+      cached = [('a', ((60, 300, 60), [1, 2, 3, 4]))]
+
+      self.assertEqual(_splice(cached, [('a', ((240, 360, 60), [40, 5]))], 100), [('a', ((120, 360, 60), [2, 3, 40, 5]))])
+      # startTime past the cached data
+      self.assertEqual(_splice(cached, [('a', ((240, 360, 60), [40, 5]))], 250), [('a', ((240, 360, 60), [40, 5]))])
+      # step changed
+      self.assertIsNone(_splice(cached, [('a', ((240, 360, 120), [40]))], 100))
+      # misaligned or disjoint tail
+      self.assertIsNone(_splice(cached, [('a', ((250, 370, 60), [40, 5]))], 100))
+      self.assertIsNone(_splice(cached, [('a', ((360, 420, 60), [6]))], 100))
+      # duplicate series
+      self.assertIsNone(_splice(cached, [('a', ((240, 360, 60), [40, 5])), ('a', ((240, 360, 60), [40, 5]))], 100))
+
+      # values decoded as arrays, with NaN for gaps
+      if arrays.np:
+        cached = [('a', ((60, 300, 60), arrays.np.array([1.0, float('nan'), 3.0, 4.0])))]
+        tail = [('a', ((240, 360, 60), arrays.np.array([float('nan'), 5.0])))]
+        self.assertEqual(_splice(cached, tail, 0), [('a', ((60, 360, 60), [1.0, None, 3.0, None, 5.0]))])
@@ -1,6 +1,7 @@
 import os
 import random
 import shutil
+import threading
 import time
 import whisper
 
@@ -61,6 +62,56 @@ class StorageTest(TestCase):
     self.assertEqual(result[2]['name'], 'a.b.c.e')
     self.assertEqual(result[2]['pathExpression'], 'a.**')
 
+  @override_settings(COALESCE_REQUESTS=True)
+  def test_fetch_coalesced(self):
+    release = threading.Event()
+    calls = []
+
+    class SlowFinder(RemoteFinder):
+      local = True
+
+      def fetch(self, patterns, start_time, end_time, now=None, requestContext=None):
+        calls.append(patterns)
+        release.wait()
+        return super(SlowFinder, self).fetch(patterns, start_time, end_time, now=now, requestContext=requestContext)
+
+    store = Store(finders=[SlowFinder()])
+
+    results = []
+    threads = [
+      threading.Thread(target=lambda: results.append(store.fetch(['a.**'], 1, 2, 3, {})))
+      for _ in range(3)
+    ]
+    for thread in threads:
+      thread.start()
+    time.sleep(0.1)
+    release.set()
+    for thread in threads:
+      thread.join()
+
+    self.assertEqual(calls, [['a.**']])
+    self.assertEqual(len(results), 3)
+    for result in results:
+      self.assertEqual(sorted(node['name'] for node in result), ['a.b.c.d', 'a.b.c.e'])
+
+    # different time ranges aren't coalesced
+    store.fetch(['a.**'], 1, 3, 3, {})
+    self.assertEqual(len(calls), 2)
+
+    # neither are concurrent requests forwarding different headers
+    release.clear()
+    threads = [
+      threading.Thread(target=store.fetch, args=(['a.**'], 1, 2, 3, {'forwardHeaders': {'Authorization': auth}}))
+      for auth in ['a', 'b']
+    ]
+    for thread in threads:
+      thread.start()
+    time.sleep(0.1)
+    release.set()
+    for thread in threads:
+      thread.join()
+    self.assertEqual(len(calls), 4)
+
   def test_fetch_pool_timeout(self):
     # pool timeout
     store = Store(
@@ -78,6 +129,43 @@ class StorageTest(TestCase):
         self.assertEqual(log_info.call_count, 1)
         self.assertRegex(log_info.call_args[0][0], message)
 
+  @override_settings(REMOTE_ADAPTIVE_TIMEOUT=True, FETCH_TIMEOUT=10)
+  def test_fetch_adaptive_timeout(self):
+    fast = RemoteFinder()
+    fast.adaptive_timeout = lambda timeout, operation: min(timeout, 1) if operation == 'fetch' else timeout
+    slow = RemoteFinder()
+    slow.adaptive_timeout = lambda timeout, operation: min(timeout, 3) if operation == 'fetch' else timeout
+
+    timeouts = []
+
+    def mock_pool_exec(pool, jobs, timeout, job_timeout):
+      timeouts.append((timeout, [job_timeout(job) for job in jobs]))
+      raise PoolTimeoutError()
+
+    # each cluster server is waited for as long as it usually takes,
+    # local finders don't time out early
+    store = Store(finders=[fast, slow, TestFinder()])
+    with patch('graphite.storage.pool_exec', mock_pool_exec):
+      with self.assertRaises(Exception):
+        store.fetch(['a'], 1, 2, 3, {})
+    self.assertEqual(timeouts, [(10, [1, 3, 10])])
+
+  @override_settings(REMOTE_ADAPTIVE_TIMEOUT=True, FETCH_TIMEOUT=10, USE_WORKER_POOL=True)
+  def test_fetch_adaptive_timeout_slow_remote(self):
+    local = RemoteFinder()
+    local.local = True
+    slow = SlowRemoteFinder()
+    slow.adaptive_timeout = lambda timeout, operation: min(timeout, 0.2) if operation == 'fetch' else timeout
+
+    # the local results are returned without waiting for the full timeout
+    store = Store(finders=[local, slow])
+    start = time.time()
+    with patch('graphite.storage.log.info') as log_info:
+      result = store.fetch(['a.**'], 1, 2, 3, {})
+    self.assertLess(time.time() - start, 1)
+    self.assertEqual(len(result), 2)
+    self.assertRegex(log_info.call_args[0][0], r'Timed out after [-.e0-9]+s')
+
   def test_fetch_all_failed(self):
     # all finds failed
     store = Store(
@@ -683,6 +771,12 @@ class RemoteFinder(BaseFinder):
     yield LeafNode('a.b.c.e', DummyReader('a.b.c.e'))
 
 
+class SlowRemoteFinder(RemoteFinder):
+  def fetch(self, patterns, start_time, end_time, now=None, requestContext=None):
+    time.sleep(2)
+    return []
+
+
 class TestFinder(BaseFinder):
   def find_nodes(self, query):
     raise Exception('TestFinder.find_nodes')
@@ -10,6 +10,7 @@ from django.conf import settings
 from mock import patch, Mock
 
 from graphite.tags.localdatabase import LocalDatabaseTagDB
+from graphite.tags.memory import MemoryTagDB, TagIndex
 from graphite.tags.redis import RedisTagDB
 from graphite.tags.http import HttpTagDB
 from graphite.tags.utils import TaggedSeries
@@ -255,6 +256,130 @@ class TagsTest(TestCase):
     settings.TAGDB_REDIS_PORT = os.environ.get('TEST_REDIS_PORT') or 6379
     return self._test_tagdb(RedisTagDB(settings))
 
+  def test_memory_tagdb(self):
+    return self._test_tagdb(MemoryTagDB(settings))
+
+  def test_memory_tagdb_sync(self):
+    local = LocalDatabaseTagDB(settings)
+    local.tag_series('test.a;hello=tiger')
+
+    db = MemoryTagDB(settings)
+    self.assertEqual(db._find_series(['hello=tiger']), ['test.a;hello=tiger'])
+
+    # series tagged by another process are picked up by the next sync
+    local.tag_series('test.b;hello=tiger')
+    self.assertEqual(db._find_series(['hello=tiger']), ['test.a;hello=tiger'])
+    db.sync(force=True)
+    self.assertEqual(db._find_series(['hello=tiger']), ['test.a;hello=tiger', 'test.b;hello=tiger'])
+    self.assertEqual(db.get_series('test.b;hello=tiger').tags, {'hello': 'tiger', 'name': 'test.b'})
+    self.assertEqual(db.get_series('test.b;hello=tiger').id, local.get_series('test.b;hello=tiger').id)
+
+    # and so are deleted series
+    local.del_series('test.a;hello=tiger')
+    db.sync(force=True)
+    self.assertEqual(db._find_series(['hello=tiger']), ['test.b;hello=tiger'])
+    self.assertIsNone(db.get_series('test.a;hello=tiger'))
+    self.assertEqual(db.list_values('name'), [{'value': 'test.b', 'count': 1}])
+
+    # syncs are rate limited
+    local.tag_series('test.c;hello=tiger')
+    with self.settings(TAGDB_MEMORY_SYNC_INTERVAL=60):
+      db.sync()
+    self.assertEqual(db._find_series(['hello=tiger']), ['test.b;hello=tiger'])
+    with self.settings(TAGDB_MEMORY_SYNC_INTERVAL=0):
+      db.sync()
+    self.assertEqual(db._find_series(['hello=tiger']), ['test.b;hello=tiger', 'test.c;hello=tiger'])
+
+  def test_memory_tagdb_snapshot(self):
+    import os
+    import shutil
+    import tempfile
+
+    tmpdir = tempfile.mkdtemp()
+    self.addCleanup(shutil.rmtree, tmpdir)
+    snapshot = os.path.join(tmpdir, 'tagdb.snapshot')
+
+    with self.settings(TAGDB_MEMORY_SNAPSHOT=snapshot, TAGDB_MEMORY_SNAPSHOT_INTERVAL=3600):
+      db = MemoryTagDB(settings)
+      db.tag_series('test.a;hello=tiger')
+      self.assertTrue(os.path.exists(snapshot))
+
+      # the snapshot isn't saved again on every sync
+      db.tag_series('test.b;hello=lion')
+      with patch.object(db, '_save_snapshot') as save_snapshot:
+        db.sync(force=True)
+      self.assertEqual(save_snapshot.call_count, 0)
+      self.assertTrue(db.snapshot_stale)
+
+      # an out of date snapshot is saved once the interval passed
+      with self.settings(TAGDB_MEMORY_SNAPSHOT_INTERVAL=0):
+        db.sync(force=True)
+      self.assertFalse(db.snapshot_stale)
+
+      # the snapshot is loaded, only newer series are loaded from the database
+      LocalDatabaseTagDB(settings).tag_series('test.c;hello=tiger')
+      db = MemoryTagDB(settings)
+      with patch.object(db, '_load', wraps=db._load) as load:
+        self.assertEqual(db._find_series(['hello=tiger']), ['test.a;hello=tiger', 'test.c;hello=tiger'])
+      self.assertEqual(load.call_count, 1)
+      self.assertGreater(load.call_args[0][1], 0)
+
+  def test_memory_tagdb_reload(self):
+    import threading
+
+    local = LocalDatabaseTagDB(settings)
+    local.tag_series('test.a;hello=tiger')
+    local.tag_series('test.b;hello=tiger')
+
+    db = MemoryTagDB(settings)
+    self.assertEqual(db._find_series(['hello=tiger']), ['test.a;hello=tiger', 'test.b;hello=tiger'])
+    index = db.index
+
+    # the new index is built without holding the lock queries use
+    acquired = []
+    add = TagIndex.add
+
+    def try_lock():
+      if db.lock.acquire(timeout=1):
+        db.lock.release()
+        acquired.append(True)
+
+    def _add(index, series_id, path, tags):
+      if index is not db.index:
+        thread = threading.Thread(target=try_lock)
+        thread.start()
+        thread.join()
+      return add(index, series_id, path, tags)
+
+    local.del_series('test.a;hello=tiger')
+    with patch.object(TagIndex, 'add', _add):
+      db.sync(force=True)
+    self.assertEqual(acquired, [True])
+    self.assertIsNot(db.index, index)
+    self.assertEqual(db._find_series(['hello=tiger']), ['test.b;hello=tiger'])
+
+  def test_memory_tagdb_find_series(self):
+    local = LocalDatabaseTagDB(settings)
+    db = MemoryTagDB(settings)
+
+    for i in range(20):
+      db.tag_series('test.%d;dc=dc%d;env=%s;rack=r%d' % (i, i % 3, 'prod' if i % 2 else 'dev', i % 5))
+    db.tag_series('test.other;dc=dc1')
+
+    for tags in [
+      ['dc=dc1'],
+      ['dc=dc1', 'env=prod'],
+      ['dc=dc1', 'env!=prod'],
+      ['dc=~dc[12]', 'rack=~r[0-2]', 'env=prod'],
+      ['dc!=dc0', 'name=~test.1'],
+      ['dc=dc2', 'env=', 'rack!=r1'],
+      ['env=~prod|dev', 'dc!=~dc[01]$', 'rack!=~^$'],
+      ['name=~test', 'env=~$|dev'],
+      ['dc=dc3'],
+      ['unknown=~.+', 'dc=dc1'],
+    ]:
+      self.assertEqual(db._find_series(tags), local._find_series(tags), tags)
+
   def test_tagdb_autocomplete(self):
     self.maxDiff = None
 